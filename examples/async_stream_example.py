@@ -0,0 +1,32 @@
+import asyncio
+
+from absl import app
+
+from zcoinbase import AsyncCoinbaseWebsocket
+
+SANDBOX_WEBSOCKET = 'wss://ws-feed-public.sandbox.pro.coinbase.com'
+
+
+async def print_ticker(cbws, product_id, count):
+  # Each stream is a lightweight consumer on the shared event loop.
+  async for msg in cbws.stream('ticker', product_id=product_id):
+    print('{} ticker: {}'.format(product_id, msg['price']))
+    count -= 1
+    if count == 0:
+      return
+
+
+async def run():
+  async with AsyncCoinbaseWebsocket(websocket_addr=SANDBOX_WEBSOCKET,
+                                    products_to_listen=['BTC-USD', 'ETH-USD'],
+                                    extra_channels=['ticker']) as cbws:
+    await asyncio.gather(print_ticker(cbws, 'BTC-USD', 5), print_ticker(cbws, 'ETH-USD', 5))
+
+
+def main(argv):
+  del argv  # Unused
+  asyncio.run(run())
+
+
+if __name__ == '__main__':
+  app.run(main)
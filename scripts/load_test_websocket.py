@@ -0,0 +1,36 @@
+import json
+
+from absl import app, flags, logging
+from zcoinbase.synthetic_feed_server import run_load_test
+
+FLAGS = flags.FLAGS
+flags.DEFINE_float('duration', 10.0, 'Seconds to measure for.')
+flags.DEFINE_float('messages_per_second', 1000, 'Rate of generated market messages, over all products.')
+flags.DEFINE_integer('product_count', 10, 'Number of synthetic products to subscribe to.')
+flags.DEFINE_list('channels', ['level2', 'full', 'heartbeat'], 'The channels to subscribe to.')
+flags.DEFINE_bool('order_book', True, 'Maintain an order book for every product.')
+flags.DEFINE_bool('lazy_json', False, 'Decode messages lazily.')
+flags.DEFINE_bool('typed_messages', False, 'Decode messages to typed records.')
+flags.DEFINE_integer('worker_threads', 0, 'Worker threads for the message functions, 0 runs them inline.')
+flags.DEFINE_string('output', None, 'Also write the report to this JSON file.')
+
+
+def main(argv):
+  del argv  # Unused
+  report = run_load_test(duration=FLAGS.duration,
+                         messages_per_second=FLAGS.messages_per_second,
+                         product_count=FLAGS.product_count,
+                         channels=FLAGS.channels,
+                         order_book=FLAGS.order_book,
+                         lazy_json=FLAGS.lazy_json,
+                         typed_messages=FLAGS.typed_messages,
+                         worker_threads=FLAGS.worker_threads)
+  for key, value in report.items():
+    logging.info('{}: {}'.format(key, value))
+  if FLAGS.output:
+    with open(FLAGS.output, 'w') as output_file:
+      json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,38 @@
+import time
+
+from absl import app, flags, logging
+from zcoinbase import CoinbaseWebsocket, FeedRecorder
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('websocket_addr', CoinbaseWebsocket.PROD_ADDRESS, 'The websocket to record.')
+flags.DEFINE_list('product_ids', ['BTC-USD'], 'The products to record.')
+flags.DEFINE_list('channels', ['level2', 'heartbeat'], 'The channels to record.')
+flags.DEFINE_string('output_dir', None, 'The directory to write the feed logs to.')
+flags.DEFINE_integer('max_file_mb', 256, 'Start a new log file when the current one is this big.')
+flags.DEFINE_float('duration', None, 'Seconds to record for, records until interrupted by default.')
+flags.mark_flag_as_required('output_dir')
+
+
+def main(argv):
+  del argv  # Unused
+  cb_ws = CoinbaseWebsocket(websocket_addr=FLAGS.websocket_addr,
+                            products_to_listen=FLAGS.product_ids,
+                            extra_channels=FLAGS.channels,
+                            preparse_json=False,
+                            auto_reconnect=True,
+                            autostart=False)
+  with FeedRecorder(FLAGS.output_dir, max_file_bytes=FLAGS.max_file_mb << 20) as recorder:
+    recorder.attach(cb_ws)
+    cb_ws.start_websocket_in_thread()
+    start = time.monotonic()
+    try:
+      while FLAGS.duration is None or time.monotonic() - start < FLAGS.duration:
+        time.sleep(1)
+    except KeyboardInterrupt:
+      pass
+    cb_ws.close_websocket()
+  logging.info('Recorded {} frames in {} chunks'.format(recorder.frames_recorded, recorder.chunks_written))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -16,5 +16,12 @@ setup(
                     'websocket-client',
                     'sortedcontainers',
                     'python-dateutil',
-                    'pandas']
+                    'pandas',
+                    'numpy'],
+  extras_require={
+    # Faster JSON decoding in the websocket client.
+    'orjson': ['orjson'],
+    # AsyncCoinbaseWebsocket and the synthetic feed server.
+    'asyncio': ['websockets'],
+  }
 )
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from zcoinbase import AsyncCoinbaseWebsocket
+from zcoinbase.util import LogLevel
+from zcoinbase.synthetic_feed_server import SyntheticFeedServer
+
+
+class _Frames:
+  """Stands in for the connection, yields the frames and then ends like a closed websocket."""
+
+  def __init__(self, frames):
+    self.frames = frames
+
+  async def __aiter__(self):
+    for frame in self.frames:
+      yield frame
+
+
+@pytest.fixture
+def feed_server():
+  # Only the server needs websockets.
+  pytest.importorskip('websockets')
+  server = SyntheticFeedServer(messages_per_second=2000, product_count=2, seed=1, log_level=LogLevel.NO_LOG)
+  server.start()
+  yield server
+  server.stop()
+
+
+def test_function_exceptions_are_reported_and_reading_continues(feed_server):
+  errors = []
+  tickers = []
+
+  def on_ticker(message):
+    tickers.append(message)
+    raise ValueError('Bad ticker {}'.format(len(tickers)))
+
+  async def on_ticker_async(message):
+    raise KeyError('Bad async ticker')
+
+  async def run():
+    cbws = AsyncCoinbaseWebsocket(websocket_addr=feed_server.address, products_to_listen=feed_server.product_ids,
+                                  channels_to_function={'ticker': [on_ticker, on_ticker_async],
+                                                        'error': errors.append},
+                                  log_level=LogLevel.NO_LOG)
+    async with cbws:
+      for _ in range(100):
+        if len(tickers) >= 3:
+          break
+        await asyncio.sleep(0.05)
+      assert not cbws._reader_task.done()
+
+  asyncio.run(run())
+  assert len(tickers) >= 3
+  assert any(isinstance(error, ValueError) for error in errors)
+  assert any(isinstance(error, KeyError) for error in errors)
+
+
+def test_frames_that_fail_to_decode_are_reported_and_reading_continues():
+  errors = []
+  tickers = []
+  cbws = AsyncCoinbaseWebsocket(channels_to_function={'ticker': tickers.append, 'error': errors.append},
+                                log_level=LogLevel.NO_LOG)
+  cbws.ws = _Frames(['not json', '{"type": "ticker", "product_id": "BTC-USD"}'])
+  asyncio.run(cbws._read_messages())
+  assert len(errors) == 1
+  assert [ticker['product_id'] for ticker in tickers] == ['BTC-USD']
@@ -0,0 +1,262 @@
+import random
+import threading
+import time
+
+import pytest
+
+from zcoinbase import CoinbaseOrderBook, CoinbaseWebsocket, Level3OrderBook, ProductOrderBook, \
+  ShardedCoinbaseWebsocket, TickProductOrderBook
+from zcoinbase import coinbase_order_book
+from zcoinbase.coinbase_order_book import _FixedPoint
+from zcoinbase.util import LogLevel
+from zcoinbase.synthetic_feed_server import SyntheticFeedServer
+
+
+def _wait_for(condition, timeout=10.0):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.05)
+  return True
+
+
+@pytest.fixture
+def feed_server():
+  # Only the server needs websockets.
+  pytest.importorskip('websockets')
+  server = SyntheticFeedServer(messages_per_second=2000, product_count=4, seed=1, log_level=LogLevel.NO_LOG)
+  server.start()
+  yield server
+  server.stop()
+
+
+def test_aggregate_levels_sums_sizes_exactly():
+  orders = [['0.00001234', '0.00001', 'a'], ['0.00001234', '0.00002', 'b'], ['0.1', '0.1', 'c'], ['0.1', '0.2', 'd']]
+  assert CoinbaseOrderBook._aggregate_levels(orders) == [['0.00001234', '0.00003'], ['0.1', '0.3']]
+
+
+def test_fixed_point_reads_exponent_strings():
+  fixed_point = _FixedPoint('0.00000001')
+  assert fixed_point.to_ticks('1.234e-05') == fixed_point.to_ticks('0.00001234') == 1234
+  assert fixed_point.to_ticks('2E-8') == 2
+  assert fixed_point.to_string(fixed_point.to_ticks('1.234e-05')) == '0.00001234'
+
+
+_BIDS = [['100.02', '1.5'], ['100.01', '2'], ['99.5', '3']]
+_ASKS = [['100.03', '0.5'], ['100.04', '1'], ['101', '4']]
+
+
+@pytest.mark.parametrize('make_book', [lambda: ProductOrderBook('BTC-USD'),
+                                       lambda: TickProductOrderBook('BTC-USD', '0.01', '0.00000001')])
+def test_reads_that_fall_back_to_the_writer_lock_read_a_copy(monkeypatch, make_book):
+  book = make_book()
+  book._init_book(_BIDS, _ASKS)
+  expected = (book.get_snapshot(2), book.get_snapshot(), book.get_bids_array(2).price.tolist())
+  # Every read takes the fallback, as if the book always changed under it.
+  monkeypatch.setattr(coinbase_order_book, '_SEQLOCK_RETRIES', 0)
+  book._snapshots = (-1, {})
+  assert (book.get_snapshot(2), book.get_snapshot(), book.get_bids_array(2).price.tolist()) == expected
+
+  def read(book_copy):
+    # The writer can change the book while the copy is read.
+    acquired = []
+
+    def write():
+      acquired.append(book._sync_lock.acquire(timeout=1.0))
+      if acquired[0]:
+        book._sync_lock.release()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    writer.join()
+    return acquired, book_copy._read_levels('buy', 1)
+
+  version, (acquired, bids) = book._read_consistent(read, 1)
+  assert version == book.version and acquired == [True]
+  assert bids == expected[0].bids[:1]
+
+
+@pytest.mark.parametrize('options', [{'min_interval_ms': 50}, {'deltas': True}, {'top_k': 1}])
+def test_update_callbacks_can_remove_themselves(options):
+  book = ProductOrderBook('BTC-USD')
+  book._init_book(_BIDS, _ASKS)
+  calls = []
+
+  def callback(order_book, changes=None):
+    calls.append(changes)
+    order_book.remove_update_callback(identifier)
+
+  identifier = book.add_update_callback(callback, **options)
+  writer = threading.Thread(target=lambda: book._consume_changes([['buy', '100.02', '2.5']]), daemon=True)
+  writer.start()
+  writer.join(timeout=5.0)
+  assert not writer.is_alive()
+  book._consume_changes([['buy', '100.02', '3.5']])
+  assert len(calls) == 1
+
+
+def test_snapshot_callbacks_and_replay_run_without_the_lock():
+  book = ProductOrderBook('BTC-USD')
+  book._invalidate(buffer_changes=True)
+  book._consume_changes([['buy', '100.02', '2']])
+  book._consume_changes([['buy', '100.02', '3']])
+  calls = []
+
+  def callback(order_book, changes=None):
+    calls.append(changes)
+    if changes == [('buy', '100.02', '2')]:
+      # Another writer, e.g. the websocket thread, isn't held up, its changes are applied after the buffered ones.
+      writer = threading.Thread(target=lambda: order_book._consume_changes([['buy', '100.02', '9']]))
+      writer.start()
+      writer.join(timeout=5.0)
+      assert not writer.is_alive()
+
+  book.add_update_callback(callback, deltas=True)
+  book._init_book(_BIDS, _ASKS)
+  assert calls == [None, [('buy', '100.02', '2')], [('buy', '100.02', '3')], [('buy', '100.02', '9')]]
+  assert book.is_valid() and book.get_bids()[0] == ('100.02', 9.0)
+
+
+@pytest.mark.parametrize('overflow', ['store', 'drop'])
+def test_capped_book_keeps_the_best_levels_of_an_uncapped_book(overflow):
+  rng = random.Random(7)
+  prices = ['{:.2f}'.format(100 + tick / 100) for tick in range(-40, 41)]
+  bids = [[price, '1'] for price in prices[:40]]
+  asks = [[price, '1'] for price in prices[41:]]
+  book = ProductOrderBook('BTC-USD')
+  capped = ProductOrderBook('BTC-USD', max_depth=5, overflow=overflow)
+  for order_book in (book, capped):
+    order_book._init_book(bids, asks)
+  for step in range(5000):
+    side = rng.choice(['buy', 'sell'])
+    price = rng.choice(prices[:40] if side == 'buy' else prices[41:])
+    # Mostly removals near the top, so the capped levels empty out and have to be refilled.
+    size = '0' if rng.random() < 0.6 else '{}'.format(rng.randint(1, 9))
+    for order_book in (book, capped):
+      order_book._consume_changes([[side, price, size]])
+    for full_side, capped_side in ((book.get_bids(), capped.get_bids()), (book.get_asks(), capped.get_asks())):
+      if overflow == 'store':
+        assert capped_side == full_side[:5], step
+      else:
+        assert len(capped_side) <= 5 and capped_side == full_side[:len(capped_side)], step
+    if step % 1000 == 999:
+      # A snapshot lets the dropped levels back in.
+      snapshot = book.get_book()
+      capped._init_book(snapshot['bids'], snapshot['asks'])
+      assert capped.get_bids() == book.get_bids()[:5] and capped.get_asks() == book.get_asks()[:5]
+
+
+def test_stored_levels_refill_the_capped_side_with_their_latest_size():
+  book = ProductOrderBook('BTC-USD', max_depth=2)
+  book._init_book(_BIDS, _ASKS)
+  assert book.get_bids() == (('100.02', 1.5), ('100.01', 2.0))
+  book._consume_changes([['buy', '99.5', '7'], ['buy', '99.4', '1']])
+  book._consume_changes([['buy', '100.02', '0']])
+  assert book.get_bids() == (('100.01', 2.0), ('99.5', 7.0))
+  # A better level pushes the worst kept level back into the stored ones.
+  book._consume_changes([['buy', '100.05', '1']])
+  assert book.get_bids() == (('100.05', 1.0), ('100.01', 2.0))
+  assert book._overflow_levels['buy'] == {'99.5': 7.0, '99.4': 1.0}
+  for _ in range(1000):
+    book._consume_changes([['buy', '98.00', '1'], ['buy', '98.00', '0']])
+  assert len(book._overflow_heaps['buy']) <= 2 * len(book._overflow_levels['buy']) + 65
+
+
+def test_dropped_levels_keep_worse_levels_out_until_a_snapshot():
+  book = ProductOrderBook('BTC-USD', max_depth=2, overflow='drop')
+  book._init_book(_BIDS, _ASKS)
+  # 99.5 was dropped, so 99.4 can't be kept even once there's room: 99.5 would be missing between them.
+  book._consume_changes([['buy', '100.02', '0'], ['buy', '99.4', '1']])
+  assert book.get_bids() == (('100.01', 2.0),)
+  book._consume_changes([['buy', '99.9', '1']])
+  assert book.get_bids() == (('100.01', 2.0), ('99.9', 1.0))
+  book._consume_changes([['buy', '100.03', '0.5']])
+  assert book.get_bids() == (('100.03', 0.5), ('100.01', 2.0))
+  assert book._overflow_levels == {'buy': {}, 'sell': {}}
+  book._init_book([['100.00', '1'], ['99.9', '1']], _ASKS)
+  assert book.get_bids() == (('100.00', 1.0), ('99.9', 1.0))
+  book._consume_changes([['buy', '100.00', '0'], ['buy', '99.8', '1']])
+  assert book.get_bids() == (('99.9', 1.0), ('99.8', 1.0))
+
+
+def test_max_depth_and_overflow_are_checked():
+  with pytest.raises(ValueError):
+    ProductOrderBook('BTC-USD', max_depth=0)
+  with pytest.raises(ValueError):
+    ProductOrderBook('BTC-USD', max_depth=5, overflow='spill')
+
+
+def _open(sequence):
+  return {'type': 'open', 'sequence': sequence, 'order_id': 'order-{}'.format(sequence), 'side': 'buy',
+          'price': '100.00', 'remaining_size': '1.0'}
+
+
+def test_level3_snapshot_needs_buffered_messages_without_gaps():
+  book = Level3OrderBook('BTC-USD')
+  for sequence in (11, 12, 12, 14, 15):
+    book._consume_message(_open(sequence))
+
+  def snapshot(sequence):
+    return {'sequence': sequence, 'bids': [['99.00', '2.0', 'resting']], 'asks': []}
+
+  # 13 is missing after the snapshot, and an older snapshot doesn't help.
+  assert not book._load_snapshot(snapshot(10))
+  assert not book._load_snapshot(snapshot(12))
+  assert not book.is_synced()
+  assert book._load_snapshot(snapshot(13))
+  assert book.is_synced() and book.sequence == 15
+  assert [order_id for order_id, _ in book.get_level('buy', 100.0)] == ['order-14', 'order-15']
+
+
+def _gap(product_id, out_of_order=False):
+  return {'type': 'sequence_gap', 'channel': 'full', 'product_id': product_id, 'last_sequence': 10, 'sequence': 12,
+          'out_of_order': out_of_order}
+
+
+def test_sequence_gaps_resync_once_until_the_snapshot_arrives():
+  cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], autostart=False, log_level=LogLevel.NO_LOG)
+  order_book = CoinbaseOrderBook(cb_ws, snapshot_loaders=0)
+  book = order_book.get_order_book('BTC-USD')
+  order_book._initial_snapshot('BTC-USD', [['100.0', '1.0']], [['101.0', '1.0']])
+  order_book._on_sequence_gap(_gap('BTC-USD', out_of_order=True))
+  order_book._on_sequence_gap(dict(_gap('BTC-USD'), channel='matches'))
+  assert book.resyncs == 0 and book.is_valid()
+  for _ in range(3):
+    order_book._on_sequence_gap(_gap('BTC-USD'))
+  assert book.resyncs == 1 and not book.is_valid()
+  order_book._initial_snapshot('BTC-USD', [['100.0', '1.0']], [['101.0', '1.0']])
+  order_book._on_sequence_gap(_gap('BTC-USD'))
+  assert book.resyncs == 2
+
+
+def test_closed_connections_invalidate_their_books():
+  cb_ws = ShardedCoinbaseWebsocket(products_to_listen=['BTC-USD', 'ETH-USD'], shards=2, autostart=False,
+                                   log_level=LogLevel.NO_LOG)
+  order_book = CoinbaseOrderBook(cb_ws, snapshot_loaders=0)
+  books = [order_book.get_order_book(product_id) for product_id in ('BTC-USD', 'ETH-USD')]
+  for book in books:
+    order_book._initial_snapshot(book.product_id, [['100.0', '1.0']], [['101.0', '1.0']])
+  # What the shard's WebSocketApp calls after the connection drops or fails.
+  cb_ws.shards[1].on_close(cb_ws.shards[1].ws)
+  assert [book.is_valid() for book in books] == [True, False]
+  cb_ws.shards[0].on_close(cb_ws.shards[0].ws)
+  assert not any(book.is_valid() for book in books)
+
+
+def test_staggered_shard_open_only_invalidates_its_own_books(feed_server):
+  cb_ws = ShardedCoinbaseWebsocket(websocket_addr=feed_server.address, products_to_listen=feed_server.product_ids,
+                                   shards=2, autostart=False, log_level=LogLevel.NO_LOG)
+  order_book = CoinbaseOrderBook(cb_ws)
+  books = [order_book.get_order_book(product_id) for product_id in feed_server.product_ids]
+  try:
+    # Products are spread round-robin, so the first shard owns the even ones.
+    cb_ws.shards[0].start_websocket_in_thread()
+    assert _wait_for(lambda: [book.is_valid() for book in books] == [True, False, True, False])
+    cb_ws.shards[1].start_websocket_in_thread()
+    assert _wait_for(lambda: all(book.is_valid() for book in books))
+    # The second shard opening again only makes its own books wait for new snapshots.
+    order_book._on_open_websocket(cb_ws.shards[1].ws)
+    assert [book.is_valid() for book in books] == [True, False, True, False]
+  finally:
+    cb_ws.close_websocket()
@@ -0,0 +1,87 @@
+import json
+import os
+
+from zcoinbase import CoinbaseWebsocket, FeedRecorder, FeedReplayer
+from zcoinbase.feed_recorder import INDEX_SUFFIX, LOG_SUFFIX
+from zcoinbase.util import FrameType, LogLevel
+
+# One frame a microsecond, from an arbitrary start time.
+_START_NS = 1_600_000_000_000_000_000
+
+
+def _frame(sequence):
+  return json.dumps({'type': 'received', 'product_id': 'BTC-USD', 'sequence': sequence})
+
+
+def _record(directory, count, **recorder_kwargs):
+  # Chunks are only cut by size, not by a slow test.
+  recorder_kwargs.setdefault('flush_interval', 60.0)
+  with FeedRecorder(directory, **recorder_kwargs) as recorder:
+    for sequence in range(count):
+      recorder.record(_frame(sequence), timestamp_ns=_START_NS + sequence * 1000)
+  return recorder
+
+
+def _sequences(frames):
+  return [json.loads(frame)['sequence'] for _, frame in frames]
+
+
+def test_replayed_frames_match_the_recording(tmp_path):
+  directory = str(tmp_path)
+  recorder = _record(directory, 1000, chunk_frames=64)
+  assert recorder.frames_recorded == 1000 and recorder.chunks_written == 16
+  replayer = FeedReplayer(directory)
+  frames = list(replayer.frames())
+  assert [timestamp_ns for timestamp_ns, _ in frames] == [_START_NS + sequence * 1000 for sequence in range(1000)]
+  assert [frame for _, frame in frames] == [_frame(sequence) for sequence in range(1000)]
+  views = [frame for _, frame in replayer.frames(frame_type=FrameType.MEMORYVIEW)]
+  assert all(isinstance(view, memoryview) for view in views)
+  assert [json.loads(bytes(view))['sequence'] for view in views] == list(range(1000))
+
+
+def test_frames_seek_by_time_and_sequence(tmp_path):
+  directory = str(tmp_path)
+  _record(directory, 1000, chunk_frames=64)
+  replayer = FeedReplayer(directory)
+  assert _sequences(replayer.frames(start_time_ns=_START_NS + 500 * 1000, end_time_ns=_START_NS + 509 * 1000)) == \
+    list(range(500, 510))
+  assert _sequences(replayer.frames(start_sequence=700, product_id='BTC-USD'))[:3] == [700, 701, 702]
+  assert list(replayer.frames(start_sequence=700, product_id='ETH-USD')) == []
+
+
+def test_missing_index_is_rebuilt_from_the_log(tmp_path):
+  directory = str(tmp_path)
+  _record(directory, 300, chunk_frames=64)
+  replayer = FeedReplayer(directory)
+  log_file_name, = replayer.log_files()
+  index = FeedReplayer._read_index(log_file_name)
+  os.remove(log_file_name[:-len(LOG_SUFFIX)] + INDEX_SUFFIX)
+  assert FeedReplayer._rebuild_index(log_file_name) == index
+  assert _sequences(replayer.frames(start_sequence=250)) == list(range(250, 300))
+
+
+def test_log_files_rotate_and_old_ones_can_be_deleted(tmp_path):
+  directory = str(tmp_path)
+  _record(directory, 1000, chunk_frames=10, max_file_bytes=1)
+  replayer = FeedReplayer(directory)
+  # Every chunk after the first goes to a new file.
+  assert len(replayer.log_files()) == 100
+  assert _sequences(replayer.frames()) == list(range(1000))
+  recorder = FeedRecorder(directory)
+  recorder.delete_before(_START_NS + 500 * 1000)
+  recorder.close()
+  assert len(replayer.log_files()) == 50
+  assert _sequences(replayer.frames()) == list(range(500, 1000))
+
+
+def test_attached_recording_replays_into_functions(tmp_path):
+  directory = str(tmp_path)
+  cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], autostart=False, log_level=LogLevel.NO_LOG)
+  with FeedRecorder(directory) as recorder:
+    recorder.attach(cb_ws)
+    for sequence in range(5):
+      cb_ws.on_message(None, _frame(sequence))
+  assert cb_ws._raw_message_functions == ()
+  received = []
+  assert FeedReplayer(directory).replay({'received': received.append}) == 5
+  assert [message['sequence'] for message in received] == list(range(5))
@@ -0,0 +1,73 @@
+import json
+import random
+
+import pytest
+
+from zcoinbase import CoinbaseWebsocket
+from zcoinbase.latency import EXCHANGE_TO_RECEIVE, HANDLER, RECEIVE_TO_DISPATCH, LatencyHistogram, LatencyTracker, \
+  parse_exchange_time
+from zcoinbase.util import LogLevel
+
+
+def test_histogram_percentiles_are_within_the_bucket_precision():
+  rng = random.Random(3)
+  values = sorted(int(rng.lognormvariate(12, 2)) for _ in range(20000))
+  histogram = LatencyHistogram()
+  for value in values:
+    histogram.record(value)
+  for percentile in (50.0, 90.0, 99.0, 99.9):
+    exact = values[int(round(len(values) * percentile / 100.0)) - 1]
+    assert exact <= histogram.percentile(percentile) <= exact * 1.04, percentile
+  assert (histogram.min, histogram.max, histogram.count) == (values[0], values[-1], len(values))
+  assert histogram.percentile(100.0) == values[-1]
+
+
+def test_histogram_counts_small_values_exactly_and_clamps_the_rest():
+  histogram = LatencyHistogram()
+  for value in (-5, 0, 1, 63):
+    histogram.record(value)
+  assert [histogram.percentile(percentile) for percentile in (25.0, 50.0, 75.0, 100.0)] == [0, 0, 1, 63]
+  # Values beyond the largest tracked value are counted in the last bucket, only max keeps them.
+  histogram.record(1 << 50)
+  assert histogram.percentile(100.0) == (1 << 40) - 1 and histogram.max == 1 << 50
+  assert LatencyHistogram().to_dict()['p50'] is None
+
+
+def test_merged_histograms_match_one_histogram():
+  merged, first, second, single = LatencyHistogram(), LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+  for value in range(0, 100000, 7):
+    (first if value % 2 else second).record(value)
+    single.record(value)
+  merged.merge(first)
+  merged.merge(second)
+  assert merged.to_dict() == single.to_dict()
+
+
+def test_tracker_merges_over_unspecified_keys():
+  tracker = LatencyTracker()
+  tracker.record(HANDLER, 'ticker', 'BTC-USD', 100, handler='a')
+  tracker.record(HANDLER, 'ticker', 'ETH-USD', 200, handler='b')
+  tracker.record(HANDLER, 'l2update', 'BTC-USD', 300, handler='a')
+  assert tracker.get_histogram(HANDLER).count == 3
+  assert tracker.get_histogram(HANDLER, channel='ticker').count == 2
+  assert tracker.get_histogram(HANDLER, product_id='BTC-USD', handler='a').total == 400
+  assert LatencyTracker(per_product=False).get_histogram(HANDLER, product_id='BTC-USD').count == 0
+  assert len(tracker.get_stats()) == 3
+
+
+def test_parse_exchange_time():
+  assert parse_exchange_time('1970-01-01T00:00:01.000002Z') == 1000002000
+  with pytest.raises(ValueError):
+    parse_exchange_time('yesterday')
+
+
+def test_websocket_records_every_stage():
+  handled = []
+  cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], channels_to_function={'ticker': handled.append},
+                            track_latency=True, autostart=False, log_level=LogLevel.NO_LOG)
+  cb_ws.on_message(None, json.dumps({'type': 'ticker', 'product_id': 'BTC-USD', 'time': '2020-01-01T00:00:00Z'}))
+  cb_ws.on_message(None, json.dumps({'type': 'ticker', 'product_id': 'BTC-USD', 'time': 'not a time'}))
+  assert len(handled) == 2
+  assert cb_ws.latency.get_histogram(EXCHANGE_TO_RECEIVE, 'ticker', 'BTC-USD').count == 1
+  assert cb_ws.latency.get_histogram(RECEIVE_TO_DISPATCH, 'ticker', 'BTC-USD').count == 2
+  assert cb_ws.latency.get_histogram(HANDLER, 'ticker', 'BTC-USD').count == 2
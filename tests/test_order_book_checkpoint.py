@@ -0,0 +1,46 @@
+from zcoinbase import CoinbaseOrderBook, CoinbaseWebsocket, OrderBookCheckpointer, TickProductOrderBook
+from zcoinbase.order_book_checkpoint import read_checkpoint
+from zcoinbase.util import LogLevel
+
+
+def _make_order_book():
+  cb_ws = CoinbaseWebsocket(products_to_listen=['SHIB-USD', 'BTC-USD'], autostart=False, log_level=LogLevel.NO_LOG)
+  return CoinbaseOrderBook(cb_ws, snapshot_loaders=0,
+                           order_book_factory=lambda product_id: TickProductOrderBook(product_id, '0.00000001',
+                                                                                      '0.00000001'))
+
+
+def test_checkpoint_round_trips_small_tick_prices(tmp_path):
+  path = str(tmp_path / 'books.zcbk')
+  order_book = _make_order_book()
+  order_book._initial_snapshot('SHIB-USD', [['0.00001234', '1500.5'], ['0.00001233', '20']],
+                               [['0.00001235', '300']])
+  order_book._initial_snapshot('BTC-USD', [['30000.01', '0.5']], [['30000.02', '0.25']])
+  assert OrderBookCheckpointer(order_book, path).checkpoint() == 2
+  _, books = read_checkpoint(path)
+  bids, asks = books['SHIB-USD']
+  assert [price for price, _ in bids + asks] == ['0.00001234', '0.00001233', '0.00001235']
+
+  restored_order_book = _make_order_book()
+  assert sorted(OrderBookCheckpointer(restored_order_book, path).restore()) == ['BTC-USD', 'SHIB-USD']
+  for product_id in ('SHIB-USD', 'BTC-USD'):
+    book = restored_order_book.get_order_book(product_id)
+    assert book.restored
+    assert book.get_book() == order_book.get_order_book(product_id).get_book()
+
+
+def test_restore_skips_books_that_fail_to_load(tmp_path):
+  path = str(tmp_path / 'books.zcbk')
+  order_book = _make_order_book()
+  order_book._initial_snapshot('SHIB-USD', [['0.00001234', '1500.5']], [['0.00001235', '300']])
+  order_book._initial_snapshot('BTC-USD', [['30000.01', '0.5']], [['30000.02', '0.25']])
+  OrderBookCheckpointer(order_book, path).checkpoint()
+
+  restored_order_book = _make_order_book()
+
+  def fail_to_restore(bids, asks, journal=()):
+    raise ValueError('Bad checkpoint')
+
+  restored_order_book.get_order_book('SHIB-USD')._restore = fail_to_restore
+  assert OrderBookCheckpointer(restored_order_book, path).restore() == ['BTC-USD']
+  assert restored_order_book.get_order_book('BTC-USD').restored
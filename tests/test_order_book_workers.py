@@ -0,0 +1,96 @@
+import json
+import random
+import threading
+import time
+
+import pytest
+
+from zcoinbase import CoinbaseOrderBook, CoinbaseWebsocket
+from zcoinbase.util import LogLevel
+
+_PRODUCT_IDS = ['BTC-USD', 'ETH-USD', 'SOL-USD']
+
+
+def _wait_for(condition, timeout=10.0):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.02)
+  return True
+
+
+def _messages(seed=5):
+  """Snapshots for every product, followed by interleaved l2updates that never cross the books."""
+  rng = random.Random(seed)
+  messages = [{'type': 'snapshot', 'product_id': product_id, 'bids': [['99.00', '1']], 'asks': [['101.00', '1']]}
+              for product_id in _PRODUCT_IDS]
+  for _ in range(600):
+    side = rng.choice(['buy', 'sell'])
+    price = '{:.2f}'.format((rng.randint(9000, 9999) if side == 'buy' else rng.randint(10001, 11000)) / 100)
+    size = '0' if rng.random() < 0.3 else str(rng.randint(1, 5))
+    messages.append({'type': 'l2update', 'product_id': rng.choice(_PRODUCT_IDS), 'changes': [[side, price, size]]})
+  return messages
+
+
+def _make_order_book(**order_book_kwargs):
+  cb_ws = CoinbaseWebsocket(products_to_listen=list(_PRODUCT_IDS), autostart=False, log_level=LogLevel.NO_LOG)
+  return cb_ws, CoinbaseOrderBook(cb_ws, **order_book_kwargs)
+
+
+def _feed(cb_ws, messages):
+  for message in messages:
+    cb_ws.on_message(None, json.dumps(message))
+
+
+@pytest.mark.parametrize('mode', ['threads', 'processes'])
+def test_workers_build_the_same_books(mode):
+  messages = _messages()
+  reference_ws, reference = _make_order_book(snapshot_loaders=0)
+  _feed(reference_ws, messages)
+  cb_ws, order_book = _make_order_book(workers=2, mode=mode)
+  calls = []
+  called = threading.Event()
+
+  def callback(book, changes):
+    calls.append((book.product_id, changes))
+    called.set()
+
+  order_book.add_callback('ETH-USD', callback, deltas=True)
+  try:
+    _feed(cb_ws, messages)
+    if mode == 'threads':
+      # Closing runs everything the workers were sent.
+      order_book.close()
+    for product_id in _PRODUCT_IDS:
+      book = order_book.get_order_book(product_id)
+      assert book.is_valid(), product_id
+      assert book.get_book() == reference.get_order_book(product_id).get_book(), product_id
+    expected_rows = reference.get_top_of_book_matrix().tolist()
+    assert _wait_for(lambda: order_book.get_top_of_book_matrix().tolist() == expected_rows)
+    assert called.wait(timeout=5.0)
+    assert calls[0] == ('ETH-USD', None)
+  finally:
+    if mode == 'processes':
+      order_book.close()
+
+
+def test_worker_process_reports_crossed_books():
+  cb_ws, order_book = _make_order_book(workers=1, mode='processes')
+  try:
+    _feed(cb_ws, _messages()[:len(_PRODUCT_IDS)])
+    book = order_book.get_order_book('BTC-USD')
+    _feed(cb_ws, [{'type': 'l2update', 'product_id': 'BTC-USD', 'changes': [['buy', '102.00', '1']]}])
+    assert _wait_for(lambda: book.resyncs == 1)
+    assert not book.is_valid()
+    assert order_book.get_order_book('ETH-USD').is_valid()
+  finally:
+    order_book.close()
+
+
+def test_workers_must_be_positive_and_mode_known():
+  cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], autostart=False, log_level=LogLevel.NO_LOG)
+  with pytest.raises(ValueError):
+    CoinbaseOrderBook(cb_ws, workers=0)
+  with pytest.raises(ValueError):
+    CoinbaseOrderBook(cb_ws, workers=2, mode='fibers')
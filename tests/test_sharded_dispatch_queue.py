@@ -0,0 +1,99 @@
+import threading
+
+from zcoinbase import CoinbaseWebsocket, ShardedCoinbaseWebsocket
+from zcoinbase.internal import ShardedDispatchQueue
+from zcoinbase.util import BackpressurePolicy, LogLevel
+
+
+def _blocked_queue(backpressure, max_queue_size=2):
+  """Returns a queue with one worker that is stuck on its first entry until the returned event is set."""
+  queue = ShardedDispatchQueue(num_workers=1, max_queue_size=max_queue_size, backpressure=backpressure)
+  release = threading.Event()
+  started = threading.Event()
+
+  def block():
+    started.set()
+    release.wait()
+
+  queue.submit('BTC-USD', block, ())
+  assert started.wait(timeout=5.0)
+  return queue, release
+
+
+def test_block_runs_everything_in_order_and_close_drains():
+  queue = ShardedDispatchQueue(num_workers=2, max_queue_size=3)
+  processed = {'BTC-USD': [], 'ETH-USD': []}
+  for index in range(200):
+    for product_id in processed:
+      assert queue.submit(product_id, processed[product_id].append, (index,))
+  queue.close_and_join()
+  assert processed == {'BTC-USD': list(range(200)), 'ETH-USD': list(range(200))}
+  stats = queue.get_stats()
+  assert stats['submitted'] == stats['processed'] == 400 and stats['dropped'] == 0
+  assert stats['max_queue_depth'] <= 3
+  assert not queue.submit('BTC-USD', processed['BTC-USD'].append, (200,))
+  assert queue.get_stats()['submitted'] == 400
+
+
+def test_drop_oldest_drops_queued_entries():
+  queue, release = _blocked_queue(BackpressurePolicy.DROP_OLDEST)
+  processed = []
+  for index in range(4):
+    assert queue.submit('BTC-USD', processed.append, (index,))
+  release.set()
+  queue.close_and_join()
+  assert processed == [2, 3]
+  stats = queue.get_stats()
+  assert (stats['submitted'], stats['processed'], stats['dropped']) == (5, 3, 2)
+
+
+def test_conflate_replaces_the_queued_entry_with_the_same_key():
+  queue, release = _blocked_queue(BackpressurePolicy.CONFLATE)
+  processed = []
+  assert queue.submit('BTC-USD', processed.append, ('x1',), conflation_key='x')
+  assert queue.submit('BTC-USD', processed.append, ('y1',), conflation_key='y')
+  assert queue.submit('BTC-USD', processed.append, ('x2',), conflation_key='x')
+  # There's no queued 'z', so the oldest entry makes room.
+  assert queue.submit('BTC-USD', processed.append, ('z1',), conflation_key='z')
+  release.set()
+  queue.close_and_join()
+  assert processed == ['y1', 'z1']
+  stats = queue.get_stats()
+  assert (stats['submitted'], stats['conflated'], stats['dropped'], stats['processed']) == (4, 1, 1, 3)
+
+
+def test_close_without_draining_drops_queued_entries():
+  queue, release = _blocked_queue(BackpressurePolicy.DROP_OLDEST)
+  processed = []
+  for index in range(2):
+    queue.submit('BTC-USD', processed.append, (index,))
+  release.set()
+  queue.close_and_join(drain=False)
+  assert processed == []
+  assert queue.get_stats()['dropped'] == 2
+
+
+def test_a_worker_can_close_its_own_queue():
+  queue = ShardedDispatchQueue(num_workers=1)
+  closed = threading.Event()
+
+  def close():
+    queue.close_and_join()
+    closed.set()
+
+  queue.submit('BTC-USD', close, ())
+  assert closed.wait(timeout=5.0)
+
+
+def test_close_websocket_stops_the_worker_threads():
+  cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], worker_threads=2, autostart=False,
+                            log_level=LogLevel.NO_LOG)
+  threads = [shard.thread for shard in cb_ws._dispatch_queue._shards]
+  cb_ws.close_websocket()
+  assert not any(thread.is_alive() for thread in threads)
+
+  sharded = ShardedCoinbaseWebsocket(products_to_listen=['BTC-USD', 'ETH-USD'], shards=2,
+                                     worker_threads=1, autostart=False, log_level=LogLevel.NO_LOG)
+  threads = [shard._dispatch_queue._shards[0].thread for shard in sharded.shards]
+  sharded.close_websocket()
+  assert not any(thread.is_alive() for thread in threads)
@@ -0,0 +1,83 @@
+import json
+import threading
+
+from zcoinbase import CoinbaseLevel3OrderBook, ShardedCoinbaseWebsocket
+from zcoinbase.util import FrameType, LogLevel
+
+
+def _message(product_id, sequence):
+  return {'type': 'received', 'product_id': product_id, 'sequence': sequence}
+
+
+def test_functions_can_add_products_while_a_product_is_moving():
+  received = []
+  cb_ws = None
+
+  def on_received(message):
+    received.append(message['sequence'])
+    cb_ws.add_product('SOL-USD', refresh_subscriptions=False)
+
+  cb_ws = ShardedCoinbaseWebsocket(products_to_listen=['BTC-USD', 'ETH-USD'], channels_to_function={
+    'received': on_received}, shards=2, autostart=False, log_level=LogLevel.NO_LOG)
+  cb_ws.move_product('BTC-USD', 1)
+
+  def deliver():
+    cb_ws._on_shard_message(0, _message('BTC-USD', 1))
+    cb_ws._on_shard_message(1, _message('BTC-USD', 2))
+
+  delivery = threading.Thread(target=deliver, daemon=True)
+  delivery.start()
+  delivery.join(timeout=5.0)
+  assert not delivery.is_alive()
+  assert received == [1, 2]
+  assert cb_ws._owners['BTC-USD'] == 1 and 'SOL-USD' in cb_ws.products_to_listen
+
+
+def test_moving_product_waits_for_full_sequences_after_a_snapshot():
+  delivered = []
+  cb_ws = ShardedCoinbaseWebsocket(products_to_listen=['BTC-USD', 'ETH-USD'], channels_to_function={
+    'received': lambda message: delivered.append(message['sequence']),
+    'snapshot': lambda message: delivered.append('snapshot')}, extra_channels=['full', 'level2'], shards=2,
+                                   autostart=False, log_level=LogLevel.NO_LOG)
+  cb_ws.move_product('BTC-USD', 1)
+  cb_ws._on_shard_message(0, _message('BTC-USD', 99))
+  # The new shard's level2 snapshot and full messages arrive before the old shard's last ones.
+  cb_ws._on_shard_message(1, {'type': 'snapshot', 'product_id': 'BTC-USD', 'bids': [], 'asks': []})
+  cb_ws._on_shard_message(1, _message('BTC-USD', 101))
+  cb_ws._on_shard_message(1, _message('BTC-USD', 102))
+  assert 'BTC-USD' in cb_ws._handovers
+  cb_ws._on_shard_message(0, _message('BTC-USD', 100))
+  cb_ws._on_shard_message(0, _message('BTC-USD', 101))
+  cb_ws._on_shard_message(1, _message('BTC-USD', 103))
+  assert delivered == [99, 100, 'snapshot', 101, 102, 103]
+  assert cb_ws._owners['BTC-USD'] == 1 and 'BTC-USD' not in cb_ws._handovers
+
+
+def test_message_counts_from_every_shard_are_kept():
+  cb_ws = ShardedCoinbaseWebsocket(products_to_listen=['BTC-USD', 'ETH-USD'], shards=2, autostart=False,
+                                   log_level=LogLevel.NO_LOG)
+
+  def receive(shard_index):
+    for sequence in range(20000):
+      cb_ws._on_shard_message(shard_index, _message('BTC-USD', sequence))
+
+  shards = [threading.Thread(target=receive, args=(shard_index,)) for shard_index in range(2)]
+  for shard in shards:
+    shard.start()
+  for shard in shards:
+    shard.join()
+  stats = cb_ws.get_shard_stats()
+  assert stats['shards'][0]['products'] == ['BTC-USD']
+  assert sum(counts['BTC-USD'] for counts in cb_ws._message_counts) == 40000
+
+
+def test_can_be_used_like_a_single_websocket():
+  received = []
+  cb_ws = ShardedCoinbaseWebsocket(products_to_listen=['BTC-USD', 'ETH-USD'], channels_to_function={
+    'received': received.append}, shards=2, autostart=False, frame_type=FrameType.BYTES, log_level=LogLevel.NO_LOG)
+  assert cb_ws.frame_type == FrameType.BYTES
+  assert not cb_ws.ws_opened.is_set()
+  CoinbaseLevel3OrderBook(cb_ws)
+  # How FeedReplayer.replay passes frames on.
+  cb_ws.on_message(None, json.dumps(_message('ETH-USD', 7)).encode())
+  assert [message['product_id'] for message in received] == ['ETH-USD']
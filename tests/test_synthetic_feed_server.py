@@ -0,0 +1,36 @@
+import json
+
+import pytest
+import websocket
+
+from zcoinbase.util import LogLevel
+
+pytest.importorskip('websockets')
+from zcoinbase.synthetic_feed_server import SyntheticFeedServer
+
+
+def test_start_raises_when_the_server_cannot_listen():
+  server = SyntheticFeedServer(product_count=1, log_level=LogLevel.NO_LOG)
+  server.start()
+  try:
+    taken = SyntheticFeedServer(port=server.port, product_count=1, log_level=LogLevel.NO_LOG)
+    with pytest.raises(OSError):
+      taken.start()
+    taken.stop()
+  finally:
+    server.stop()
+
+
+def test_subscriptions_ack_comes_before_the_snapshots():
+  server = SyntheticFeedServer(messages_per_second=100, product_count=2, log_level=LogLevel.NO_LOG)
+  server.start()
+  try:
+    connection = websocket.create_connection(server.address, timeout=5.0)
+    try:
+      connection.send(json.dumps({'type': 'subscribe', 'product_ids': server.product_ids, 'channels': ['level2']}))
+      message_types = [json.loads(connection.recv())['type'] for _ in range(3)]
+    finally:
+      connection.close()
+  finally:
+    server.stop()
+  assert message_types == ['subscriptions', 'snapshot', 'snapshot']
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from zcoinbase import ProductOrderBook, TickProductOrderBook
+from zcoinbase.coinbase_order_book import _FixedPoint
+
+
+def _as_floats(levels):
+  return [(float(price), size) for price, size in levels]
+
+
+def test_fixed_point_converts_both_ways():
+  price_point = _FixedPoint('0.05')
+  assert price_point.to_ticks('100.15') == price_point.to_ticks(100.15) == 2003
+  assert price_point.to_string(2003) == '100.15'
+  assert price_point.from_ticks(2003) == pytest.approx(100.15)
+  assert _FixedPoint('1').to_string(42) == '42'
+  assert _FixedPoint('0.001').to_ticks('7') == 7000
+  with pytest.raises(ValueError):
+    _FixedPoint('0.00')
+
+
+def test_tick_book_matches_a_float_book():
+  rng = random.Random(11)
+  prices = ['{:.2f}'.format(100 + tick / 100) for tick in range(-30, 31)]
+  book = ProductOrderBook('BTC-USD')
+  tick_book = TickProductOrderBook('BTC-USD', '0.01', '0.00000001')
+  bids = [[price, '1.5'] for price in prices[:30:2]]
+  asks = [[price, '0.25'] for price in prices[31::2]]
+  for order_book in (book, tick_book):
+    order_book._init_book(bids, asks)
+  for step in range(3000):
+    side = rng.choice(['buy', 'sell'])
+    price = rng.choice(prices[:30] if side == 'buy' else prices[31:])
+    size = '0' if rng.random() < 0.4 else '{:.8f}'.format(rng.randint(1, 10 ** 9) / 10 ** 8)
+    for order_book in (book, tick_book):
+      order_book._consume_changes([[side, price, size]])
+    if step % 100 == 0:
+      assert _as_floats(tick_book.get_bids()) == _as_floats(book.get_bids()), step
+      assert _as_floats(tick_book.get_asks(5)) == _as_floats(book.get_asks(5)), step
+  assert tick_book.get_top_of_book()[:4] == book.get_top_of_book()[:4]
+  assert tick_book.get_bids_array(5).price.tolist() == pytest.approx(book.get_bids_array(5).price.tolist())
+  assert tick_book.get_asks_array(5).size.tolist() == pytest.approx(book.get_asks_array(5).size.tolist())
+
+
+def test_ticks_and_strings_are_exact():
+  book = TickProductOrderBook('SHIB-USD', '0.00000001', '1')
+  book._init_book([['0.00001233', '20'], ['0.00001234', '1500']], [['0.00001235', '300']])
+  book._consume_changes([['buy', '0.00001234', '1501'], ['sell', '1.236e-05', '7'], ['buy', '0.00001233', '0']])
+  assert book.get_bids_ticks() == [(1234, 1501)]
+  assert book.get_asks_ticks() == [(1235, 300), (1236, 7)]
+  assert [book.price_string(price) for price, _ in book.get_asks_ticks()] == ['0.00001235', '0.00001236']
+  assert book.size_string(1501) == '1501'
+  assert 'PRICE: 0.00001234, SIZE: 1501' in book.top_n_string()
@@ -0,0 +1,48 @@
+import json
+
+from zcoinbase import CoinbaseWebsocket
+
+
+def _make_websocket(channels, gaps):
+  channels_to_function = {channel: lambda message: None for channel in channels}
+  channels_to_function['sequence_gap'] = gaps.append
+  cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], channels_to_function=channels_to_function,
+                            autostart=False, detect_sequence_gaps=True)
+  # What on_open does once the connection subscribed.
+  with cb_ws._subscription_lock:
+    cb_ws._set_active_subscriptions(cb_ws._get_wanted_subscriptions())
+  return cb_ws
+
+
+def _send(cb_ws, message_type, sequence):
+  cb_ws.on_message(None, json.dumps({'type': message_type, 'product_id': 'BTC-USD', 'sequence': sequence}))
+
+
+def test_matches_subscription_never_reports_sequence_gaps():
+  gaps = []
+  cb_ws = _make_websocket(['matches'], gaps)
+  for sequence in (100, 105, 111):
+    _send(cb_ws, 'match', sequence)
+  assert gaps == []
+  assert cb_ws.get_connection_stats()['sequence_gaps'] == 0
+
+
+def test_full_subscription_reports_sequence_gaps():
+  gaps = []
+  cb_ws = _make_websocket(['full'], gaps)
+  for sequence in (100, 101, 105):
+    _send(cb_ws, 'received', sequence)
+  assert len(gaps) == 1
+  assert (gaps[0]['last_sequence'], gaps[0]['sequence'], gaps[0]['out_of_order']) == (101, 105, False)
+
+
+def test_close_websocket_stops_conflated_functions():
+  tickers = []
+  cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], conflated_channels=['ticker'], autostart=False)
+  cb_ws.add_conflated_function('ticker', tickers.append, interval=0.01)
+  threads = [listener.thread for listener in cb_ws.latest_values._listeners]
+  cb_ws.close_websocket()
+  assert not any(thread.is_alive() for thread in threads)
+  cb_ws.on_message(None, json.dumps({'type': 'ticker', 'product_id': 'BTC-USD', 'price': '100.00'}))
+  assert cb_ws.get_latest('ticker', 'BTC-USD')['price'] == '100.00'
+  assert cb_ws.latest_values.get_stats()['listeners'] == 0
@@ -1,8 +1,13 @@
 import zcoinbase.internal as internal
 from zcoinbase.websocket_client import CoinbaseWebsocket
+from zcoinbase.async_websocket_client import AsyncCoinbaseWebsocket
+from zcoinbase.sharded_websocket_client import ShardedCoinbaseWebsocket
 from zcoinbase.util import OrderSide, TimeInForce, SelfTradePrevention, Stop, OrderStatus, TransferType, ReportType, \
-  ReportFormat, LogLevel
+  ReportFormat, LogLevel, BackpressurePolicy, FrameType
 from zcoinbase.public_client import PublicClient
 from zcoinbase.authenticated_client import AuthenticatedClient
-from zcoinbase.coinbase_order_book import CoinbaseOrderBook, ProductOrderBook
+from zcoinbase.coinbase_order_book import CoinbaseOrderBook, ProductOrderBook, TickProductOrderBook, \
+  CoinbaseLevel3OrderBook, Level3OrderBook
 from zcoinbase.historical_data_downloader import HistoricalDownloader
+from zcoinbase.feed_recorder import FeedRecorder, FeedReplayer
+from zcoinbase.order_book_checkpoint import OrderBookCheckpointer
@@ -0,0 +1,282 @@
+import asyncio
+import importlib.util
+import logging
+
+from functools import partial
+from typing import Text, Callable
+
+from .util import LogLevel
+from .message_decoding import get_json_decoder
+from .websocket_client import CoinbaseWebsocket, FULL_CHANNELS, _UNSUBSCRIBABLE_CHANNELS
+
+# The asyncio client needs the websockets package, it is optional for the rest of zcoinbase.
+websockets_spec = importlib.util.find_spec('websockets')
+if websockets_spec is not None:
+  import websockets
+
+# Key used for streams of every message type.
+_ALL_MESSAGES = 'all_messages'
+# Put on a stream's queue when the websocket is closed, ends the stream.
+_STREAM_CLOSED = object()
+
+
+class AsyncCoinbaseWebsocket:
+  """An asyncio Coinbase Websocket, many of these can share a single event loop without a thread each.
+
+  Minimal Usage:
+    async with AsyncCoinbaseWebsocket(products_to_listen=['BTC-USD'], extra_channels=['level2']) as cbws:
+      async for msg in cbws.stream('l2update', product_id='BTC-USD'):
+        print(msg)
+
+  Subscriptions work the same as CoinbaseWebsocket, channels_to_function can also hold coroutine functions, these are
+  scheduled as tasks on the event loop instead of being awaited by the reader.
+  """
+  PROD_ADDRESS = CoinbaseWebsocket.PROD_ADDRESS
+  SANDBOX_ADDRESS = CoinbaseWebsocket.SANDBOX_ADDRESS
+
+  def __init__(self, websocket_addr=PROD_ADDRESS,
+               products_to_listen: list[Text] = None,
+               channels_to_function: dict[Text, list[Callable]] = None,
+               extra_channels: list[Text] = None,
+               preparse_json: bool = True,
+               json_decoder='auto',
+               stream_queue_size: int = 10000,
+               log_level: LogLevel = LogLevel.BASIC_MESSAGES,
+               api_key=None, api_secret=None, passphrase=None):
+    """Constructor for the AsyncCoinbaseWebsocket, nothing is opened until connect is awaited.
+
+    Args:
+      websocket_addr: The address to subscribe to. Default is prod, but you should use Sandbox for testing.
+      products_to_listen: List of products to subscribe to when the socket is opened.
+      channels_to_function: Map of Channels to Functions, see CoinbaseWebsocket.
+      extra_channels: Extra channels to subscribe to without a function, e.g. 'level2' when you only use stream.
+      preparse_json: (Default: True) Should we pass json to functions and streams or simply the string?
+      json_decoder: (Default: 'auto') The JSON decoder to use, see message_decoding.get_json_decoder.
+      stream_queue_size: (Default: 10000) The most messages buffered for each stream, when a stream falls further
+        behind than this its oldest messages are dropped.
+      log_level: (Default: BASIC_MESSAGES) The LOG_LEVEL to use for this class.
+      api_key: (optional) API Key for Authenticated Websocket
+      api_secret: (optional) API Secret for Authenticated Websocket
+      passphrase: (optional) passphrase for authenticated websocket
+    """
+    if products_to_listen is None:
+      products_to_listen = []
+    if channels_to_function is None:
+      channels_to_function = {}
+    if extra_channels is None:
+      extra_channels = []
+    self.websocket_addr = websocket_addr
+    self.products_to_listen = products_to_listen
+    self.channels_to_function = channels_to_function
+    self.extra_channels = extra_channels
+    self.preparse_json = preparse_json
+    self.json_decoder = get_json_decoder(json_decoder)
+    self.stream_queue_size = stream_queue_size
+    self.log_level = log_level
+    self.api_key = api_key
+    self.api_secret = api_secret
+    self.passphrase = passphrase
+    self.ws = None
+    self.ws_opened = asyncio.Event()
+    self._reader_task = None
+    self._function_tasks = set()
+    self._dispatch_table = CoinbaseWebsocket.make_dispatch_table(self.channels_to_function)
+    # Map of (message type, product_id or None) to a tuple of stream queues, replaced whenever streams change.
+    self._streams = {}
+
+  async def __aenter__(self):
+    await self.connect()
+    return self
+
+  async def __aexit__(self, *args):
+    await self.close()
+
+  async def connect(self):
+    """Opens the websocket, subscribes, and starts reading messages on the running event loop."""
+    if websockets_spec is None:
+      raise ImportError('AsyncCoinbaseWebsocket requires the websockets package (pip install websockets).')
+    # Level2 snapshots are far larger than the default limit on message size.
+    self.ws = await websockets.connect(self.websocket_addr, max_size=None)
+    if self.log_level >= LogLevel.BASIC_MESSAGES:
+      logging.info('Coinbase Websocket Connection ({})'.format(self.websocket_addr))
+    self.ws_opened.set()
+    await self.subscribe()
+    self._call_special_functions('open_websocket', self.ws)
+    self._reader_task = asyncio.get_running_loop().create_task(self._read_messages())
+
+  async def close(self):
+    if self.ws is not None:
+      await self.ws.close()
+    if self._reader_task is not None:
+      await self._reader_task
+      self._reader_task = None
+
+  async def wait_for_open(self):
+    await self.ws_opened.wait()
+
+  async def subscribe(self):
+    channels = [channel for channel in self.channels_to_function.keys() if
+                channel not in _UNSUBSCRIBABLE_CHANNELS] + self.extra_channels
+    if self.log_level >= LogLevel.VERBOSE_LOG:
+      logging.info("Subscribing to channels: {}".format(", ".join(channels)))
+    # Make sure there are channels and products to listen to, and that we're connected.
+    if channels and self.products_to_listen and self.ws is not None:
+      await self.ws.send(CoinbaseWebsocket.make_subscribe(self.products_to_listen,
+                                                          channels,
+                                                          self.api_key, self.api_secret, self.passphrase))
+
+  async def add_channel_function(self, channel, function, refresh_subscriptions=None):
+    if channel in self.channels_to_function:
+      functions = self.channels_to_function[channel]
+      if isinstance(functions, list):
+        functions.append(function)
+      else:
+        self.channels_to_function[channel] = [functions, function]
+    else:
+      self.channels_to_function[channel] = [function]
+      # This is a new channel, so force subscription update, if not set.
+      if refresh_subscriptions is None:
+        refresh_subscriptions = True
+    self._dispatch_table = CoinbaseWebsocket.make_dispatch_table(self.channels_to_function)
+    if refresh_subscriptions:
+      await self.subscribe()
+
+  async def add_product(self, product, refresh_subscriptions=True):
+    if product not in self.products_to_listen:
+      self.products_to_listen.append(product)
+      if refresh_subscriptions:
+        await self.subscribe()
+
+  async def add_channel(self, channel, refresh_subscriptions=True):
+    if channel not in self.extra_channels:
+      self.extra_channels.append(channel)
+      if refresh_subscriptions:
+        await self.subscribe()
+
+  async def add_authentication(self, api_key, api_secret, passphrase):
+    self.api_key = api_key
+    self.api_secret = api_secret
+    self.passphrase = passphrase
+    await self.subscribe()
+
+  async def stream(self, channel: Text, product_id: Text = None, max_queue_size: int = None):
+    """Async iterator over the messages of a message type, optionally for a single product.
+
+    The channel is a message type (e.g. 'l2update', 'ticker') or one of the 'full', 'matches' and 'all_messages'
+    aliases. Streams don't subscribe by themselves, the channel that sends the messages ('level2' for 'l2update') has
+    to be in channels_to_function or extra_channels. The stream ends when the websocket is closed.
+    """
+    if channel == 'full':
+      message_types = FULL_CHANNELS
+    elif channel == 'matches':
+      message_types = ['match']
+    else:
+      message_types = [channel]
+    queue = asyncio.Queue(maxsize=max_queue_size or self.stream_queue_size)
+    keys = [(message_type, product_id) for message_type in message_types]
+    self._update_streams(keys, add=queue)
+    try:
+      while True:
+        message = await queue.get()
+        if message is _STREAM_CLOSED:
+          return
+        yield message
+    finally:
+      self._update_streams(keys, remove=queue)
+
+  def _update_streams(self, keys, add=None, remove=None):
+    # Copy-on-write, the reader only ever sees complete tuples.
+    streams = dict(self._streams)
+    for key in keys:
+      queues = tuple(queue for queue in streams.get(key, ()) if queue is not remove)
+      if add is not None:
+        queues += (add,)
+      if queues:
+        streams[key] = queues
+      else:
+        streams.pop(key, None)
+    self._streams = streams
+
+  async def _read_messages(self):
+    try:
+      async for message in self.ws:
+        if self.log_level >= LogLevel.VERBOSE_LOG:
+          logging.info('Message Received: {}'.format(message))
+        try:
+          self._call_message_functions(message)
+        except Exception as err:
+          # A message we can't decode doesn't stop the reader.
+          self._on_error(err)
+    except websockets.exceptions.ConnectionClosed as err:
+      if self.log_level >= LogLevel.ERROR_LOG:
+        logging.error('Error Received: {}'.format(err))
+    finally:
+      self.ws_opened.clear()
+      if self.log_level >= LogLevel.BASIC_MESSAGES:
+        logging.info('Coinbase Websocket Disconnection ({})'.format(self.websocket_addr))
+      self._call_special_functions('close_websocket', self.ws)
+      for queues in self._streams.values():
+        for queue in queues:
+          AsyncCoinbaseWebsocket._put_dropping_oldest(queue, _STREAM_CLOSED)
+
+  def _call_message_functions(self, message):
+    json_msg = self.json_decoder(message)
+    message_type = json_msg.get('type')
+    product_id = json_msg.get('product_id')
+    if not self.preparse_json:
+      json_msg = message
+    table, default_functions = self._dispatch_table
+    for function in table.get(message_type, default_functions):
+      self._call_function(function, json_msg)
+    streams = self._streams
+    if streams:
+      keys = ((message_type, None), (_ALL_MESSAGES, None))
+      if product_id is not None:
+        keys += ((message_type, product_id), (_ALL_MESSAGES, product_id))
+      for key in keys:
+        for queue in streams.get(key, ()):
+          AsyncCoinbaseWebsocket._put_dropping_oldest(queue, json_msg)
+
+  def _call_special_functions(self, channel, argument):
+    if channel in self.channels_to_function:
+      for function in CoinbaseWebsocket._functions_as_tuple(self.channels_to_function[channel]):
+        self._call_function(function, argument)
+
+  def _call_function(self, function, argument, report_errors=True):
+    """Calls the function, exceptions it raises are passed to _on_error (or only logged, without report_errors)."""
+    try:
+      result = function(argument)
+    except Exception as err:
+      self._on_function_error(err, report_errors)
+      return
+    if asyncio.iscoroutine(result):
+      # Never await functions on the reader, keep a reference so the task isn't garbage collected.
+      task = asyncio.get_running_loop().create_task(result)
+      self._function_tasks.add(task)
+      task.add_done_callback(partial(self._on_function_task_done, report_errors))
+
+  def _on_function_task_done(self, report_errors, task):
+    self._function_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+      self._on_function_error(task.exception(), report_errors)
+
+  def _on_function_error(self, err, report_errors):
+    if report_errors:
+      self._on_error(err)
+    elif self.log_level >= LogLevel.ERROR_LOG:
+      logging.error('Exception raised by an error function: {}'.format(err))
+
+  def _on_error(self, err):
+    """Like CoinbaseWebsocket.on_error, for exceptions raised while reading a message or by a function."""
+    if self.log_level >= LogLevel.ERROR_LOG:
+      logging.error('Error Received: {}'.format(err))
+    if 'error' in self.channels_to_function:
+      for function in CoinbaseWebsocket._functions_as_tuple(self.channels_to_function['error']):
+        # Errors raised by the error functions themselves are only logged, they'd never stop otherwise.
+        self._call_function(function, err, report_errors=False)
+
+  @staticmethod
+  def _put_dropping_oldest(queue: asyncio.Queue, message):
+    if queue.full():
+      queue.get_nowait()
+    queue.put_nowait(message)
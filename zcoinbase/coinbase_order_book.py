@@ -1,40 +1,243 @@
-# Maintains a level2 order book of Coinbase
+# Maintains level2 and level3 order books of Coinbase
+import copy
+import logging
+import threading
+import time
 import uuid
 
+from array import array
+from heapq import heappop, heappush, heapify
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from decimal import Decimal
 from operator import neg
+
+import numpy as np
 from sortedcontainers import SortedDict
-from threading import Lock
+from threading import Lock, RLock
 from typing import Text, Callable
 
-from zcoinbase import CoinbaseWebsocket
+from zcoinbase import CoinbaseWebsocket, PublicClient, LogLevel
+from zcoinbase.internal import ShardedDispatchQueue
+from zcoinbase.order_book_arrays import DepthArrays
+from zcoinbase.order_book_workers import BookWorkerProcess, ProductOrderBookProxy
+
+# Analytics of the top of a ProductOrderBook, the prices are None while a side is empty.
+# bid_depth and ask_depth are the total size within each of the book's depth_bands_bps of the mid.
+TopOfBook = namedtuple('TopOfBook', ['best_bid', 'best_bid_size', 'best_ask', 'best_ask_size', 'mid', 'spread',
+                                     'microprice', 'bid_depth', 'ask_depth'])
+_EMPTY_TOP_OF_BOOK = TopOfBook(None, 0.0, None, 0.0, None, None, None, (), ())
+# A consistent view of a ProductOrderBook, bids and asks are tuples of (price, size), best first.
+BookSnapshot = namedtuple('BookSnapshot', ['version', 'bids', 'asks', 'top_of_book'])
+# Reads that a change interrupted are retried this many times before the reader waits for the writer.
+_SEQLOCK_RETRIES = 100
+# Columns of CoinbaseOrderBook.top_of_book_matrix.
+TOP_OF_BOOK_COLUMNS = ('best_bid', 'best_bid_size', 'best_ask', 'best_ask_size')
+
+
+class _UpdateCallback:
+  """A callback of a ProductOrderBook, with the options it was added with (see add_update_callback)."""
+
+  def __init__(self, order_book, callback, min_interval_ms=None, top_k=None, deltas=False):
+    self.order_book = order_book
+    self.callback = callback
+    self.min_interval = min_interval_ms / 1000.0 if min_interval_ms else None
+    self.top_k = top_k
+    self.deltas = deltas
+    self._plain = not (min_interval_ms or top_k or deltas)
+    # Changes since the last call by (side, price), or None when the book was reloaded since then.
+    self._pending = {}
+    self._changed = False
+    self._last_top = None
+    self._last_call = 0.0
+    self._timer = None
+    self._cancelled = False
+    # Guards the pending changes and the timer, the callback is called after it's released so that it can remove
+    # itself or change the book's callbacks.
+    self._lock = threading.Lock()
+    # Calls never overlap, even when a debounced call is made from its timer.
+    self._call_lock = threading.RLock()
+
+  def on_update(self, changes):
+    """Called by the book's writer after every change, changes are the l2update's or None for a snapshot."""
+    if self._plain:
+      self.callback(self.order_book)
+      return
+    with self._lock:
+      if self.deltas:
+        if changes is None:
+          self._pending = None
+        elif self._pending is not None:
+          for side, price, size in changes:
+            self._pending[(side, price)] = size
+      if self.top_k:
+        top = (self.order_book._read_levels('buy', self.top_k), self.order_book._read_levels('sell', self.top_k))
+        if top == self._last_top:
+          return
+        self._last_top = top
+      self._changed = True
+      if self.min_interval:
+        wait = self._last_call + self.min_interval - time.monotonic()
+        if wait > 0:
+          # Called at the end of the interval, with everything that changed until then.
+          if self._timer is None:
+            self._timer = threading.Timer(wait, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+          return
+      arguments = self._take_call_arguments()
+    self._call(arguments)
+
+  def cancel(self):
+    with self._lock:
+      self._cancelled = True
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+
+  def _on_timer(self):
+    with self._lock:
+      self._timer = None
+      if not self._changed or self._cancelled:
+        return
+      arguments = self._take_call_arguments()
+    self._call(arguments)
+
+  def _take_call_arguments(self):
+    """Returns the callback's arguments with everything that changed since the last call, call with _lock held."""
+    self._last_call = time.monotonic()
+    self._changed = False
+    if not self.deltas:
+      return (self.order_book,)
+    changes = None if self._pending is None else [(side, price, size) for (side, price), size in self._pending.items()]
+    self._pending = {}
+    return self.order_book, changes
+
+  def _call(self, arguments):
+    with self._call_lock:
+      self.callback(*arguments)
 
 
 class ProductOrderBook:
-  def __init__(self, product_id):
+  """A level2 order book of a product.
+
+  The book is changed by a single writer at a time (the websocket, or a resync). Readers never take the writer's lock:
+  every change bumps a version (odd while the change is being made, like a seqlock), readers copy what they need and
+  retry if the version moved under them. Reads return immutable tuples, cached per version, so reading the same version
+  again costs nothing.
+
+  With max_depth the book only sorts the best max_depth levels of each side. Those are always exact, reads and
+  top_of_book (including the depth bands) only see them. Levels beyond them are handled by the overflow policy:
+    'store': Kept in an unsorted dict (and a heap to find the best one), changes to them cost O(1). When a level leaves
+      the top max_depth, the best stored level takes its place with its latest size.
+    'drop': Discarded, so the book uses bounded memory. Levels worse than the best level that was dropped are
+      discarded too until the next snapshot, since a level between them and the kept levels could be missing. So a side
+      can hold fewer than max_depth levels, but the levels it holds are always the best levels of the side.
+  """
+
+  def __init__(self, product_id, depth_bands_bps=(10, 50, 100), max_depth: int = None, overflow: Text = 'store'):
+    """Args:
+      product_id: The product of the book.
+      depth_bands_bps: (Default: (10, 50, 100)) Bands (in basis points around the mid) to keep the total bid and ask
+        size of, see top_of_book.
+      max_depth: (optional) Only keep the best max_depth levels of each side sorted, by default the whole book is.
+      overflow: (Default: 'store') What happens to the levels beyond max_depth, 'store' or 'drop'.
+    """
+    if max_depth is not None and max_depth < 1:
+      raise ValueError('max_depth must be at least 1.')
+    if overflow not in ('store', 'drop'):
+      raise ValueError('overflow must be one of [store, drop], got {}'.format(overflow))
     self.product_id = product_id
+    self.depth_bands_bps = tuple(sorted(depth_bands_bps))
+    self.max_depth = max_depth
+    self.overflow = overflow
+    # With max_depth and the 'store' policy: the levels beyond max_depth by side, and heaps of (sort key, price) of
+    # them. The heaps may have entries of levels that were removed since, they're skipped.
+    self._overflow_levels = {'buy': {}, 'sell': {}}
+    self._overflow_heaps = {'buy': [], 'sell': []}
+    # With max_depth and the 'drop' policy: the sort key of the best level dropped from each side since the last
+    # snapshot, or None. Only levels at least as good as it are kept.
+    self._drop_bounds = {'buy': None, 'sell': None}
+    # Kept up to date with every change, so reading it never scans the book.
+    self.top_of_book = _EMPTY_TOP_OF_BOOK
     self._asks = SortedDict(lambda key: float(key))
-    self._asks_lock = Lock()
     self._bids = SortedDict(lambda key: neg(float(key)))
-    self._bids_lock = Lock()
-    self._first_bids_lock = Lock()
-    self._first_bids_lock.acquire()
-    self._first_asks_lock = Lock()
-    self._first_asks_lock.acquire()
     self._update_callbacks = {}
+    # The book is valid once a snapshot has been loaded, until it's found to be out of sync.
+    self._valid = False
+    # Only taken by writers: loading snapshots and applying changes can come from different threads while resyncing.
+    self._sync_lock = RLock()
+    # Odd while the book is being changed.
+    self._version = 0
+    # (version, {top_n: BookSnapshot}) of the latest version that was read.
+    self._snapshots = (-1, {})
+    # While resyncing from a REST snapshot, changes are buffered to be applied on top of the snapshot.
+    self._buffering = False
+    self._buffer = []
+    # Set by _init_book while it replays the buffered changes, changes until then are buffered too.
+    self._replaying = None
+    # Set by _begin_snapshot, only the latest snapshot that began loading is loaded.
+    self._snapshot_token = None
+    self.resyncs = 0
+    # True while the book holds a checkpoint (see OrderBookCheckpointer) and not yet a live snapshot.
+    self.restored = False
 
-  def add_update_callback(self, callback: Callable):
+  @property
+  def version(self):
+    """Incremented twice for every change to the book."""
+    return self._version
+
+  def get_top_of_book(self) -> TopOfBook:
+    """Returns the best bid and ask, mid, spread, microprice and depth in the bps bands, without touching the book."""
+    return self.top_of_book
+
+  def is_valid(self):
+    """Whether the book is in sync, False before the first snapshot and while the book is being resynced."""
+    return self._valid
+
+  def add_update_callback(self, callback: Callable, min_interval_ms: float = None, top_k: int = None,
+                          deltas: bool = False):
     """Add a callback to be called on every update. The callback will be called with 'self' as a parameter.
 
+    Args:
+      callback: The function to call.
+      min_interval_ms: (optional) Call the callback at most once every min_interval_ms. Updates within the interval
+        are combined into a single call at its end.
+      top_k: (optional) Only call the callback when the top_k levels of either side changed.
+      deltas: (Default: False) Call the callback with (self, changes), changes is a list of (side, price, size) of
+        every level that changed since the last call (size 0 removed the level), with the price as it was received.
+        changes is None when a snapshot was loaded since the last call, so the whole book should be read again.
+
     Returns:
       A unique identifier (str) that can be used to remove the callback in the future.
     """
     identifier = str(uuid.uuid4())
-    self._update_callbacks[identifier] = callback
+    self._update_callbacks[identifier] = _UpdateCallback(self, callback, min_interval_ms=min_interval_ms, top_k=top_k,
+                                                         deltas=deltas)
     return identifier
 
   def remove_update_callback(self, identifier: Text):
     """Removes the callback by it's identifier."""
-    del self._update_callbacks[identifier]
+    self._update_callbacks.pop(identifier).cancel()
+
+  def get_snapshot(self, top_n=None) -> BookSnapshot:
+    """Returns a consistent, immutable view of both sides of the book (and top_of_book) at a single version.
+
+    Params:
+      top_n: The depth of the order book to return.
+    """
+    version, snapshots = self._snapshots
+    if version == self._version and top_n in snapshots:
+      return snapshots[top_n]
+    version, (bids, asks, top_of_book) = self._read_consistent(
+      lambda book: (book._read_levels('buy', top_n), book._read_levels('sell', top_n), book.top_of_book), top_n)
+    snapshot = BookSnapshot(version, bids, asks, top_of_book)
+    cached_version, snapshots = self._snapshots
+    if cached_version == version:
+      snapshots[top_n] = snapshot
+    else:
+      self._snapshots = (version, {top_n: snapshot})
+    return snapshot
 
   def top_n_string(self, n=None):
     """Returns the "Top-N" asks/bids in the order-book in string form.
@@ -42,21 +245,19 @@ class ProductOrderBook:
     Params:
       n: How many of the top
     """
-    with self._bids_lock and self._asks_lock:
-      return ProductOrderBook._make_formatted_string(
-        bids=ProductOrderBook._make_sorted_dict_slice(self._bids, stop=n),
-        asks=ProductOrderBook._make_sorted_dict_slice(self._asks, stop=n)
-      )
+    snapshot = self.get_snapshot(n)
+    return self._make_formatted_string(bids=snapshot.bids, asks=snapshot.asks)
 
   def get_book(self, top_n=None):
-    """Returns the order book as a dict with keys 'asks' and 'bids' and tuples of [price, size].
+    """Returns the order book as a dict with keys 'asks' and 'bids' and tuples of (price, size).
 
     Params:
       top_n: The depth of the order book to return.
     """
+    snapshot = self.get_snapshot(top_n)
     return {
-      'asks': self.get_asks(top_n=top_n),
-      'bids': self.get_bids(top_n=top_n)
+      'asks': snapshot.asks,
+      'bids': snapshot.bids
     }
 
   def get_asks(self, top_n=None):
@@ -65,8 +266,7 @@ class ProductOrderBook:
     Params:
       top_n: The depth of the order book to return.
     """
-    with self._asks_lock:
-      return ProductOrderBook._make_slice(self._asks, stop=top_n)
+    return self.get_snapshot(top_n).asks
 
   def get_bids(self, top_n=None):
     """Get the 'bids' part of the order book.
@@ -74,108 +274,685 @@ class ProductOrderBook:
         Params:
           top_n: The depth of the order book to return.
         """
-    with self._bids_lock:
-      return ProductOrderBook._make_slice(self._bids, stop=top_n)
+    return self.get_snapshot(top_n).bids
+
+  def get_bids_array(self, top_n, out: DepthArrays = None) -> DepthArrays:
+    """Returns the top_n bids as NumPy arrays of price, size, cumulative size and notional, see order_book_arrays.
+
+    Params:
+      top_n: The depth of the order book to return.
+      out: (optional) DepthArrays to fill instead of allocating new ones, e.g. to reuse them on every call.
+    """
+    _, (prices, sizes) = self._read_consistent(lambda book: book._top_levels('buy', top_n), top_n)
+    return (out if out is not None else DepthArrays(top_n)).fill(prices, sizes)
+
+  def get_asks_array(self, top_n, out: DepthArrays = None) -> DepthArrays:
+    """Returns the top_n asks as NumPy arrays of price, size, cumulative size and notional, see get_bids_array."""
+    _, (prices, sizes) = self._read_consistent(lambda book: book._top_levels('sell', top_n), top_n)
+    return (out if out is not None else DepthArrays(top_n)).fill(prices, sizes)
 
   # Private API Below this Line.
-  def _call_callbacks(self):
-    for callback in self._update_callbacks.values():
-      callback(self)
+  def _read_consistent(self, read, top_n=None):
+    """Runs read (which is passed the book and must not change anything) until it ran without the book changing under
+    it.
 
-  def _init_bids(self, bids):
-    with self._bids_lock:
-      self._bids.clear()  # init should clear all current bids.
-      for price, size in bids:
-        self._bids[price] = float(size)
-      self._first_bids_lock.release()
-    self._call_callbacks()
+    Args:
+      read: Function of the book, it only reads the best top_n levels of each side.
+      top_n: (optional) The depth read reads, by default the whole book.
+
+    Returns:
+      A tuple of (version, the result of read).
+    """
+    for _ in range(_SEQLOCK_RETRIES):
+      version = self._version
+      if version & 1:
+        # A change is being made, let the writer finish.
+        time.sleep(0)
+        continue
+      try:
+        result = read(self)
+      except (IndexError, KeyError, ValueError, RuntimeError):
+        # The structures changed while they were being read.
+        continue
+      if self._version == version:
+        return version, result
+    # The book is changing too fast to read it between changes. Wait for the writer to copy the levels that are read,
+    # and read the copy without holding the writer up.
+    with self._sync_lock:
+      version = self._version
+      book = copy.copy(self)
+      book._bids, book._asks = self._copy_sides(top_n)
+    return version, read(book)
+
+  def _copy_sides(self, top_n):
+    """Returns copies of the bids and asks with only their best top_n levels, call with the _sync_lock held."""
+    if top_n is None:
+      return self._bids.copy(), self._asks.copy()
+    return (SortedDict(self._bids.key, self._bids.items()[:top_n]),
+            SortedDict(self._asks.key, self._asks.items()[:top_n]))
+
+  def _read_levels(self, side, top_n):
+    """Returns (price, size) of the top_n levels of the side, best first, as they are stored."""
+    orders = self._bids if side == 'buy' else self._asks
+    return tuple((key, orders[key]) for key in orders.islice(stop=top_n))
+
+  def _top_levels(self, side, top_n):
+    """Returns the prices and sizes of the top_n levels of the side, best first."""
+    orders = self._bids if side == 'buy' else self._asks
+    keys = list(orders.islice(stop=top_n))
+    return [float(key) for key in keys], [orders[key] for key in keys]
+
+  def _call_callbacks(self, changes=None):
+    for callback in list(self._update_callbacks.values()):
+      callback.on_update(changes)
+
+  def _build_sides(self, bids, asks):
+    """Builds new bids and asks from a snapshot in bulk: one pass to parse it, and one sort per side.
 
-  def _init_asks(self, asks):
-    with self._asks_lock:
-      self._asks.clear()  # init should clear all current asks.
-      for price, size in asks:
-        self._asks[price] = float(size)
-      self._first_asks_lock.release()
+    Returns:
+      A tuple of (bids, asks, overflow), overflow is a tuple of the overflow levels, heaps and drop bounds with
+      max_depth, else None.
+    """
+    if self.max_depth is None:
+      return (SortedDict(self._bids.key, [(price, float(size)) for price, size in bids]),
+              SortedDict(self._asks.key, [(price, float(size)) for price, size in asks]), None)
+    sides = []
+    overflow_levels, overflow_heaps, drop_bounds = {}, {}, {'buy': None, 'sell': None}
+    for side, orders, levels in (('buy', self._bids, bids), ('sell', self._asks, asks)):
+      key = orders.key
+      keyed_levels = sorted((key(price), price, float(size)) for price, size in levels)
+      sides.append(SortedDict(key, [(price, size) for _, price, size in keyed_levels[:self.max_depth]]))
+      if self.overflow == 'store':
+        overflow_levels[side] = {price: size for _, price, size in keyed_levels[self.max_depth:]}
+        # A sorted list is already a heap.
+        overflow_heaps[side] = [(sort_key, price) for sort_key, price, _ in keyed_levels[self.max_depth:]]
+      else:
+        overflow_levels[side], overflow_heaps[side] = {}, []
+        if len(keyed_levels) > self.max_depth:
+          drop_bounds[side] = keyed_levels[self.max_depth][0]
+    return sides[0], sides[1], (overflow_levels, overflow_heaps, drop_bounds)
+
+  def _begin_snapshot(self):
+    """Buffers changes until the snapshot that is about to be loaded (e.g. on another thread) is in.
+
+    Returns:
+      The token to pass to _init_book with the snapshot.
+    """
+    with self._sync_lock:
+      self._invalidate(buffer_changes=True)
+      self._snapshot_token = token = object()
+    return token
+
+  def _init_book(self, bids, asks, snapshot_token=None):
+    """Loads a snapshot, makes the book valid and applies any changes buffered while it was loading or resyncing.
+
+    Args:
+      snapshot_token: (optional) From _begin_snapshot, the snapshot is dropped if the book was invalidated or another
+        snapshot began loading since.
+    """
+    # Parsing and sorting the snapshot doesn't touch the book, so it's done before taking the lock.
+    new_bids, new_asks, overflow = self._build_sides(bids, asks)
+    with self._sync_lock:
+      if snapshot_token is not None and snapshot_token is not self._snapshot_token:
+        return
+      self._snapshot_token = None
+      self.restored = False
+      self._version += 1
+      try:
+        # Readers see either the old or the new sides, never a partly loaded one.
+        self._bids, self._asks = new_bids, new_asks
+        if overflow is not None:
+          self._overflow_levels, self._overflow_heaps, self._drop_bounds = overflow
+        self._update_top_of_book()
+      finally:
+        self._version += 1
+      buffered, self._buffer, self._buffering = self._buffer, [], False
+      self._valid = True
+      # Changes that arrive while the buffered ones are replayed go to the end of the buffer, so they stay in order.
+      self._replaying = replay = object() if buffered else None
+    # Callbacks and the replay run without the lock, so callbacks can't hold up the websocket thread.
     self._call_callbacks()
+    while buffered:
+      for changes in buffered:
+        with self._sync_lock:
+          if self._replaying is not replay:
+            # Invalidated, or another snapshot was loaded, while replaying.
+            return
+          self._apply_changes(changes)
+        self._call_callbacks(changes)
+      with self._sync_lock:
+        if self._replaying is not replay:
+          return
+        buffered, self._buffer = self._buffer, []
+        if not buffered:
+          self._replaying = None
+
+  def _restore(self, bids, asks, journal=()):
+    """Loads a checkpoint and the changes journaled after it. The book can be read, but stays invalid (and changes are
+    dropped) until the next snapshot."""
+    with self._sync_lock:
+      self._init_book(bids, asks)
+      for changes in journal:
+        self._consume_changes(changes)
+      self._invalidate()
+      self.restored = True
+
+  def _invalidate(self, buffer_changes=False):
+    """Marks the book out of sync until the next snapshot, changes until then are buffered or dropped."""
+    with self._sync_lock:
+      self._valid = False
+      self._buffering = buffer_changes
+      self._buffer = []
+      self._replaying = None
+      self._snapshot_token = None
+
+  def _best_level(self, side):
+    """Returns (price, size) of the best level of the side, (None, 0.0) if the side is empty."""
+    orders = self._bids if side == 'buy' else self._asks
+    if not orders:
+      return None, 0.0
+    price, size = orders.peekitem(0)
+    return float(price), size
+
+  def _levels_from_best(self, side):
+    """Yields (price, size) of the side's levels, best first. Only safe on the thread that changes the book."""
+    orders = self._bids if side == 'buy' else self._asks
+    for price in orders.islice():
+      yield float(price), orders[price]
+
+  def _update_top_of_book(self, size_changes=None):
+    """Updates top_of_book after the book changed.
+
+    Args:
+      size_changes: (optional) (side, price, size change) of every level that changed. When the mid didn't move only
+        these are added to the depth bands, otherwise (or without them) the bands are summed again from the book.
+    """
+    best_bid, best_bid_size = self._best_level('buy')
+    best_ask, best_ask_size = self._best_level('sell')
+    if best_bid is None or best_ask is None:
+      mid = spread = microprice = None
+    else:
+      mid = (best_bid + best_ask) / 2
+      spread = best_ask - best_bid
+      total_size = best_bid_size + best_ask_size
+      microprice = (best_bid * best_ask_size + best_ask * best_bid_size) / total_size if total_size else mid
+    previous = self.top_of_book
+    bands = self.depth_bands_bps
+    if mid is None or not bands:
+      bid_depth = ask_depth = ()
+    elif size_changes is not None and mid == previous.mid:
+      bid_depth, ask_depth = list(previous.bid_depth), list(previous.ask_depth)
+      for side, price, size_change in size_changes:
+        price = float(price)
+        if side == 'buy':
+          distance, depth = (mid - price) / mid * 1e4, bid_depth
+        else:
+          distance, depth = (price - mid) / mid * 1e4, ask_depth
+        for index, band in enumerate(bands):
+          if distance <= band:
+            depth[index] += size_change
+      bid_depth, ask_depth = tuple(bid_depth), tuple(ask_depth)
+    else:
+      bid_depth = self._sum_depth_bands('buy', mid)
+      ask_depth = self._sum_depth_bands('sell', mid)
+    self.top_of_book = TopOfBook(best_bid, best_bid_size, best_ask, best_ask_size, mid, spread, microprice,
+                                 bid_depth, ask_depth)
+
+  def _sum_depth_bands(self, side, mid):
+    bands = self.depth_bands_bps
+    depth = [0.0] * len(bands)
+    widest = bands[-1]
+    for price, size in self._levels_from_best(side):
+      distance = (mid - price if side == 'buy' else price - mid) / mid * 1e4
+      if distance > widest:
+        break
+      for index, band in enumerate(bands):
+        if distance <= band:
+          depth[index] += size
+    return tuple(depth)
+
+  def _is_crossed(self):
+    top_of_book = self.top_of_book
+    return (top_of_book.best_bid is not None and top_of_book.best_ask is not None and
+            top_of_book.best_bid >= top_of_book.best_ask)
 
   def _consume_changes(self, changes):
-    for side, price, size in changes:
-      if side == 'buy':
-        self._consume_buy(price, size)
-      elif side == 'sell':
-        self._consume_sell(price, size)
-    self._call_callbacks()
+    """Applies an l2update's changes.
+
+    Returns:
+      False if the changes left the book crossed, so it's out of sync, True otherwise.
+    """
+    with self._sync_lock:
+      if self._replaying is not None:
+        self._buffer.append(changes)
+        return True
+      if not self._valid:
+        if self._buffering:
+          self._buffer.append(changes)
+        return True
+      self._apply_changes(changes)
+    self._call_callbacks(changes)
+    return not self._is_crossed()
+
+  def _apply_changes(self, changes):
+    """Applies an l2update's changes to the sides, the caller holds _sync_lock."""
+    self._version += 1
+    try:
+      size_changes = []
+      for side, price, size in changes:
+        if side == 'buy':
+          size_changes.append((side, price, self._consume_buy(price, size)))
+        elif side == 'sell':
+          size_changes.append((side, price, self._consume_sell(price, size)))
+      # Levels moving in and out of the top max_depth aren't in size_changes, the bands are summed over them again.
+      self._update_top_of_book(size_changes if self.max_depth is None else None)
+    finally:
+      self._version += 1
 
   def _consume_buy(self, price, size):
+    """Sets the size of a bid level, returns how much the size changed."""
     fsize = float(size)
-    # Wait for _init_bids to run.
-    if self._first_bids_lock.locked():
-      self._first_bids_lock.acquire()
-      self._first_bids_lock.release()
-    with self._bids_lock:
-      if str(fsize) == '0.0':
-        del self._bids[price]
-      else:
-        self._bids[price] = fsize
+    if self.max_depth is not None:
+      return self._consume_capped('buy', self._bids, price, fsize)
+    if str(fsize) == '0.0':
+      return -self._bids.pop(price, 0.0)
+    previous_size = self._bids.get(price, 0.0)
+    self._bids[price] = fsize
+    return fsize - previous_size
 
   def _consume_sell(self, price, size):
+    """Sets the size of an ask level, returns how much the size changed."""
     fsize = float(size)
-    # Wait for _init_asks to run.
-    if self._first_asks_lock.locked():
-      self._first_asks_lock.acquire()
-      self._first_asks_lock.release()
-    with self._asks_lock:
-      if str(fsize) == '0.0':
-        del self._asks[price]
+    if self.max_depth is not None:
+      return self._consume_capped('sell', self._asks, price, fsize)
+    if str(fsize) == '0.0':
+      return -self._asks.pop(price, 0.0)
+    previous_size = self._asks.get(price, 0.0)
+    self._asks[price] = fsize
+    return fsize - previous_size
+
+  def _consume_capped(self, side, orders, price, fsize):
+    """Sets the size of a level of a book with max_depth, returns how much the size of the kept levels changed."""
+    if price in orders:
+      if not fsize:
+        previous_size = orders.pop(price)
+        self._refill(side, orders)
+        return -previous_size
+      previous_size = orders[price]
+      orders[price] = fsize
+      return fsize - previous_size
+    overflow_levels = self._overflow_levels[side]
+    sort_key = orders.key(price)
+    drop_bound = self._drop_bounds[side]
+    if ((drop_bound is None or sort_key <= drop_bound) and
+        (len(orders) < self.max_depth or sort_key < orders.key(orders.peekitem(-1)[0]))):
+      # Only the worst kept level can be pushed out, the stored (or dropped) levels are all worse than it.
+      if not fsize:
+        return 0.0
+      overflow_levels.pop(price, None)
+      orders[price] = fsize
+      if len(orders) > self.max_depth:
+        worst_price, worst_size = orders.popitem(-1)
+        if self.overflow == 'store':
+          self._store_overflow(side, orders.key(worst_price), worst_price, worst_size)
+        else:
+          self._drop(side, orders.key(worst_price))
+        return fsize - worst_size
+      return fsize
+    if self.overflow == 'store':
+      if not fsize:
+        overflow_levels.pop(price, None)
       else:
-        self._asks[price] = fsize
+        self._store_overflow(side, sort_key, price, fsize)
+    elif fsize:
+      self._drop(side, sort_key)
+    return 0.0
 
-  @staticmethod
-  def _make_formatted_string(bids, asks):
+  def _drop(self, side, sort_key):
+    drop_bound = self._drop_bounds[side]
+    if drop_bound is None or sort_key < drop_bound:
+      self._drop_bounds[side] = sort_key
+
+  def _store_overflow(self, side, sort_key, price, size):
+    overflow_levels, overflow_heap = self._overflow_levels[side], self._overflow_heaps[side]
+    if price not in overflow_levels:
+      heappush(overflow_heap, (sort_key, price))
+      if len(overflow_heap) > 2 * len(overflow_levels) + 64:
+        # Mostly entries of levels that were removed, rebuild it from the stored levels.
+        overflow_heap[:] = [(self._sort_key(side, stored_price), stored_price) for stored_price in overflow_levels]
+        overflow_heap.append((sort_key, price))
+        heapify(overflow_heap)
+    overflow_levels[price] = size
+
+  def _sort_key(self, side, price):
+    return (self._bids if side == 'buy' else self._asks).key(price)
+
+  def _refill(self, side, orders):
+    """Moves the best stored levels back into the kept levels, after one was removed."""
+    overflow_levels, overflow_heap = self._overflow_levels[side], self._overflow_heaps[side]
+    while overflow_heap and len(orders) < self.max_depth:
+      _, price = heappop(overflow_heap)
+      size = overflow_levels.pop(price, None)
+      if size is not None:
+        orders[price] = size
+
+  def _make_formatted_string(self, bids, asks):
     overall_format = "BIDS:\n{}\n\nASKS:\n{}\n\n"
     format_str = 'PRICE: {}, SIZE: {}'
     return overall_format.format(
-      '\n'.join(format_str.format(str(price), str(bids[price])) for price in bids.keys()),
-      '\n'.join(format_str.format(str(price), str(asks[price])) for price in asks.keys()))
+      '\n'.join(format_str.format(str(price), str(size)) for price, size in bids),
+      '\n'.join(format_str.format(str(price), str(size)) for price, size in asks))
 
   def __repr__(self):
     """Print the entire order book."""
-    with self._asks_lock and self._bids_lock:
-      return ProductOrderBook._make_formatted_string(self._bids, self._asks)
+    return self.top_n_string()
 
-  @staticmethod
-  def _make_sorted_dict_slice(orders: SortedDict, start=None, stop=None):
-    return SortedDict(orders.key, [(key, orders[key]) for key in orders.islice(start=start, stop=stop)])
 
-  @staticmethod
-  def _make_slice(orders: SortedDict, start=None, stop=None):
-    return [(key, orders[key]) for key in orders.islice(start=start, stop=stop)]
+class _FixedPoint:
+  """Converts decimal strings (or floats) to integer multiples of an increment, e.g. '0.01'."""
+  __slots__ = ('increment', 'decimals', 'multiple', 'scale')
+
+  def __init__(self, increment: Text):
+    self.increment = increment
+    whole, _, fraction = increment.partition('.')
+    fraction = fraction.rstrip('0')
+    self.decimals = len(fraction)
+    self.scale = 10 ** self.decimals
+    # The increment in units of 10**-decimals, e.g. 5 for '0.05'.
+    self.multiple = int(whole + fraction)
+    if self.multiple <= 0:
+      raise ValueError('Increment must be positive, got {}'.format(increment))
+
+  def to_ticks(self, value):
+    if isinstance(value, str):
+      if 'e' in value or 'E' in value:
+        # Exponent notation, e.g. '1.234e-05', is written out in full first.
+        value = format(Decimal(value), 'f')
+      whole, _, fraction = value.partition('.')
+      units = int(whole + fraction[:self.decimals].ljust(self.decimals, '0'))
+    else:
+      units = round(value * self.scale)
+    return units // self.multiple if self.multiple != 1 else units
+
+  def from_ticks(self, ticks: int):
+    return ticks * self.multiple / self.scale
+
+  def to_string(self, ticks: int):
+    units = ticks * self.multiple
+    if not self.decimals:
+      return str(units)
+    return '{}.{}'.format(units // self.scale, str(units % self.scale).rjust(self.decimals, '0'))
+
+
+class _TickSide:
+  """One side of a TickProductOrderBook: parallel arrays of price keys and sizes (both integer ticks).
+
+  Keys are sorted ascending with the best price last, so the busiest levels are at the end of the arrays and inserting
+  or removing them moves the fewest elements. Bids are keyed by their price ticks and asks by their negated price ticks.
+  """
+  __slots__ = ('keys', 'sizes', 'sign')
+
+  def __init__(self, sign):
+    self.keys = array('q')
+    self.sizes = array('q')
+    self.sign = sign
+
+  def clear(self):
+    self.keys = array('q')
+    self.sizes = array('q')
+
+  def set(self, price_ticks: int, size_ticks: int):
+    """Sets the size of a level, returns the size it had before."""
+    key = price_ticks * self.sign
+    keys = self.keys
+    index = bisect_left(keys, key)
+    if index < len(keys) and keys[index] == key:
+      previous_size = self.sizes[index]
+      if size_ticks:
+        self.sizes[index] = size_ticks
+      else:
+        del keys[index]
+        del self.sizes[index]
+      return previous_size
+    if size_ticks:
+      keys.insert(index, key)
+      self.sizes.insert(index, size_ticks)
+    return 0
+
+  def load(self, levels):
+    """Replaces the side with (price_ticks, size_ticks) levels, in any order."""
+    levels = sorted((price_ticks * self.sign, size_ticks) for price_ticks, size_ticks in levels if size_ticks)
+    self.keys = array('q', [key for key, _ in levels])
+    self.sizes = array('q', [size for _, size in levels])
+
+  def copy(self, n=None):
+    """Returns a copy of the side with only its best n levels."""
+    start = 0 if n is None else max(0, len(self.keys) - n)
+    side = _TickSide(self.sign)
+    side.keys = self.keys[start:]
+    side.sizes = self.sizes[start:]
+    return side
+
+  def top(self, n=None):
+    """(price_ticks, size_ticks) of the best n levels, best first."""
+    length = len(self.keys)
+    start = 0 if n is None else max(0, length - n)
+    sign = self.sign
+    return [(self.keys[index] * sign, self.sizes[index]) for index in range(length - 1, start - 1, -1)]
+
+  def __len__(self):
+    return len(self.keys)
+
+
+class TickProductOrderBook(ProductOrderBook):
+  """A ProductOrderBook that stores prices and sizes as integer ticks of the product's quote_increment and
+  base_increment, in compact arrays.
+
+  Updates are a bisect and an in-place array write, and prices and sizes are exact. get_bids/get_asks return
+  (price, size) floats like the other books (typed messages), get_bids_ticks/get_asks_ticks return the exact ticks and
+  price_string/size_string convert ticks back to exact decimal strings.
+
+  Usage:
+    order_book = CoinbaseOrderBook(cb_ws, order_book_factory=TickProductOrderBook.from_product)
+  """
+
+  def __init__(self, product_id, quote_increment: Text, base_increment: Text, depth_bands_bps=(10, 50, 100)):
+    super().__init__(product_id, depth_bands_bps)
+    self.price_point = _FixedPoint(quote_increment)
+    self.size_point = _FixedPoint(base_increment)
+    self._bids = _TickSide(1)
+    self._asks = _TickSide(-1)
+
+  @classmethod
+  def from_product(cls, product_id, public_client: PublicClient = None):
+    """Makes the order book with the increments from PublicClient.get_product."""
+    if public_client is None:
+      public_client = PublicClient()
+    product = public_client.get_product(product_id)
+    return cls(product_id, product['quote_increment'], product['base_increment'])
+
+  def price_string(self, price_ticks: int):
+    return self.price_point.to_string(price_ticks)
+
+  def size_string(self, size_ticks: int):
+    return self.size_point.to_string(size_ticks)
+
+  def get_asks_ticks(self, top_n=None):
+    """Like get_asks, but the prices and sizes are integer ticks."""
+    return self._read_consistent(lambda book: book._asks.top(top_n), top_n)[1]
+
+  def get_bids_ticks(self, top_n=None):
+    """Like get_bids, but the prices and sizes are integer ticks."""
+    return self._read_consistent(lambda book: book._bids.top(top_n), top_n)[1]
+
+  def top_n_string(self, n=None):
+    _, (bids, asks) = self._read_consistent(lambda book: (book._bids.top(n), book._asks.top(n)), n)
+    return self._make_tick_string(bids, asks)
+
+  # Private API Below this Line.
+  def _read_levels(self, side, top_n):
+    book_side = self._bids if side == 'buy' else self._asks
+    return self._from_ticks(book_side.top(top_n))
+
+  def _copy_sides(self, top_n):
+    return self._bids.copy(top_n), self._asks.copy(top_n)
+
+  def _best_level(self, side):
+    book_side = self._bids if side == 'buy' else self._asks
+    if not book_side.keys:
+      return None, 0.0
+    return (self.price_point.from_ticks(book_side.keys[-1] * book_side.sign),
+            self.size_point.from_ticks(book_side.sizes[-1]))
+
+  def _levels_from_best(self, side):
+    book_side = self._bids if side == 'buy' else self._asks
+    price_from_ticks, size_from_ticks = self.price_point.from_ticks, self.size_point.from_ticks
+    for index in range(len(book_side.keys) - 1, -1, -1):
+      yield price_from_ticks(book_side.keys[index] * book_side.sign), size_from_ticks(book_side.sizes[index])
+
+  def _top_levels(self, side, top_n):
+    book_side = self._bids if side == 'buy' else self._asks
+    # Copy the best levels (at the end of the arrays), the arrays can't be resized while NumPy has a view of them.
+    keys = book_side.keys[-top_n:] if top_n else array('q')
+    sizes = book_side.sizes[-top_n:] if top_n else array('q')
+    if len(keys) != len(sizes):
+      raise ValueError('Read a level while it was being changed')
+    prices = np.frombuffer(keys, dtype=np.int64)[::-1] * (book_side.sign * self.price_point.multiple /
+                                                          self.price_point.scale)
+    return prices, np.frombuffer(sizes, dtype=np.int64)[::-1] * (self.size_point.multiple / self.size_point.scale)
+
+  def _from_ticks(self, levels):
+    price_from_ticks = self.price_point.from_ticks
+    size_from_ticks = self.size_point.from_ticks
+    return tuple((price_from_ticks(price), size_from_ticks(size)) for price, size in levels)
+
+  def _make_tick_string(self, bids, asks):
+    overall_format = "BIDS:\n{}\n\nASKS:\n{}\n\n"
+    format_str = 'PRICE: {}, SIZE: {}'
+    return overall_format.format(
+      '\n'.join(format_str.format(self.price_string(price), self.size_string(size)) for price, size in bids),
+      '\n'.join(format_str.format(self.price_string(price), self.size_string(size)) for price, size in asks))
+
+  def _build_sides(self, bids, asks):
+    to_price, to_size = self.price_point.to_ticks, self.size_point.to_ticks
+    new_bids, new_asks = _TickSide(self._bids.sign), _TickSide(self._asks.sign)
+    new_bids.load([(to_price(price), to_size(size)) for price, size in bids])
+    new_asks.load([(to_price(price), to_size(size)) for price, size in asks])
+    return new_bids, new_asks, None
+
+  def _consume_buy(self, price, size):
+    price_ticks, size_ticks = self.price_point.to_ticks(price), self.size_point.to_ticks(size)
+    previous_size = self._bids.set(price_ticks, size_ticks)
+    return self.size_point.from_ticks(size_ticks - previous_size)
+
+  def _consume_sell(self, price, size):
+    price_ticks, size_ticks = self.price_point.to_ticks(price), self.size_point.to_ticks(size)
+    previous_size = self._asks.set(price_ticks, size_ticks)
+    return self.size_point.from_ticks(size_ticks - previous_size)
 
 
 class CoinbaseOrderBook:
-  def __init__(self, cb_ws: CoinbaseWebsocket):
+  def __init__(self, cb_ws: CoinbaseWebsocket,
+               order_book_factory: Callable[[Text], ProductOrderBook] = ProductOrderBook,
+               resync: bool = True,
+               resync_source: Text = 'websocket',
+               public_client: PublicClient = None,
+               workers: int = None,
+               mode: Text = 'threads',
+               snapshot_loaders: int = 1):
+    """Keeps an order book for every product the websocket listens to, from the level2 channel.
+
+    Args:
+      cb_ws: The websocket to get the level2 messages from.
+      order_book_factory: (Default: ProductOrderBook) Makes the order book for a product_id, e.g.
+        TickProductOrderBook.from_product.
+      resync: (Default: True) Resync a product's book when it goes out of sync: when it's crossed, or when its "full"
+        channel has a sequence gap (needs detect_sequence_gaps on the websocket). Books are always resynced after a
+        reconnect. Other products keep updating while a book resyncs.
+      resync_source: (Default: 'websocket') Where the new snapshot comes from:
+        'websocket': Resubscribe the product to level2, Coinbase sends a snapshot followed by the changes after it.
+        'rest': Get the level3 book from PublicClient.get_order_book and aggregate it, the changes received while
+          waiting for it are applied on top. level2 changes have no sequence, so a level can briefly show a value
+          from just before the snapshot, until its next change.
+      public_client: (optional) Client for the 'rest' resync_source, by default a PublicClient for prod.
+      workers: (optional) Split the books over this many workers instead of updating them on the websocket's thread.
+        Every book is owned by a single worker, which applies all of its updates (in order) and runs its callbacks.
+      mode: (Default: 'threads') What the workers are:
+        'threads': Worker threads, the books are read directly. Frees the websocket's thread to keep reading.
+        'processes': Worker processes, so the books are updated on multiple cores. get_order_book returns a
+          ProductOrderBookProxy that asks the owning worker for every read, callbacks are called with the proxy on a
+          thread per worker. order_book_factory must be picklable unless the processes are forked.
+      snapshot_loaders: (Default: 1) Threads that parse and load the level2 snapshots, so the thread that received a
+        snapshot (and the other products' updates) isn't held up by it. The book's changes that arrive meanwhile are
+        buffered and applied on top of the snapshot. With 0 snapshots are loaded on the thread that received them.
+        The worker processes always load their own snapshots.
+    """
+    if resync_source not in ('websocket', 'rest'):
+      raise ValueError('resync_source must be one of [websocket, rest], got {}'.format(resync_source))
+    if mode not in ('threads', 'processes'):
+      raise ValueError('mode must be one of [threads, processes], got {}'.format(mode))
+    if workers is not None and workers < 1:
+      raise ValueError('workers must be at least 1.')
     self.coinbase_websocket = cb_ws
+    self.order_book_factory = order_book_factory
+    self.resync = resync
+    self.resync_source = resync_source
+    self.public_client = public_client
+    # Products waiting for the snapshot of a resync.
+    self._resyncing = set()
+    self._resyncing_lock = Lock()
+    self._dispatch_queue = None
+    self._snapshot_loader = None
+    self._book_workers = []
+    if workers and mode == 'threads':
+      self._dispatch_queue = ShardedDispatchQueue(num_workers=workers, name='CoinbaseOrderBook')
+    elif workers:
+      self._book_workers = [BookWorkerProcess(order_book_factory, on_resync=self._on_worker_resync,
+                                              on_top_of_book=self._set_top_of_book_row,
+                                              name='BookWorker-{}'.format(index)) for index in range(workers)]
+    if snapshot_loaders and not self._book_workers:
+      self._snapshot_loader = ShardedDispatchQueue(num_workers=snapshot_loaders, name='SnapshotLoader')
     self.coinbase_websocket.add_channel('level2')
     self._order_books = {}
+    # Row of every product in the top of book matrix, rows are never reused.
+    self.product_index = {}
+    self._top_of_book_rows = np.full((max(16, len(self.coinbase_websocket.products_to_listen)),
+                                      len(TOP_OF_BOOK_COLUMNS)), np.nan)
+    self._top_of_book_lock = Lock()
     for product in self.coinbase_websocket.products_to_listen:
-      self._order_books[product] = ProductOrderBook(product)
+      self._order_books[product] = self._make_product_order_book(product)
     self.coinbase_websocket.add_channel_function('l2update',
-                                                 lambda message: self._update_order_book(message['product_id'],
-                                                                                         message['changes']),
+                                                 lambda message: self._dispatch(message['product_id'],
+                                                                                self._update_order_book,
+                                                                                message['product_id'],
+                                                                                message['changes']),
                                                  refresh_subscriptions=False)
     self.coinbase_websocket.add_channel_function('snapshot',
-                                                 lambda message: self._initial_snapshot(message['product_id'],
-                                                                                        bids=message['bids'],
-                                                                                        asks=message['asks']),
+                                                 lambda message: self._dispatch(message['product_id'],
+                                                                                self._initial_snapshot,
+                                                                                message['product_id'],
+                                                                                message['bids'],
+                                                                                message['asks']),
                                                  refresh_subscriptions=False)
+    # A new connection sends new snapshots, until then its books are stale.
+    self.coinbase_websocket.add_channel_function('open_websocket', self._on_open_websocket,
+                                                 refresh_subscriptions=False)
+    # Connection errors close the connection too, its books miss every change from then on.
+    self.coinbase_websocket.add_channel_function('close_websocket', self._on_close_websocket,
+                                                 refresh_subscriptions=False)
+    if resync:
+      self.coinbase_websocket.add_channel_function('sequence_gap', self._on_sequence_gap,
+                                                   refresh_subscriptions=False)
 
   @classmethod
-  def make_order_book(cls, product_ids: list[Text], websocket_addr=CoinbaseWebsocket.PROD_ADDRESS):
+  def make_order_book(cls, product_ids: list[Text], websocket_addr=CoinbaseWebsocket.PROD_ADDRESS,
+                      order_book_factory: Callable[[Text], ProductOrderBook] = ProductOrderBook,
+                      workers: int = None, mode: Text = 'threads'):
     """Make an order-book with it's own websocket and starts that websocket."""
     coinbase_websocket = CoinbaseWebsocket(websocket_addr=websocket_addr,
                                            products_to_listen=product_ids,
                                            autostart=False)
-    order_book = cls(coinbase_websocket)
+    order_book = cls(coinbase_websocket, order_book_factory=order_book_factory, workers=workers, mode=mode)
     coinbase_websocket.start_websocket_in_thread()
     coinbase_websocket.wait_for_open()
     return order_book
@@ -189,25 +966,465 @@ class CoinbaseOrderBook:
   def get_tracked_products(self):
     return self._order_books.keys()
 
+  @property
+  def top_of_book_matrix(self) -> np.ndarray:
+    """The best bid, bid size, best ask and ask size (see TOP_OF_BOOK_COLUMNS) of every product, one row per product
+    (see product_index). Prices are NaN while a side is empty.
+
+    The rows are updated in place after every change to a book, each row is written at once so it's never torn. Use
+    get_top_of_book_matrix for a copy of every row at the same moment. Books that are out of sync keep their last row.
+    """
+    return self._top_of_book_rows[:len(self.product_index)]
+
+  def get_top_of_book_matrix(self) -> np.ndarray:
+    """A copy of top_of_book_matrix, with the rows of every product at the same moment."""
+    with self._top_of_book_lock:
+      return self._top_of_book_rows[:len(self.product_index)].copy()
+
   def add_order_books(self, product_ids: list[Text], refresh_subscriptions=True):
     for product_id in product_ids:
       if product_id not in self._order_books:
-        self._order_books[product_id] = ProductOrderBook(product_id)
+        self._order_books[product_id] = self._make_product_order_book(product_id)
         self.coinbase_websocket.add_product(product_id, refresh_subscriptions=False)
     if refresh_subscriptions:
       self.coinbase_websocket.subscribe()
 
-  def add_callback(self, product_id: Text, callback: Callable[[ProductOrderBook], None]):
+  def add_callback(self, product_id: Text, callback: Callable[[ProductOrderBook], None],
+                   min_interval_ms: float = None, top_k: int = None, deltas: bool = False):
+    """Adds a callback to the product's book, see ProductOrderBook.add_update_callback for the options."""
     if product_id in self._order_books:
-      return self._order_books[product_id].add_update_callback(callback)
+      return self._order_books[product_id].add_update_callback(callback, min_interval_ms=min_interval_ms, top_k=top_k,
+                                                               deltas=deltas)
     else:
       raise ValueError('Don\'t have order book for {}'.format(product_id))
 
+  def close(self):
+    """Stops the workers, after they applied the updates they already received."""
+    if self._dispatch_queue is not None:
+      self._dispatch_queue.close_and_join()
+    if self._snapshot_loader is not None:
+      self._snapshot_loader.close_and_join()
+    for worker in self._book_workers:
+      worker.close()
+
+  def resync_order_book(self, product_id):
+    """Drops the product's book and loads a new snapshot, from the resync_source.
+
+    Does nothing while the book is still waiting for the snapshot of an earlier resync.
+    """
+    order_book = self._order_books.get(product_id)
+    if order_book is None:
+      return
+    with self._resyncing_lock:
+      if product_id in self._resyncing:
+        return
+      self._resyncing.add(product_id)
+    if self.coinbase_websocket.log_level >= LogLevel.BASIC_MESSAGES:
+      logging.info('Resyncing the order book for {}'.format(product_id))
+    order_book.resyncs += 1
+    if self.resync_source == 'websocket':
+      order_book._invalidate()
+      self.coinbase_websocket.resubscribe('level2', [product_id])
+      return
+    order_book._invalidate(buffer_changes=True)
+    threading.Thread(target=self._load_rest_snapshot, args=(order_book,), daemon=True).start()
+
+  def _load_rest_snapshot(self, order_book: ProductOrderBook):
+    try:
+      if self.public_client is None:
+        self.public_client = PublicClient()
+      book = self.public_client.get_order_book(order_book.product_id, level=3)
+      order_book._init_book(CoinbaseOrderBook._aggregate_levels(book['bids']),
+                            CoinbaseOrderBook._aggregate_levels(book['asks']))
+    except Exception:
+      # Still resyncing until the websocket's snapshot arrives.
+      logging.exception('Failed to load the snapshot for {}, resubscribing'.format(order_book.product_id))
+      order_book._invalidate()
+      self.coinbase_websocket.resubscribe('level2', [order_book.product_id])
+    else:
+      with self._resyncing_lock:
+        self._resyncing.discard(order_book.product_id)
+
+  @staticmethod
+  def _aggregate_levels(orders):
+    """Sums the sizes of level3 [price, size, order_id] entries by price, to level2 [price, size] levels."""
+    levels = {}
+    for price, size, _ in orders:
+      # Summed as decimals, float sums come out as e.g. '3.0000000000000004e-05'.
+      levels[price] = levels.get(price, Decimal(0)) + Decimal(size)
+    return [[price, format(size, 'f')] for price, size in levels.items()]
+
+  def _make_product_order_book(self, product_id):
+    with self._top_of_book_lock:
+      if len(self.product_index) == len(self._top_of_book_rows):
+        rows = np.full((2 * len(self._top_of_book_rows), len(TOP_OF_BOOK_COLUMNS)), np.nan)
+        rows[:len(self._top_of_book_rows)] = self._top_of_book_rows
+        self._top_of_book_rows = rows
+      self.product_index[product_id] = len(self.product_index)
+    if self._book_workers:
+      # Products are dealt to the workers in turn.
+      order_book = ProductOrderBookProxy(product_id,
+                                         self._book_workers[len(self._order_books) % len(self._book_workers)])
+      order_book.worker.send(('track_top_of_book', product_id))
+      return order_book
+    order_book = self.order_book_factory(product_id)
+    order_book.add_update_callback(lambda book: self._set_top_of_book_row(book.product_id, book.top_of_book))
+    return order_book
+
+  def _set_top_of_book_row(self, product_id, top_of_book):
+    row = (np.nan if top_of_book[0] is None else top_of_book[0], top_of_book[1],
+           np.nan if top_of_book[2] is None else top_of_book[2], top_of_book[3])
+    with self._top_of_book_lock:
+      self._top_of_book_rows[self.product_index[product_id]] = row
+
+  def _dispatch(self, product_id, function, *args):
+    """Runs function(*args) on the worker thread that owns the product, or right away without worker threads."""
+    if self._dispatch_queue is None:
+      function(*args)
+    else:
+      self._dispatch_queue.submit(product_id, function, args)
+
+  def _on_worker_resync(self, product_id):
+    if self.resync:
+      self.resync_order_book(product_id)
+
+  def _on_open_websocket(self, ws):
+    # With a sharded websocket only the books of the shard that (re)connected get new snapshots.
+    self._invalidate_all(self.coinbase_websocket.get_connection_products(ws))
+
+  def _on_close_websocket(self, ws):
+    self._invalidate_all(self.coinbase_websocket.get_connection_products(ws))
+
+  def _invalidate_all(self, product_ids=None):
+    for product_id, order_book in list(self._order_books.items()):
+      if product_ids is None or product_id in product_ids:
+        # Behind the messages of the old connection that are still queued.
+        self._dispatch(product_id, order_book._invalidate)
+
+  def _on_sequence_gap(self, message):
+    # Out of order messages are dropped by the websocket, only missing "full" messages mean the book is stale.
+    if message.get('channel') == 'full' and not message.get('out_of_order'):
+      self.resync_order_book(message['product_id'])
+
   def _initial_snapshot(self, product_id, bids, asks):
-    if product_id in self._order_books:
-      self._order_books[product_id]._init_bids(bids)
-      self._order_books[product_id]._init_asks(asks)
+    order_book = self._order_books.get(product_id)
+    if order_book is None:
+      return
+    with self._resyncing_lock:
+      self._resyncing.discard(product_id)
+    if self._snapshot_loader is None:
+      order_book._init_book(bids, asks)
+    else:
+      self._snapshot_loader.submit(product_id, order_book._init_book, (bids, asks, order_book._begin_snapshot()))
 
   def _update_order_book(self, product_id, changes):
     if product_id in self._order_books:
-      self._order_books[product_id]._consume_changes(changes)
+      if not self._order_books[product_id]._consume_changes(changes) and self.resync:
+        self.resync_order_book(product_id)
+
+
+class _Level3Order:
+  __slots__ = ('order_id', 'side', 'price', 'size')
+
+  def __init__(self, order_id, side, price, size):
+    self.order_id = order_id
+    self.side = side
+    self.price = price
+    self.size = size
+
+
+class _Level3PriceLevel:
+  """The orders resting at a price, in the order they arrived, and their total size."""
+  __slots__ = ('orders', 'size')
+
+  def __init__(self):
+    self.orders = OrderedDict()
+    self.size = 0.0
+
+
+class Level3OrderBook:
+  """A per-order (level3) book of a product, maintained from the "full" channel.
+
+  Orders are kept by order_id, and in arrival order at each price level, so the aggregated (level2) view and the queue
+  position of an order are always up to date. Until a level3 snapshot is loaded, messages are buffered, after that
+  messages are applied in sequence order, and a gap in the sequence makes the book unsynced until the next snapshot.
+  """
+
+  def __init__(self, product_id):
+    self.product_id = product_id
+    self.sequence = None
+    self._orders = {}
+    self._bids = SortedDict(neg)
+    self._asks = SortedDict()
+    self._lock = Lock()
+    self._synced = False
+    self._buffer = []
+    self._update_callbacks = {}
+
+  def add_update_callback(self, callback: Callable):
+    """Add a callback to be called on every update. The callback will be called with 'self' as a parameter.
+
+    Returns:
+      A unique identifier (str) that can be used to remove the callback in the future.
+    """
+    identifier = str(uuid.uuid4())
+    self._update_callbacks[identifier] = callback
+    return identifier
+
+  def remove_update_callback(self, identifier: Text):
+    """Removes the callback by it's identifier."""
+    del self._update_callbacks[identifier]
+
+  def is_synced(self):
+    """Whether the book has been loaded from a snapshot and hasn't missed a message since."""
+    return self._synced
+
+  def get_book(self, top_n=None):
+    """Returns the aggregated order book as a dict with keys 'asks' and 'bids' and tuples of (price, size)."""
+    return {
+      'asks': self.get_asks(top_n=top_n),
+      'bids': self.get_bids(top_n=top_n)
+    }
+
+  def get_asks(self, top_n=None):
+    with self._lock:
+      return Level3OrderBook._make_slice(self._asks, stop=top_n)
+
+  def get_bids(self, top_n=None):
+    with self._lock:
+      return Level3OrderBook._make_slice(self._bids, stop=top_n)
+
+  def get_order(self, order_id):
+    """Returns (side, price, size) of an order on the book, or None if it isn't on the book."""
+    with self._lock:
+      order = self._orders.get(order_id)
+      return None if order is None else (order.side, order.price, order.size)
+
+  def get_level(self, side: Text, price: float):
+    """Returns the (order_id, size) of the orders at a price ('buy' or 'sell' side), first in the queue first."""
+    with self._lock:
+      level = self._side(side).get(float(price))
+      return [] if level is None else [(order.order_id, order.size) for order in level.orders.values()]
+
+  def queue_position(self, order_id):
+    """Estimates where an order is in the queue at its price.
+
+    Returns:
+      A tuple of (orders_ahead, size_ahead), or None if the order isn't on the book.
+    """
+    with self._lock:
+      order = self._orders.get(order_id)
+      if order is None:
+        return None
+      orders_ahead = 0
+      size_ahead = 0.0
+      for queued in self._side(order.side)[order.price].orders.values():
+        if queued is order:
+          break
+        orders_ahead += 1
+        size_ahead += queued.size
+      return orders_ahead, size_ahead
+
+  # Private API Below this Line.
+  def _call_callbacks(self):
+    for callback in self._update_callbacks.values():
+      callback(self)
+
+  def _side(self, side):
+    return self._bids if side == 'buy' else self._asks
+
+  def _reset(self):
+    """Drops the book (not the buffered messages) until the next snapshot."""
+    with self._lock:
+      self._synced = False
+      self._orders = {}
+      self._bids.clear()
+      self._asks.clear()
+
+  def _load_snapshot(self, book):
+    """Loads a level3 snapshot from PublicClient.get_order_book(level=3) and applies the buffered messages after it.
+
+    Returns:
+      False if the buffered messages don't continue from the snapshot without a gap (the snapshot is too old, or a
+      message after it was missed), True otherwise. Either way a newer snapshot is needed.
+    """
+    with self._lock:
+      self._orders = {}
+      self._bids.clear()
+      self._asks.clear()
+      for side, levels in (('buy', book['bids']), ('sell', book['asks'])):
+        for price, size, order_id in levels:
+          self._add_order(order_id, side, float(price), float(size))
+      self.sequence = int(book['sequence'])
+      buffered = []
+      for message in sorted(self._buffer, key=lambda message: message['sequence']):
+        if message['sequence'] <= self.sequence + len(buffered):
+          # Older than the snapshot, or received twice.
+          continue
+        if message['sequence'] != self.sequence + len(buffered) + 1:
+          return False
+        buffered.append(message)
+      self._buffer = []
+      self._synced = True
+      for message in buffered:
+        self._apply(message)
+    self._call_callbacks()
+    return True
+
+  def _consume_message(self, message):
+    """Applies a "full" channel message, returns False if a message was missed and the book needs a new snapshot."""
+    with self._lock:
+      if not self._synced:
+        self._buffer.append(message)
+        return True
+      sequence = message['sequence']
+      if sequence <= self.sequence:
+        return True
+      if sequence != self.sequence + 1:
+        self._synced = False
+        self._buffer = [message]
+        return False
+      self._apply(message)
+    self._call_callbacks()
+    return True
+
+  def _apply(self, message):
+    self.sequence = message['sequence']
+    message_type = message['type']
+    if message_type == 'open':
+      self._add_order(message['order_id'], message['side'], float(message['price']),
+                      float(message['remaining_size']))
+    elif message_type == 'match':
+      self._change_size(self._orders.get(message['maker_order_id']), -float(message['size']))
+    elif message_type == 'change':
+      order = self._orders.get(message['order_id'])
+      if order is not None and message.get('new_size') is not None:
+        self._change_size(order, float(message['new_size']) - order.size)
+    elif message_type == 'done':
+      self._remove_order(message['order_id'])
+
+  def _add_order(self, order_id, side, price, size):
+    levels = self._side(side)
+    level = levels.get(price)
+    if level is None:
+      level = levels[price] = _Level3PriceLevel()
+    order = _Level3Order(order_id, side, price, size)
+    level.orders[order_id] = order
+    level.size += size
+    self._orders[order_id] = order
+
+  def _change_size(self, order, size_change):
+    if order is None:
+      return
+    order.size += size_change
+    self._side(order.side)[order.price].size += size_change
+
+  def _remove_order(self, order_id):
+    order = self._orders.pop(order_id, None)
+    if order is None:
+      # Orders that never rested on the book (e.g. market orders) are done without being opened.
+      return
+    levels = self._side(order.side)
+    level = levels[order.price]
+    del level.orders[order_id]
+    if level.orders:
+      level.size -= order.size
+    else:
+      del levels[order.price]
+
+  @staticmethod
+  def _make_slice(levels: SortedDict, start=None, stop=None):
+    return [(price, levels[price].size) for price in levels.islice(start=start, stop=stop)]
+
+
+class CoinbaseLevel3OrderBook:
+  """Keeps a Level3OrderBook for every product the websocket listens to, from the "full" channel.
+
+  Each book is loaded from a REST level3 snapshot (on a background thread) when the websocket opens, and again
+  whenever it misses a message.
+  """
+
+  def __init__(self, cb_ws: CoinbaseWebsocket, public_client: PublicClient = None, snapshot_retry_delay: float = 1.0):
+    """Args:
+      cb_ws: The websocket to get the "full" channel messages from.
+      public_client: (optional) Client to get the snapshots with, by default a PublicClient for prod.
+      snapshot_retry_delay: (Default: 1.0) Seconds to wait before getting another snapshot, when the last one was older
+        than the buffered messages.
+    """
+    self.coinbase_websocket = cb_ws
+    self.public_client = public_client if public_client is not None else PublicClient()
+    self.snapshot_retry_delay = snapshot_retry_delay
+    self._order_books = {}
+    self._loading = set()
+    self._loading_lock = Lock()
+    for product in self.coinbase_websocket.products_to_listen:
+      self._order_books[product] = Level3OrderBook(product)
+    self.coinbase_websocket.add_channel('full', refresh_subscriptions=False)
+    self.coinbase_websocket.add_channel_function('full', self._on_message, refresh_subscriptions=False)
+    self.coinbase_websocket.add_channel_function('open_websocket', self._on_open_websocket,
+                                                 refresh_subscriptions=False)
+    self.coinbase_websocket.subscribe()
+    if self.coinbase_websocket.ws_opened.is_set():
+      self._load_all()
+
+  def get_order_book(self, product_id) -> Level3OrderBook:
+    if product_id in self._order_books:
+      return self._order_books[product_id]
+    else:
+      raise ValueError('Don\'t have order book for {}'.format(product_id))
+
+  def get_tracked_products(self):
+    return self._order_books.keys()
+
+  def add_order_books(self, product_ids: list[Text], refresh_subscriptions=True):
+    for product_id in product_ids:
+      if product_id not in self._order_books:
+        self._order_books[product_id] = Level3OrderBook(product_id)
+        self.coinbase_websocket.add_product(product_id, refresh_subscriptions=False)
+    if refresh_subscriptions:
+      self.coinbase_websocket.subscribe()
+    if self.coinbase_websocket.ws_opened.is_set():
+      for product_id in product_ids:
+        self._load(product_id)
+
+  def add_callback(self, product_id: Text, callback: Callable[[Level3OrderBook], None]):
+    return self.get_order_book(product_id).add_update_callback(callback)
+
+  def _on_message(self, message):
+    order_book = self._order_books.get(message.get('product_id'))
+    if order_book is not None and not order_book._consume_message(message):
+      if self.coinbase_websocket.log_level >= LogLevel.BASIC_MESSAGES:
+        logging.info('Level3 order book for {} missed a message, reloading'.format(order_book.product_id))
+      self._load(order_book.product_id)
+
+  def _on_open_websocket(self, ws):
+    # With a sharded websocket only the books of the shard that (re)connected missed messages.
+    self._load_all(self.coinbase_websocket.get_connection_products(ws))
+
+  def _load_all(self, product_ids=None):
+    for order_book in list(self._order_books.values()):
+      if product_ids is None or order_book.product_id in product_ids:
+        # After a reconnect the books have missed messages.
+        order_book._reset()
+        self._load(order_book.product_id)
+
+  def _load(self, product_id):
+    with self._loading_lock:
+      if product_id in self._loading:
+        return
+      self._loading.add(product_id)
+    threading.Thread(target=self._load_snapshot, args=(product_id,), daemon=True).start()
+
+  def _load_snapshot(self, product_id):
+    order_book = self._order_books[product_id]
+    try:
+      while self.coinbase_websocket.ws_opened.is_set():
+        if order_book._load_snapshot(self.public_client.get_order_book(product_id, level=3)):
+          return
+        # The snapshot is older than the messages we have, wait for the REST API to catch up.
+        time.sleep(self.snapshot_retry_delay)
+    except Exception:
+      logging.exception('Failed to load the level3 snapshot for {}'.format(product_id))
+    finally:
+      with self._loading_lock:
+        self._loading.discard(product_id)
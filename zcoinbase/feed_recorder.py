@@ -0,0 +1,340 @@
+# Records the raw websocket feed to disk, and replays it into the same functions the live feed uses.
+#
+# A log file is a series of chunks, each chunk is a header followed by a zlib compressed block of frames:
+#   header: magic (4s), compressed length (I), frame count (I), first timestamp (Q), last timestamp (Q)
+#   frame:  timestamp (Q), length (I), frame bytes
+# Every log file has an index file next to it with an entry per chunk, so replay can seek by time or sequence without
+# decompressing the whole log. Files are only ever appended to, if the index is missing it's rebuilt from the headers.
+import bisect
+import glob
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from collections.abc import Mapping
+from typing import Text, Union
+
+from .message_decoding import as_frame, extract_product_id, extract_sequence
+from .util import FrameType
+from .websocket_client import CoinbaseWebsocket
+
+_CHUNK_MAGIC = b'ZCBC'
+_CHUNK_HEADER = struct.Struct('<4sIIQQ')
+_FRAME_HEADER = struct.Struct('<QI')
+# offset, frame count, first timestamp, last timestamp, min sequence, max sequence (-1 if the chunk has none)
+_INDEX_ENTRY = struct.Struct('<QIQQqq')
+
+LOG_SUFFIX = '.zcblog'
+INDEX_SUFFIX = '.zcbidx'
+
+# Put on the recorder's queue to make the writer flush the current chunk.
+_FLUSH = object()
+
+
+class FeedRecorder:
+  """Records raw websocket frames with their receive time to compressed, chunk indexed, rotating log files.
+
+  Usage:
+    recorder = FeedRecorder('/data/feed')
+    recorder.attach(cb_ws)  # Records every frame cb_ws receives.
+    ...
+    recorder.close()
+
+  Frames are handed to a writer thread, so the websocket thread only pays for a queue put.
+  """
+
+  def __init__(self, directory: Text, prefix: Text = 'feed',
+               chunk_frames: int = 4096,
+               chunk_bytes: int = 1 << 20,
+               flush_interval: float = 1.0,
+               max_file_bytes: int = 256 << 20,
+               rotate_interval: float = None,
+               compression_level: int = 1):
+    """Constructor for the FeedRecorder.
+
+    Args:
+      directory: Directory to write the logs to, it's created if it doesn't exist.
+      prefix: (Default: 'feed') Log files are named <prefix>-<first timestamp in ns>.zcblog
+      chunk_frames: (Default: 4096) The most frames in a chunk.
+      chunk_bytes: (Default: 1MiB) The most (uncompressed) bytes in a chunk.
+      flush_interval: (Default: 1.0) Seconds after which a chunk is written even if it isn't full.
+      max_file_bytes: (Default: 256MiB) Start a new log file when the current one is this big.
+      rotate_interval: (optional) Start a new log file after this many seconds.
+      compression_level: (Default: 1) zlib compression level, 1 is the fastest.
+    """
+    self.directory = directory
+    self.prefix = prefix
+    self.chunk_frames = chunk_frames
+    self.chunk_bytes = chunk_bytes
+    self.flush_interval = flush_interval
+    self.max_file_bytes = max_file_bytes
+    self.rotate_interval = rotate_interval
+    self.compression_level = compression_level
+    os.makedirs(directory, exist_ok=True)
+    self.frames_recorded = 0
+    self.chunks_written = 0
+    self._queue = queue.SimpleQueue()
+    self._log_file = None
+    self._index_file = None
+    self._file_opened = None
+    self._attached = []
+    self._closed = False
+    self._writer_thread = threading.Thread(target=self._run_writer, name='FeedRecorder', daemon=True)
+    self._writer_thread.start()
+
+  def attach(self, cb_ws: CoinbaseWebsocket):
+    """Records every frame received by the websocket."""
+    cb_ws.add_raw_message_function(self.record)
+    self._attached.append(cb_ws)
+
+  def record(self, frame: Union[Text, bytes, memoryview], timestamp_ns: int = None):
+    """Records a single frame, timestamp_ns defaults to now. bytes and memoryview frames are written as they are."""
+    self._queue.put((time.time_ns() if timestamp_ns is None else timestamp_ns, frame))
+
+  def flush(self):
+    """Writes out the current chunk, even if it isn't full."""
+    self._queue.put(_FLUSH)
+
+  def delete_before(self, timestamp_ns: int):
+    """Deletes the log files (and their indexes) that only have frames received before timestamp_ns, except the one
+    being written."""
+    log_file = self._log_file
+    current = log_file.name if log_file is not None else None
+    for log_file_name in FeedReplayer(self.directory, self.prefix).log_files():
+      if log_file_name == current:
+        continue
+      index = FeedReplayer._read_index(log_file_name)
+      if index and index[-1][3] >= timestamp_ns:
+        continue
+      os.remove(log_file_name)
+      index_file_name = log_file_name[:-len(LOG_SUFFIX)] + INDEX_SUFFIX
+      if os.path.exists(index_file_name):
+        os.remove(index_file_name)
+
+  def close(self):
+    """Detaches from the websockets, writes out everything that was recorded and closes the log."""
+    for cb_ws in self._attached:
+      cb_ws.remove_raw_message_function(self.record)
+    self._attached = []
+    self._closed = True
+    self._queue.put(_FLUSH)
+    self._writer_thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _run_writer(self):
+    frames = []
+    chunk_size = 0
+    chunk_started = time.monotonic()
+    while True:
+      try:
+        item = self._queue.get(timeout=self.flush_interval)
+      except queue.Empty:
+        item = _FLUSH
+      if item is not _FLUSH:
+        timestamp_ns, frame = item
+        if isinstance(frame, str):
+          frame = frame.encode('utf-8')
+        frames.append((timestamp_ns, frame))
+        chunk_size += len(frame)
+      if frames and (item is _FLUSH or len(frames) >= self.chunk_frames or chunk_size >= self.chunk_bytes or
+                     time.monotonic() - chunk_started >= self.flush_interval):
+        try:
+          self._write_chunk(frames)
+        except OSError:
+          logging.exception('FeedRecorder failed to write {} frames'.format(len(frames)))
+        frames = []
+        chunk_size = 0
+        chunk_started = time.monotonic()
+      if item is _FLUSH and self._closed and self._queue.empty():
+        if self._log_file is not None:
+          self._log_file.close()
+          self._index_file.close()
+        return
+
+  def _write_chunk(self, frames):
+    self._maybe_rotate(frames[0][0])
+    payload = bytearray()
+    min_sequence = max_sequence = -1
+    for timestamp_ns, frame in frames:
+      payload += _FRAME_HEADER.pack(timestamp_ns, len(frame))
+      payload += frame
+      sequence = extract_sequence(frame)
+      if sequence is not None:
+        min_sequence = sequence if min_sequence < 0 else min(min_sequence, sequence)
+        max_sequence = max(max_sequence, sequence)
+    compressed = zlib.compress(bytes(payload), self.compression_level)
+    offset = self._log_file.tell()
+    self._log_file.write(_CHUNK_HEADER.pack(_CHUNK_MAGIC, len(compressed), len(frames), frames[0][0], frames[-1][0]))
+    self._log_file.write(compressed)
+    self._log_file.flush()
+    self._index_file.write(_INDEX_ENTRY.pack(offset, len(frames), frames[0][0], frames[-1][0],
+                                             min_sequence, max_sequence))
+    self._index_file.flush()
+    self.frames_recorded += len(frames)
+    self.chunks_written += 1
+
+  def _maybe_rotate(self, timestamp_ns):
+    if self._log_file is not None:
+      too_big = self._log_file.tell() >= self.max_file_bytes
+      too_old = self.rotate_interval is not None and time.monotonic() - self._file_opened >= self.rotate_interval
+      if not (too_big or too_old):
+        return
+      self._log_file.close()
+      self._index_file.close()
+    base_name = os.path.join(self.directory, '{}-{:020d}'.format(self.prefix, timestamp_ns))
+    self._log_file = open(base_name + LOG_SUFFIX, 'ab')
+    self._index_file = open(base_name + INDEX_SUFFIX, 'ab')
+    self._file_opened = time.monotonic()
+
+
+class FeedReplayer:
+  """Replays logs written by FeedRecorder.
+
+  Usage:
+    # Rebuild order books from a recording, as fast as possible.
+    cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD'], autostart=False)
+    order_book = CoinbaseOrderBook(cb_ws)
+    FeedReplayer('/data/feed').replay(cb_ws)
+  """
+
+  def __init__(self, directory: Text, prefix: Text = 'feed'):
+    self.directory = directory
+    self.prefix = prefix
+
+  def log_files(self):
+    """The log files of the recording, oldest first."""
+    return sorted(glob.glob(os.path.join(self.directory, '{}-*{}'.format(self.prefix, LOG_SUFFIX))))
+
+  def frames(self, start_time_ns: int = None, end_time_ns: int = None,
+             start_sequence: int = None, product_id: Text = None, frame_type: FrameType = FrameType.TEXT):
+    """Yields (timestamp_ns, frame) for the recorded frames, in the order they were received.
+
+    Args:
+      start_time_ns: (optional) Skip frames received before this time (ns since the epoch).
+      end_time_ns: (optional) Stop at the first frame received after this time.
+      start_sequence: (optional) Skip frames until the first one with at least this sequence.
+      product_id: (optional) With start_sequence, only this product's sequence is compared.
+      frame_type: (Default: TEXT) The type of the yielded frames, MEMORYVIEW frames are views into the decompressed
+        chunk, nothing is copied.
+    """
+    seeking_sequence = start_sequence is not None
+    for log_file_name in self.log_files():
+      index = FeedReplayer._read_index(log_file_name)
+      if not index:
+        continue
+      # Skip whole files, and then whole chunks, using the index.
+      if start_time_ns is not None and index[-1][3] < start_time_ns:
+        continue
+      if end_time_ns is not None and index[0][2] > end_time_ns:
+        return
+      first_chunk = 0
+      if start_time_ns is not None:
+        first_chunk = bisect.bisect_left([entry[3] for entry in index], start_time_ns)
+      if seeking_sequence:
+        while first_chunk < len(index) and index[first_chunk][5] < start_sequence:
+          first_chunk += 1
+      with open(log_file_name, 'rb') as log_file:
+        for offset, _, _, _, _, _ in index[first_chunk:]:
+          for timestamp_ns, frame in FeedReplayer._read_chunk(log_file, offset, frame_type):
+            if start_time_ns is not None and timestamp_ns < start_time_ns:
+              continue
+            if end_time_ns is not None and timestamp_ns > end_time_ns:
+              return
+            if seeking_sequence:
+              sequence = extract_sequence(frame)
+              if (sequence is None or sequence < start_sequence or
+                  (product_id is not None and extract_product_id(frame) != product_id)):
+                continue
+              seeking_sequence = False
+            yield timestamp_ns, frame
+
+  def replay(self, target, speed: float = None, **frames_kwargs):
+    """Feeds the recorded frames into a websocket's functions.
+
+    Args:
+      target: A CoinbaseWebsocket (frames go through on_message, so everything attached to it, including
+        CoinbaseOrderBooks, sees them), an object with a coinbase_websocket (e.g. CoinbaseOrderBook) or a
+        channels_to_function dict.
+      speed: (optional) Replay speed relative to the recording (1.0 is the recorded pace), by default replays as fast
+        as possible.
+      **frames_kwargs: Passed to frames, to seek by time or sequence. The frames are of the target's frame_type.
+
+    Returns:
+      The number of frames replayed.
+    """
+    if isinstance(target, Mapping):
+      target = CoinbaseWebsocket(channels_to_function=target, autostart=False)
+    elif hasattr(target, 'coinbase_websocket'):
+      target = target.coinbase_websocket
+    frames_kwargs.setdefault('frame_type', target.frame_type)
+    replayed = 0
+    first_recorded = first_replayed = None
+    for timestamp_ns, frame in self.frames(**frames_kwargs):
+      if speed is not None:
+        if first_recorded is None:
+          first_recorded = timestamp_ns
+          first_replayed = time.monotonic()
+        delay = (timestamp_ns - first_recorded) / 1e9 / speed - (time.monotonic() - first_replayed)
+        if delay > 0:
+          time.sleep(delay)
+      target.on_message(None, frame)
+      replayed += 1
+    return replayed
+
+  @staticmethod
+  def _read_chunk(log_file, offset, frame_type=FrameType.TEXT):
+    log_file.seek(offset)
+    magic, compressed_length, frame_count, _, _ = _CHUNK_HEADER.unpack(log_file.read(_CHUNK_HEADER.size))
+    if magic != _CHUNK_MAGIC:
+      raise ValueError('Corrupt feed log {} at offset {}'.format(log_file.name, offset))
+    payload = memoryview(zlib.decompress(log_file.read(compressed_length)))
+    position = 0
+    for _ in range(frame_count):
+      timestamp_ns, length = _FRAME_HEADER.unpack_from(payload, position)
+      position += _FRAME_HEADER.size
+      yield timestamp_ns, as_frame(payload[position:position + length], frame_type)
+      position += length
+
+  @staticmethod
+  def _read_index(log_file_name):
+    index_file_name = log_file_name[:-len(LOG_SUFFIX)] + INDEX_SUFFIX
+    if os.path.exists(index_file_name):
+      with open(index_file_name, 'rb') as index_file:
+        data = index_file.read()
+      # Ignore a partially written last entry.
+      return list(_INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % _INDEX_ENTRY.size]))
+    return FeedReplayer._rebuild_index(log_file_name)
+
+  @staticmethod
+  def _rebuild_index(log_file_name):
+    index = []
+    with open(log_file_name, 'rb') as log_file:
+      while True:
+        offset = log_file.tell()
+        header = log_file.read(_CHUNK_HEADER.size)
+        if len(header) < _CHUNK_HEADER.size:
+          break
+        magic, compressed_length, frame_count, first_timestamp, last_timestamp = _CHUNK_HEADER.unpack(header)
+        if magic != _CHUNK_MAGIC:
+          break
+        try:
+          sequences = [sequence for sequence in
+                       (extract_sequence(frame) for _, frame in
+                        FeedReplayer._read_chunk(log_file, offset, FrameType.MEMORYVIEW))
+                       if sequence is not None]
+        except (zlib.error, struct.error):
+          # The recorder stopped in the middle of writing this chunk.
+          break
+        index.append((offset, frame_count, first_timestamp, last_timestamp,
+                      min(sequences, default=-1), max(sequences, default=-1)))
+        log_file.seek(offset + _CHUNK_HEADER.size + compressed_length)
+    return index
@@ -1 +1,3 @@
 from .rate_limited_execution_queue import RateLimitedExecutionQueue
+from .sharded_dispatch_queue import ShardedDispatchQueue
+from .latest_value_store import LatestValueStore
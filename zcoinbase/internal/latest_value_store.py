@@ -0,0 +1,86 @@
+import logging
+
+from threading import Event, Lock, Thread, current_thread
+from typing import Callable, Hashable, Text
+
+
+class _Listener:
+  """Delivers the slots of a channel that changed, to a function, once every interval."""
+
+  def __init__(self, store, channel, function, interval):
+    self.store = store
+    self.channel = channel
+    self.function = function
+    self.interval = interval
+    self.stopped = Event()
+    # The message delivered last for each product, slots that still hold the same message haven't changed.
+    self.delivered = {}
+    self.thread = Thread(target=self.run, name='LatestValueListener', daemon=True)
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      for product_id, message in self.store.get_all(self.channel).items():
+        if self.delivered.get(product_id) is not message:
+          self.delivered[product_id] = message
+          try:
+            self.function(message)
+          except Exception:
+            logging.exception('Latest value function failed')
+
+
+class LatestValueStore:
+  """Keeps only the newest message for every (channel, product_id).
+
+  Writing is a single dict assignment (atomic in CPython), so the writer never takes a lock and never waits for
+  readers. Readers can poll a slot, or add a listener that gets the slots that changed on a fixed cadence. A slow reader
+  only ever misses intermediate values, it can't build a backlog.
+  """
+
+  def __init__(self):
+    self._slots = {}
+    self._writes = 0
+    self._listeners = []
+    # Only for adding and removing listeners.
+    self._lock = Lock()
+
+  def put(self, channel: Text, product_id: Hashable, message):
+    self._slots[(channel, product_id)] = message
+    self._writes += 1
+
+  def get(self, channel: Text, product_id: Hashable = None):
+    """The newest message for the channel and product, or None if there hasn't been one."""
+    return self._slots.get((channel, product_id))
+
+  def get_all(self, channel: Text):
+    """Returns a dict of product_id to the newest message, for every product seen on the channel."""
+    # Copying the items is atomic, the writer may add slots at any time.
+    return {product_id: message for (slot_channel, product_id), message in list(self._slots.items())
+            if slot_channel == channel}
+
+  def add_listener(self, channel: Text, function: Callable, interval: float = 1.0):
+    """Calls function with the newest message of each product whose slot changed, every interval seconds."""
+    listener = _Listener(self, channel, function, interval)
+    with self._lock:
+      self._listeners.append(listener)
+    listener.thread.start()
+
+  def remove_listener(self, function: Callable):
+    with self._lock:
+      listeners = [listener for listener in self._listeners if listener.function == function]
+      self._listeners = [listener for listener in self._listeners if listener.function != function]
+    for listener in listeners:
+      listener.stopped.set()
+
+  def get_stats(self):
+    return {'slots': len(self._slots), 'writes': self._writes, 'listeners': len(self._listeners)}
+
+  def close(self):
+    """Stops every listener and waits for their threads to exit."""
+    with self._lock:
+      listeners, self._listeners = self._listeners, []
+    for listener in listeners:
+      listener.stopped.set()
+    for listener in listeners:
+      # A listener's function can close the store, its thread exits once the function returns.
+      if listener.thread is not current_thread():
+        listener.thread.join()
@@ -0,0 +1,154 @@
+import logging
+
+from collections import deque
+from threading import Condition, Lock, Thread, current_thread
+from typing import Callable, Any, Hashable
+
+from zcoinbase.util import BackpressurePolicy
+
+
+class _Shard:
+  """A bounded queue and the worker thread that drains it."""
+  __slots__ = ('queue', 'pending', 'lock', 'not_empty', 'not_full', 'thread',
+               'submitted', 'processed', 'dropped', 'conflated', 'max_depth')
+
+  def __init__(self):
+    self.queue = deque()
+    # Most recent queued entry for each conflation key, used by BackpressurePolicy.CONFLATE.
+    self.pending = {}
+    self.lock = Lock()
+    self.not_empty = Condition(self.lock)
+    self.not_full = Condition(self.lock)
+    self.thread = None
+    self.submitted = 0
+    self.processed = 0
+    self.dropped = 0
+    self.conflated = 0
+    self.max_depth = 0
+
+
+class ShardedDispatchQueue:
+  """Runs functions on a pool of worker threads, each with its own bounded queue.
+
+  Work is sharded by a key (e.g. the product_id), all work for the same key runs on the same worker, in the order that
+  it was submitted. When a worker's queue is full the backpressure policy decides what happens:
+    BLOCK: submit waits until the worker catches up.
+    DROP_OLDEST: the oldest queued entry is dropped to make room.
+    CONFLATE: the queued entry with the same conflation key is replaced by the new one, if there isn't one the oldest
+      queued entry is dropped.
+  """
+
+  def __init__(self, num_workers: int, max_queue_size: int = 10000,
+               backpressure: BackpressurePolicy = BackpressurePolicy.BLOCK, name='ShardedDispatchQueue'):
+    if num_workers < 1:
+      raise ValueError('num_workers must be at least 1.')
+    if max_queue_size < 1:
+      raise ValueError('max_queue_size must be at least 1.')
+    self.num_workers = num_workers
+    self.max_queue_size = max_queue_size
+    self.backpressure = backpressure
+    self._running = True
+    self._shards = [_Shard() for _ in range(num_workers)]
+    for index, shard in enumerate(self._shards):
+      shard.thread = Thread(target=self._run_worker, args=(shard,), name='{}-{}'.format(name, index), daemon=True)
+      shard.thread.start()
+
+  def submit(self, shard_key: Hashable, function: Callable[..., Any], args: tuple, conflation_key: Hashable = None):
+    """Queues function(*args) on the worker that owns shard_key.
+
+    Returns:
+      False if the entry could not be queued because the queue was closed, True otherwise.
+    """
+    shard = self._shards[hash(shard_key) % self.num_workers]
+    with shard.lock:
+      if not self._running:
+        return False
+      if len(shard.queue) >= self.max_queue_size:
+        if self.backpressure == BackpressurePolicy.BLOCK:
+          while len(shard.queue) >= self.max_queue_size and self._running:
+            shard.not_full.wait()
+          if not self._running:
+            return False
+        elif self.backpressure == BackpressurePolicy.CONFLATE and conflation_key in shard.pending:
+          # Overwrite the queued entry in place, it keeps its position in the queue.
+          entry = shard.pending[conflation_key]
+          entry[1] = function
+          entry[2] = args
+          shard.conflated += 1
+          return True
+        else:
+          dropped_entry = shard.queue.popleft()
+          if shard.pending.get(dropped_entry[0]) is dropped_entry:
+            del shard.pending[dropped_entry[0]]
+          shard.dropped += 1
+      entry = [conflation_key, function, args]
+      shard.queue.append(entry)
+      shard.submitted += 1
+      if self.backpressure == BackpressurePolicy.CONFLATE:
+        shard.pending[conflation_key] = entry
+      if len(shard.queue) > shard.max_depth:
+        shard.max_depth = len(shard.queue)
+      shard.not_empty.notify()
+    return True
+
+  def get_stats(self):
+    """Returns the counters for this queue, summed over all of the workers.
+
+    submitted counts the entries that were queued, conflated the ones that replaced a queued entry instead, and dropped
+    the queued entries that were dropped to make room (or by close_and_join).
+    """
+    stats = {'queue_depth': 0, 'max_queue_depth': 0, 'submitted': 0, 'processed': 0, 'dropped': 0, 'conflated': 0,
+             'queue_depths': []}
+    for shard in self._shards:
+      with shard.lock:
+        depth = len(shard.queue)
+        stats['queue_depths'].append(depth)
+        stats['queue_depth'] += depth
+        stats['max_queue_depth'] = max(stats['max_queue_depth'], shard.max_depth)
+        stats['submitted'] += shard.submitted
+        stats['processed'] += shard.processed
+        stats['dropped'] += shard.dropped
+        stats['conflated'] += shard.conflated
+    return stats
+
+  @property
+  def closed(self):
+    return not self._running
+
+  def close_and_join(self, drain: bool = True):
+    """Stops accepting work and waits for the workers to stop.
+
+    Args:
+      drain: (Default: True) Let the workers finish everything that is queued first, otherwise it is dropped.
+    """
+    for shard in self._shards:
+      with shard.lock:
+        self._running = False
+        if not drain:
+          shard.dropped += len(shard.queue)
+          shard.queue.clear()
+          shard.pending.clear()
+        shard.not_empty.notify_all()
+        shard.not_full.notify_all()
+    for shard in self._shards:
+      # A function running on a worker can close the queue, that worker stops once the function returns.
+      if shard.thread is not current_thread():
+        shard.thread.join()
+
+  def _run_worker(self, shard: _Shard):
+    while True:
+      with shard.lock:
+        while not shard.queue and self._running:
+          shard.not_empty.wait()
+        if not shard.queue:
+          return
+        entry = shard.queue.popleft()
+        if self.backpressure == BackpressurePolicy.CONFLATE and shard.pending.get(entry[0]) is entry:
+          del shard.pending[entry[0]]
+        shard.not_full.notify()
+      try:
+        entry[1](*entry[2])
+      except Exception:
+        logging.exception('Exception raised by function running on {}'.format(shard.thread.name))
+      # Only this worker writes the counter.
+      shard.processed += 1
@@ -0,0 +1,171 @@
+# Fixed memory latency histograms, used to instrument the websocket pipeline.
+import datetime
+import json
+import threading
+
+from array import array
+from typing import Text
+
+# Values below 2**_SUB_BUCKET_BITS are counted exactly, above that every power of two is split into
+# 2**(_SUB_BUCKET_BITS - 1) buckets, so every bucket is within ~3% of the values in it (like an HDR histogram).
+_SUB_BUCKET_BITS = 6
+_SUB_BUCKET_COUNT = 1 << _SUB_BUCKET_BITS
+_HALF_SUB_BUCKET_COUNT = _SUB_BUCKET_COUNT >> 1
+# Largest value that is tracked, larger values are counted in the last bucket. 2**40ns is ~18 minutes.
+_MAX_VALUE_BITS = 40
+_BUCKET_COUNT = _SUB_BUCKET_COUNT + (_MAX_VALUE_BITS - _SUB_BUCKET_BITS) * _HALF_SUB_BUCKET_COUNT
+
+DEFAULT_PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Stages of the websocket pipeline.
+EXCHANGE_TO_RECEIVE = 'exchange_to_receive'
+RECEIVE_TO_DISPATCH = 'receive_to_dispatch'
+HANDLER = 'handler'
+
+
+def _bucket_index(value):
+  if value < _SUB_BUCKET_COUNT:
+    return value if value > 0 else 0
+  shift = value.bit_length() - _SUB_BUCKET_BITS
+  index = _SUB_BUCKET_COUNT + (shift - 1) * _HALF_SUB_BUCKET_COUNT + (value >> shift) - _HALF_SUB_BUCKET_COUNT
+  return index if index < _BUCKET_COUNT else _BUCKET_COUNT - 1
+
+
+def _bucket_value(index):
+  """The highest value counted in the bucket."""
+  if index < _SUB_BUCKET_COUNT:
+    return index
+  shift = (index - _SUB_BUCKET_COUNT) // _HALF_SUB_BUCKET_COUNT + 1
+  mantissa = (index - _SUB_BUCKET_COUNT) % _HALF_SUB_BUCKET_COUNT + _HALF_SUB_BUCKET_COUNT
+  return ((mantissa + 1) << shift) - 1
+
+
+def parse_exchange_time(time_string: Text):
+  """Converts a Coinbase timestamp (e.g. '2014-11-07T08:19:27.028459Z') to nanoseconds since the epoch."""
+  if time_string.endswith('Z'):
+    time_string = time_string[:-1] + '+00:00'
+  timestamp = datetime.datetime.fromisoformat(time_string)
+  return (timestamp - _EPOCH) // _ONE_MICROSECOND * 1000
+
+
+class LatencyHistogram:
+  """A histogram of latencies in nanoseconds, with a fixed number of buckets and ~3% precision."""
+  __slots__ = ('_counts', 'count', 'total', 'min', 'max')
+
+  def __init__(self):
+    self._counts = array('Q', bytes(8 * _BUCKET_COUNT))
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+
+  def record(self, value_ns: int):
+    """Records a single value, negative values (e.g. from clock skew) are counted as 0."""
+    if value_ns < 0:
+      value_ns = 0
+    self._counts[_bucket_index(value_ns)] += 1
+    self.count += 1
+    self.total += value_ns
+    if self.min is None or value_ns < self.min:
+      self.min = value_ns
+    if self.max is None or value_ns > self.max:
+      self.max = value_ns
+
+  def merge(self, other: 'LatencyHistogram'):
+    """Adds the values recorded in other to this histogram."""
+    for index, count in enumerate(other._counts):
+      if count:
+        self._counts[index] += count
+    self.count += other.count
+    self.total += other.total
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+
+  def percentile(self, percentile: float):
+    """The value (ns) at the percentile, e.g. percentile(99.9), or None if nothing has been recorded."""
+    if not self.count:
+      return None
+    target = max(1, int(round(self.count * percentile / 100.0)))
+    seen = 0
+    for index, count in enumerate(self._counts):
+      seen += count
+      if seen >= target:
+        return min(_bucket_value(index), self.max)
+    return self.max
+
+  def mean(self):
+    return self.total / self.count if self.count else None
+
+  def to_dict(self, percentiles=DEFAULT_PERCENTILES):
+    """Summary of the histogram (all values in ns), for logging or exporting."""
+    summary = {'count': self.count, 'min': self.min, 'max': self.max, 'mean': self.mean()}
+    for percentile in percentiles:
+      summary['p{:g}'.format(percentile)] = self.percentile(percentile)
+    return summary
+
+  def reset(self):
+    self._counts = array('Q', bytes(8 * _BUCKET_COUNT))
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+
+
+class LatencyTracker:
+  """Latency histograms for each stage of the pipeline, by channel (message type) and product.
+
+  Stages:
+    exchange_to_receive: From the message's 'time' (set by Coinbase) until we received it, includes clock skew.
+    receive_to_dispatch: From receiving the message until its functions started running (includes worker queues).
+    handler: How long each function took, the key also has the function's name.
+  """
+
+  def __init__(self, per_product: bool = True):
+    """Args:
+      per_product: (Default: True) Keep separate histograms for every product, otherwise only per channel.
+    """
+    self.per_product = per_product
+    self._histograms = {}
+    # Only taken to add a new histogram.
+    self._lock = threading.Lock()
+
+  def record(self, stage: Text, channel: Text, product_id: Text, value_ns: int, handler: Text = None):
+    key = (stage, channel, product_id if self.per_product else None, handler)
+    histogram = self._histograms.get(key)
+    if histogram is None:
+      with self._lock:
+        histogram = self._histograms.setdefault(key, LatencyHistogram())
+    histogram.record(value_ns)
+
+  def get_histogram(self, stage: Text, channel: Text = None, product_id: Text = None, handler: Text = None):
+    """Returns a histogram of the stage, merged over every channel, product and handler that isn't specified."""
+    merged = LatencyHistogram()
+    for (key_stage, key_channel, key_product_id, key_handler), histogram in list(self._histograms.items()):
+      if (key_stage == stage and channel in (None, key_channel) and product_id in (None, key_product_id) and
+          handler in (None, key_handler)):
+        merged.merge(histogram)
+    return merged
+
+  def get_stats(self, percentiles=DEFAULT_PERCENTILES):
+    """Returns a list with a summary of every histogram, see LatencyHistogram.to_dict."""
+    stats = []
+    for (stage, channel, product_id, handler), histogram in sorted(list(self._histograms.items()),
+                                                                   key=lambda item: tuple(map(str, item[0]))):
+      summary = {'stage': stage, 'channel': channel, 'product_id': product_id, 'handler': handler}
+      summary.update(histogram.to_dict(percentiles))
+      stats.append(summary)
+    return stats
+
+  def export_json(self, path: Text, percentiles=DEFAULT_PERCENTILES):
+    """Writes get_stats to a JSON file."""
+    with open(path, 'w') as output_file:
+      json.dump(self.get_stats(percentiles), output_file, indent=2)
+
+  def reset(self):
+    with self._lock:
+      self._histograms = {}
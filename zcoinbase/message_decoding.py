@@ -0,0 +1,177 @@
+# Decoding of raw websocket frames, with optional fast JSON backends.
+import importlib.util
+import json
+import re
+
+from collections.abc import Mapping
+from typing import Text, Callable, Union
+
+from .util import FrameType
+
+# Decoders that can be used on this environment, in order of preference for 'auto'.
+_DECODERS = {}
+
+# Use the fast JSON decoders if they are available on the environment.
+orjson_spec = importlib.util.find_spec('orjson')
+if orjson_spec is not None:
+  import orjson
+
+  _DECODERS['orjson'] = orjson.loads
+
+simdjson_spec = importlib.util.find_spec('simdjson')
+if simdjson_spec is not None:
+  import simdjson
+
+  _DECODERS['simdjson'] = simdjson.loads
+
+_DECODERS['json'] = json.loads
+
+# Decoders that can parse a memoryview without copying it to bytes first.
+_MEMORYVIEW_DECODERS = frozenset(['orjson'])
+
+# Coinbase always puts these fields at the top level of a message, and the 'type' field first, so the first match
+# in the frame is the one we want. Note that "order_type" doesn't match because of the leading quote.
+_TYPE_RE = re.compile(r'"type"\s*:\s*"([^"]*)"')
+_PRODUCT_ID_RE = re.compile(r'"product_id"\s*:\s*"([^"]*)"')
+_SEQUENCE_RE = re.compile(r'"sequence"\s*:\s*(\d+)')
+_TIME_RE = re.compile(r'"time"\s*:\s*"([^"]*)"')
+# The same, for frames that are bytes or memoryviews.
+_TYPE_BYTES_RE = re.compile(_TYPE_RE.pattern.encode())
+_PRODUCT_ID_BYTES_RE = re.compile(_PRODUCT_ID_RE.pattern.encode())
+_SEQUENCE_BYTES_RE = re.compile(_SEQUENCE_RE.pattern.encode())
+_TIME_BYTES_RE = re.compile(_TIME_RE.pattern.encode())
+
+# A raw websocket frame, see FrameType.
+Frame = Union[Text, bytes, memoryview]
+
+
+def available_json_decoders():
+  """Returns the names of the JSON decoders that can be used on this environment."""
+  return list(_DECODERS.keys())
+
+
+def get_json_decoder(decoder='auto', frame_type: FrameType = FrameType.TEXT) -> Callable:
+  """Returns a function that decodes a JSON frame.
+
+  Args:
+    decoder: One of 'auto', 'json', 'orjson' or 'simdjson', or a callable that takes the frame and returns the parsed
+      message. 'auto' picks the fastest decoder that is installed, and falls back to the python json module.
+    frame_type: (Default: TEXT) The type of the frames that will be decoded. Every decoder takes str and bytes, for
+      MEMORYVIEW frames decoders that can't read a memoryview get a copy of the bytes.
+  """
+  if callable(decoder):
+    return decoder
+  if decoder == 'auto':
+    decoder = available_json_decoders()[0]
+  if decoder not in _DECODERS:
+    raise ValueError('JSON decoder {} is not available, must be one of [{}]'.format(
+      decoder, ', '.join(['auto'] + available_json_decoders())))
+  decode = _DECODERS[decoder]
+  if frame_type == FrameType.MEMORYVIEW and decoder not in _MEMORYVIEW_DECODERS:
+    return lambda frame: decode(bytes(frame))
+  return decode
+
+
+def as_frame(frame: Frame, frame_type: FrameType):
+  """Converts a frame to the frame_type, without copying when it already is one."""
+  if frame_type == FrameType.TEXT:
+    return frame if isinstance(frame, str) else str(frame, 'utf-8')
+  if isinstance(frame, str):
+    frame = frame.encode('utf-8')
+  if frame_type == FrameType.MEMORYVIEW:
+    return frame if isinstance(frame, memoryview) else memoryview(frame)
+  return frame if isinstance(frame, bytes) else bytes(frame)
+
+
+def extract_message_type(message: Frame):
+  """Pulls the 'type' out of a raw frame without decoding it, returns None if there isn't one."""
+  if isinstance(message, str):
+    match = _TYPE_RE.search(message)
+    return match.group(1) if match else None
+  match = _TYPE_BYTES_RE.search(message)
+  return match.group(1).decode() if match else None
+
+
+def extract_product_id(message: Frame):
+  """Pulls the 'product_id' out of a raw frame without decoding it, returns None if there isn't one."""
+  if isinstance(message, str):
+    match = _PRODUCT_ID_RE.search(message)
+    return match.group(1) if match else None
+  match = _PRODUCT_ID_BYTES_RE.search(message)
+  return match.group(1).decode() if match else None
+
+
+def extract_sequence(message: Frame):
+  """Pulls the 'sequence' out of a raw frame without decoding it, returns None if there isn't one."""
+  if isinstance(message, str):
+    match = _SEQUENCE_RE.search(message)
+    return int(match.group(1)) if match else None
+  match = _SEQUENCE_BYTES_RE.search(message)
+  return int(match.group(1)) if match else None
+
+
+def extract_time(message: Frame):
+  """Pulls the 'time' out of a raw frame without decoding it, returns None if there isn't one."""
+  if isinstance(message, str):
+    match = _TIME_RE.search(message)
+    return match.group(1) if match else None
+  match = _TIME_BYTES_RE.search(message)
+  return match.group(1).decode() if match else None
+
+
+class LazyMessage(Mapping):
+  """A read-only message that only decodes the frame when a handler reads it.
+
+  The routing fields 'type', 'product_id' and 'sequence' are scanned out of the raw frame on their own, every other key
+  decodes the whole frame once and is then served from the decoded message.
+  """
+  __slots__ = ('raw', '_decoder', '_decoded', '_type', '_product_id', '_sequence')
+
+  _ROUTING_KEYS = frozenset(['type', 'product_id', 'sequence'])
+  _NOT_SCANNED = object()
+
+  def __init__(self, raw: Frame, decoder: Callable = json.loads):
+    self.raw = raw
+    self._decoder = decoder
+    self._decoded = None
+    self._type = extract_message_type(raw)
+    self._product_id = LazyMessage._NOT_SCANNED
+    self._sequence = LazyMessage._NOT_SCANNED
+
+  @property
+  def type(self):
+    return self._type
+
+  @property
+  def product_id(self):
+    if self._product_id is LazyMessage._NOT_SCANNED:
+      self._product_id = extract_product_id(self.raw) if self._decoded is None else self._decoded.get('product_id')
+    return self._product_id
+
+  @property
+  def sequence(self):
+    if self._sequence is LazyMessage._NOT_SCANNED:
+      self._sequence = extract_sequence(self.raw) if self._decoded is None else self._decoded.get('sequence')
+    return self._sequence
+
+  def decode(self):
+    """Decodes (once) and returns the full message."""
+    if self._decoded is None:
+      self._decoded = self._decoder(self.raw)
+    return self._decoded
+
+  def __getitem__(self, key):
+    if self._decoded is None and key in LazyMessage._ROUTING_KEYS:
+      value = getattr(self, key)
+      if value is not None:
+        return value
+    return self.decode()[key]
+
+  def __iter__(self):
+    return iter(self.decode())
+
+  def __len__(self):
+    return len(self.decode())
+
+  def __repr__(self):
+    return 'LazyMessage({})'.format(self.raw if isinstance(self.raw, (str, bytes)) else bytes(self.raw))
@@ -0,0 +1,234 @@
+# Typed records for the busiest websocket message types, numbers are converted once when the message is decoded.
+#
+# Documentation for the messages: https://docs.pro.coinbase.com/#channels
+from collections.abc import Mapping
+
+
+def _to_float(value):
+  return None if value is None else float(value)
+
+
+def _to_int(value):
+  return None if value is None else int(value)
+
+
+class TypedMessage(Mapping):
+  """Base class for typed messages.
+
+  Fields are attributes (msg.price), but the messages can also be read like the dicts they replace (msg['price']), so
+  existing functions keep working. Fields that weren't in the message are None, and missing from the mapping.
+  """
+  __slots__ = ()
+  type = None
+  _fields = ()
+
+  def __getitem__(self, key):
+    if key == 'type':
+      return self.type
+    if key in self._fields:
+      value = getattr(self, key)
+      if value is not None:
+        return value
+    raise KeyError(key)
+
+  def __iter__(self):
+    yield 'type'
+    for field in self._fields:
+      if getattr(self, field) is not None:
+        yield field
+
+  def __len__(self):
+    return 1 + sum(1 for field in self._fields if getattr(self, field) is not None)
+
+  def __repr__(self):
+    return '{}({})'.format(self.__class__.__name__,
+                           ', '.join('{}={!r}'.format(field, getattr(self, field)) for field in self._fields))
+
+
+class L2Update(TypedMessage):
+  """'l2update' message, changes are (side, price, size) tuples."""
+  __slots__ = _fields = ('product_id', 'time', 'changes')
+  type = 'l2update'
+
+  def __init__(self, product_id, time, changes):
+    self.product_id = product_id
+    self.time = time
+    self.changes = changes
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg['product_id'], msg.get('time'),
+               tuple((side, float(price), float(size)) for side, price, size in msg['changes']))
+
+
+class Snapshot(TypedMessage):
+  """'snapshot' message, bids and asks are (price, size) tuples."""
+  __slots__ = _fields = ('product_id', 'bids', 'asks')
+  type = 'snapshot'
+
+  def __init__(self, product_id, bids, asks):
+    self.product_id = product_id
+    self.bids = bids
+    self.asks = asks
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg['product_id'],
+               tuple((float(price), float(size)) for price, size in msg['bids']),
+               tuple((float(price), float(size)) for price, size in msg['asks']))
+
+
+class Match(TypedMessage):
+  __slots__ = _fields = ('trade_id', 'sequence', 'maker_order_id', 'taker_order_id', 'time', 'product_id', 'size',
+                         'price', 'side')
+  type = 'match'
+
+  def __init__(self, trade_id, sequence, maker_order_id, taker_order_id, time, product_id, size, price, side):
+    self.trade_id = trade_id
+    self.sequence = sequence
+    self.maker_order_id = maker_order_id
+    self.taker_order_id = taker_order_id
+    self.time = time
+    self.product_id = product_id
+    self.size = size
+    self.price = price
+    self.side = side
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg.get('trade_id'), msg.get('sequence'), msg.get('maker_order_id'), msg.get('taker_order_id'),
+               msg.get('time'), msg['product_id'], float(msg['size']), float(msg['price']), msg.get('side'))
+
+
+class Ticker(TypedMessage):
+  __slots__ = _fields = ('trade_id', 'sequence', 'time', 'product_id', 'price', 'side', 'last_size', 'best_bid',
+                         'best_ask', 'open_24h', 'volume_24h', 'low_24h', 'high_24h', 'volume_30d')
+  type = 'ticker'
+
+  def __init__(self, trade_id, sequence, time, product_id, price, side, last_size, best_bid, best_ask,
+               open_24h, volume_24h, low_24h, high_24h, volume_30d):
+    self.trade_id = trade_id
+    self.sequence = sequence
+    self.time = time
+    self.product_id = product_id
+    self.price = price
+    self.side = side
+    self.last_size = last_size
+    self.best_bid = best_bid
+    self.best_ask = best_ask
+    self.open_24h = open_24h
+    self.volume_24h = volume_24h
+    self.low_24h = low_24h
+    self.high_24h = high_24h
+    self.volume_30d = volume_30d
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg.get('trade_id'), msg.get('sequence'), msg.get('time'), msg['product_id'],
+               _to_float(msg.get('price')), msg.get('side'), _to_float(msg.get('last_size')),
+               _to_float(msg.get('best_bid')), _to_float(msg.get('best_ask')), _to_float(msg.get('open_24h')),
+               _to_float(msg.get('volume_24h')), _to_float(msg.get('low_24h')), _to_float(msg.get('high_24h')),
+               _to_float(msg.get('volume_30d')))
+
+
+class Received(TypedMessage):
+  """'received' message, limit orders have size and price, market orders have funds (and maybe size)."""
+  __slots__ = _fields = ('time', 'product_id', 'sequence', 'order_id', 'size', 'price', 'funds', 'side', 'order_type',
+                         'client_oid')
+  type = 'received'
+
+  def __init__(self, time, product_id, sequence, order_id, size, price, funds, side, order_type, client_oid):
+    self.time = time
+    self.product_id = product_id
+    self.sequence = sequence
+    self.order_id = order_id
+    self.size = size
+    self.price = price
+    self.funds = funds
+    self.side = side
+    self.order_type = order_type
+    self.client_oid = client_oid
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg.get('time'), msg['product_id'], msg.get('sequence'), msg['order_id'], _to_float(msg.get('size')),
+               _to_float(msg.get('price')), _to_float(msg.get('funds')), msg.get('side'), msg.get('order_type'),
+               msg.get('client_oid'))
+
+
+class Open(TypedMessage):
+  __slots__ = _fields = ('time', 'product_id', 'sequence', 'order_id', 'price', 'remaining_size', 'side')
+  type = 'open'
+
+  def __init__(self, time, product_id, sequence, order_id, price, remaining_size, side):
+    self.time = time
+    self.product_id = product_id
+    self.sequence = sequence
+    self.order_id = order_id
+    self.price = price
+    self.remaining_size = remaining_size
+    self.side = side
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg.get('time'), msg['product_id'], msg.get('sequence'), msg['order_id'], float(msg['price']),
+               float(msg['remaining_size']), msg.get('side'))
+
+
+class Done(TypedMessage):
+  """'done' message, market orders have no price or remaining_size."""
+  __slots__ = _fields = ('time', 'product_id', 'sequence', 'order_id', 'price', 'remaining_size', 'reason', 'side')
+  type = 'done'
+
+  def __init__(self, time, product_id, sequence, order_id, price, remaining_size, reason, side):
+    self.time = time
+    self.product_id = product_id
+    self.sequence = sequence
+    self.order_id = order_id
+    self.price = price
+    self.remaining_size = remaining_size
+    self.reason = reason
+    self.side = side
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg.get('time'), msg['product_id'], msg.get('sequence'), msg['order_id'], _to_float(msg.get('price')),
+               _to_float(msg.get('remaining_size')), msg.get('reason'), msg.get('side'))
+
+
+class Change(TypedMessage):
+  """'change' message, limit orders change size and market orders change funds."""
+  __slots__ = _fields = ('time', 'sequence', 'order_id', 'product_id', 'new_size', 'old_size', 'new_funds',
+                         'old_funds', 'price', 'side')
+  type = 'change'
+
+  def __init__(self, time, sequence, order_id, product_id, new_size, old_size, new_funds, old_funds, price, side):
+    self.time = time
+    self.sequence = sequence
+    self.order_id = order_id
+    self.product_id = product_id
+    self.new_size = new_size
+    self.old_size = old_size
+    self.new_funds = new_funds
+    self.old_funds = old_funds
+    self.price = price
+    self.side = side
+
+  @classmethod
+  def from_json(cls, msg):
+    return cls(msg.get('time'), msg.get('sequence'), msg['order_id'], msg['product_id'],
+               _to_float(msg.get('new_size')), _to_float(msg.get('old_size')), _to_float(msg.get('new_funds')),
+               _to_float(msg.get('old_funds')), _to_float(msg.get('price')), msg.get('side'))
+
+
+# Message type to the typed record it's decoded to.
+TYPED_MESSAGES = {message_class.type: message_class for message_class in
+                  [L2Update, Snapshot, Match, Ticker, Received, Open, Done, Change]}
+
+
+def decode_typed_message(msg):
+  """Converts a decoded message to its typed record, messages of other types are returned as they are."""
+  message_class = TYPED_MESSAGES.get(msg.get('type'))
+  if message_class is None:
+    return msg
+  return message_class.from_json(msg)
@@ -0,0 +1,84 @@
+# NumPy arrays of order book depth, for vectorized depth, slippage and imbalance calculations.
+import numpy as np
+
+
+class DepthArrays:
+  """The top levels of one side of an order book, best price first.
+
+  Only the first `levels` entries are filled, the rest of price is NaN, size is 0 and the cumulative arrays repeat
+  their last value, so the arrays can be reused for books of any depth.
+
+  Attributes:
+    price: Price of each level.
+    size: Size of each level.
+    cumulative_size: Total size of this level and every better one.
+    cumulative_notional: Total price * size of this level and every better one.
+    levels: The number of levels that are filled.
+  """
+  __slots__ = ('price', 'size', 'cumulative_size', 'cumulative_notional', 'levels')
+
+  def __init__(self, max_levels: int):
+    self.price = np.full(max_levels, np.nan)
+    self.size = np.zeros(max_levels)
+    self.cumulative_size = np.zeros(max_levels)
+    self.cumulative_notional = np.zeros(max_levels)
+    self.levels = 0
+
+  def __len__(self):
+    return len(self.price)
+
+  def fill(self, prices, sizes):
+    """Fills the arrays from sequences of prices and sizes (best first), without allocating new arrays."""
+    levels = min(len(prices), len(self.price))
+    self.levels = levels
+    self.price[:levels] = prices[:levels]
+    self.price[levels:] = np.nan
+    self.size[:levels] = sizes[:levels]
+    self.size[levels:] = 0.0
+    np.cumsum(self.size[:levels], out=self.cumulative_size[:levels])
+    np.multiply(self.price[:levels], self.size[:levels], out=self.cumulative_notional[:levels])
+    np.cumsum(self.cumulative_notional[:levels], out=self.cumulative_notional[:levels])
+    self.cumulative_size[levels:] = self.cumulative_size[levels - 1] if levels else 0.0
+    self.cumulative_notional[levels:] = self.cumulative_notional[levels - 1] if levels else 0.0
+    return self
+
+  def best_price(self):
+    return self.price[0] if self.levels else np.nan
+
+
+def average_fill_price(depth: DepthArrays, quantity: float):
+  """The average price of taking quantity from the levels, NaN if there isn't enough depth."""
+  levels = depth.levels
+  index = np.searchsorted(depth.cumulative_size[:levels], quantity)
+  if index >= levels or quantity <= 0:
+    return np.nan
+  filled = depth.cumulative_size[index - 1] if index else 0.0
+  notional = depth.cumulative_notional[index - 1] if index else 0.0
+  return (notional + (quantity - filled) * depth.price[index]) / quantity
+
+
+def slippage_bps(depth: DepthArrays, quantity: float, reference_price: float = None):
+  """How far (in basis points) the average fill price of quantity is from the reference price, the best price by
+  default. NaN if there isn't enough depth."""
+  if reference_price is None:
+    reference_price = depth.best_price()
+  return abs(average_fill_price(depth, quantity) - reference_price) / reference_price * 1e4
+
+
+def depth_within_bps(depth: DepthArrays, bps: float, reference_price: float = None):
+  """Total size of the levels within bps of the reference price, the best price by default."""
+  if reference_price is None:
+    reference_price = depth.best_price()
+  levels = depth.levels
+  within = np.abs(depth.price[:levels] - reference_price) <= reference_price * bps / 1e4
+  return float(depth.size[:levels][within].sum())
+
+
+def imbalance(bids: DepthArrays, asks: DepthArrays, levels: int = None):
+  """(bid size - ask size) / (bid size + ask size) over the top levels (all filled levels by default), in [-1, 1]."""
+  bid_levels = bids.levels if levels is None else min(levels, bids.levels)
+  ask_levels = asks.levels if levels is None else min(levels, asks.levels)
+  bid_size = bids.cumulative_size[bid_levels - 1] if bid_levels else 0.0
+  ask_size = asks.cumulative_size[ask_levels - 1] if ask_levels else 0.0
+  total = bid_size + ask_size
+  return (bid_size - ask_size) / total if total else 0.0
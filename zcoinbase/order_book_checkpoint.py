@@ -0,0 +1,225 @@
+# Compact binary checkpoints of level2 order books, so a restarted process can serve its books before the live
+# snapshots arrive.
+#
+# A checkpoint file is a header followed by a zlib compressed block with a record per book:
+#   header: magic (4s), format version (H), book count (I), checkpoint time in ns (Q), compressed length (I)
+#   book:   product_id length (H), bid count (I), ask count (I), prices length (I), product_id, prices (the bid and
+#           ask prices as newline separated ascii, best first), sizes (bids then asks, little endian doubles)
+# Checkpoints are written to a temporary file that replaces the previous checkpoint, so a crash never leaves a partial
+# checkpoint behind.
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from array import array
+from decimal import Decimal
+from typing import Text
+
+from .coinbase_order_book import CoinbaseOrderBook
+from .feed_recorder import FeedRecorder, FeedReplayer
+
+_CHECKPOINT_MAGIC = b'ZCBK'
+_CHECKPOINT_VERSION = 1
+_CHECKPOINT_HEADER = struct.Struct('<4sHIQI')
+_BOOK_HEADER = struct.Struct('<HIII')
+
+
+def _price_string(price):
+  if isinstance(price, str):
+    return price
+  # str() of a small float is in exponent notation (e.g. 1.234e-05), which tick books can't load.
+  return format(Decimal(str(price)), 'f')
+
+
+def write_checkpoint(path: Text, books, timestamp_ns: int = None, compression_level: int = 1):
+  """Writes the books to a checkpoint file.
+
+  Args:
+    path: The checkpoint file, it's replaced atomically.
+    books: Dict of product_id to (bids, asks), each a sequence of (price, size) best first.
+    timestamp_ns: (optional) Time of the checkpoint (ns since the epoch), by default now.
+    compression_level: (Default: 1) zlib compression level, 1 is the fastest.
+  """
+  payload = bytearray()
+  for product_id, (bids, asks) in books.items():
+    product_bytes = product_id.encode('utf-8')
+    prices = '\n'.join(_price_string(price) for price, _ in list(bids) + list(asks)).encode('ascii')
+    sizes = array('d', [float(size) for _, size in bids])
+    sizes.extend(float(size) for _, size in asks)
+    if sys.byteorder != 'little':
+      sizes.byteswap()
+    payload += _BOOK_HEADER.pack(len(product_bytes), len(bids), len(asks), len(prices))
+    payload += product_bytes
+    payload += prices
+    payload += sizes.tobytes()
+  compressed = zlib.compress(bytes(payload), compression_level)
+  temporary_path = '{}.tmp'.format(path)
+  with open(temporary_path, 'wb') as checkpoint_file:
+    checkpoint_file.write(_CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, _CHECKPOINT_VERSION, len(books),
+                                                  time.time_ns() if timestamp_ns is None else timestamp_ns,
+                                                  len(compressed)))
+    checkpoint_file.write(compressed)
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+  os.replace(temporary_path, path)
+
+
+def read_checkpoint(path: Text):
+  """Reads a checkpoint file written by write_checkpoint.
+
+  Returns:
+    A tuple of (checkpoint time in ns, dict of product_id to (bids, asks)), the prices are strings.
+  """
+  with open(path, 'rb') as checkpoint_file:
+    magic, version, book_count, timestamp_ns, compressed_length = _CHECKPOINT_HEADER.unpack(
+      checkpoint_file.read(_CHECKPOINT_HEADER.size))
+    if magic != _CHECKPOINT_MAGIC or version != _CHECKPOINT_VERSION:
+      raise ValueError('{} is not an order book checkpoint'.format(path))
+    payload = memoryview(zlib.decompress(checkpoint_file.read(compressed_length)))
+  books = {}
+  position = 0
+  for _ in range(book_count):
+    product_length, bid_count, ask_count, prices_length = _BOOK_HEADER.unpack_from(payload, position)
+    position += _BOOK_HEADER.size
+    product_id = bytes(payload[position:position + product_length]).decode('utf-8')
+    position += product_length
+    prices = bytes(payload[position:position + prices_length]).decode('ascii').split('\n') if prices_length else []
+    position += prices_length
+    sizes = array('d')
+    sizes.frombytes(payload[position:position + 8 * (bid_count + ask_count)])
+    if sys.byteorder != 'little':
+      sizes.byteswap()
+    position += 8 * (bid_count + ask_count)
+    levels = list(zip(prices, sizes))
+    books[product_id] = (levels[:bid_count], levels[bid_count:])
+  return timestamp_ns, books
+
+
+class OrderBookCheckpointer:
+  """Periodically checkpoints the books of a CoinbaseOrderBook, and restores them after a restart.
+
+  Usage:
+    cb_ws = CoinbaseWebsocket(products_to_listen=['BTC-USD', 'ETH-USD'], autostart=False)
+    order_book = CoinbaseOrderBook(cb_ws)
+    checkpointer = OrderBookCheckpointer(order_book, '/data/books.zcbk', journal_directory='/data/journal')
+    checkpointer.restore()  # Before starting the websocket.
+    checkpointer.start()
+    cb_ws.start_websocket_in_thread()
+
+  Restored books can be read right away (their restored attribute is True), but they aren't valid until the live
+  snapshot replaces them: level2 messages have no sequence, so a checkpoint can't be reconciled with the live feed.
+  With a journal, the frames received after the last checkpoint are replayed on top of it, so the restored books are
+  as fresh as when the process stopped.
+  """
+
+  def __init__(self, order_book: CoinbaseOrderBook, path: Text, interval: float = 60.0,
+               journal_directory: Text = None, compression_level: int = 1):
+    """Args:
+      order_book: The books to checkpoint.
+      path: The checkpoint file.
+      interval: (Default: 60.0) Seconds between checkpoints, once started.
+      journal_directory: (optional) Also record the websocket's frames to a FeedRecorder log in this directory, the
+        frames from before the last checkpoint are deleted after every checkpoint.
+      compression_level: (Default: 1) zlib compression level, 1 is the fastest.
+    """
+    self.order_book = order_book
+    self.path = path
+    self.interval = interval
+    self.journal_directory = journal_directory
+    self.compression_level = compression_level
+    self.checkpoints_written = 0
+    self.last_checkpoint_ns = None
+    self._journal = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    """Starts the journal (if there is one) and checkpointing every interval."""
+    if self.journal_directory is not None and self._journal is None:
+      self._journal = FeedRecorder(self.journal_directory, prefix='journal', rotate_interval=self.interval)
+      self._journal.attach(self.order_book.coinbase_websocket)
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name='OrderBookCheckpointer', daemon=True)
+    self._thread.start()
+
+  def checkpoint(self):
+    """Writes a checkpoint of every valid book now.
+
+    Returns:
+      The number of books in the checkpoint.
+    """
+    timestamp_ns = time.time_ns()
+    books = {}
+    for product_id in list(self.order_book.get_tracked_products()):
+      book = self.order_book.get_order_book(product_id)
+      # Books that are out of sync would overwrite a good checkpoint with a stale one.
+      if book.is_valid():
+        snapshot = book.get_snapshot()
+        books[product_id] = (snapshot.bids, snapshot.asks)
+    write_checkpoint(self.path, books, timestamp_ns=timestamp_ns, compression_level=self.compression_level)
+    self.checkpoints_written += 1
+    self.last_checkpoint_ns = timestamp_ns
+    if self._journal is not None:
+      self._journal.delete_before(timestamp_ns)
+    return len(books)
+
+  def restore(self):
+    """Loads the books from the checkpoint (and the journal after it), call before starting the websocket.
+
+    Returns:
+      The product_ids that were restored, books that already have a live snapshot are left alone.
+    """
+    if not os.path.exists(self.path):
+      return []
+    timestamp_ns, books = read_checkpoint(self.path)
+    journals = {product_id: [] for product_id in books}
+    if self.journal_directory is not None and os.path.isdir(self.journal_directory):
+
+      def on_snapshot(message):
+        # A snapshot in the journal replaces the checkpointed book.
+        books[message['product_id']] = (message['bids'], message['asks'])
+        journals[message['product_id']] = []
+
+      def on_l2update(message):
+        if message['product_id'] in journals:
+          journals[message['product_id']].append(message['changes'])
+
+      FeedReplayer(self.journal_directory, prefix='journal').replay({'snapshot': on_snapshot, 'l2update': on_l2update},
+                                                                    start_time_ns=timestamp_ns)
+    restored = []
+    for product_id, (bids, asks) in books.items():
+      if product_id not in self.order_book.get_tracked_products():
+        continue
+      book = self.order_book.get_order_book(product_id)
+      if book.is_valid():
+        continue
+      try:
+        book._restore(bids, asks, journals[product_id])
+      except Exception:
+        # The other books can still be restored, this one waits for its live snapshot.
+        logging.exception('Failed to restore the order book for {} from {}'.format(product_id, self.path))
+        continue
+      restored.append(product_id)
+    return restored
+
+  def close(self):
+    """Stops checkpointing, writes a final checkpoint and closes the journal."""
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+      self.checkpoint()
+    if self._journal is not None:
+      self._journal.close()
+      self._journal = None
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      try:
+        self.checkpoint()
+      except Exception:
+        logging.exception('Failed to checkpoint the order books to {}'.format(self.path))
@@ -0,0 +1,286 @@
+# Worker processes that own order books, for CoinbaseOrderBook(mode='processes').
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import uuid
+
+from concurrent.futures import Future
+from typing import Text, Callable
+
+
+def _run_book_worker(order_book_factory, commands, events):
+  """Runs in the worker process: applies the commands to the books it owns, sends results and callbacks back."""
+  books = {}
+  # Debounced callbacks send from their timer threads.
+  send_lock = threading.Lock()
+  callback_identifiers = {}
+
+  def send(event):
+    with send_lock:
+      events.send(event)
+
+  def get_book(product_id):
+    book = books.get(product_id)
+    if book is None:
+      book = books[product_id] = order_book_factory(product_id)
+    return book
+
+  def make_forwarder(product_id, identifier):
+    def forward(book, changes=None):
+      send(('callback', product_id, identifier, changes))
+    return forward
+
+  def send_top_of_book(book):
+    top_of_book = book.top_of_book
+    send(('top_of_book', book.product_id, (top_of_book.best_bid, top_of_book.best_bid_size, top_of_book.best_ask,
+                                           top_of_book.best_ask_size)))
+
+  while True:
+    try:
+      command = commands.recv()
+    except (EOFError, OSError):
+      return
+    kind = command[0]
+    try:
+      if kind == 'changes':
+        _, product_id, changes = command
+        if not get_book(product_id)._consume_changes(changes):
+          send(('resync', product_id))
+      elif kind == 'snapshot':
+        _, product_id, bids, asks = command
+        get_book(product_id)._init_book(bids, asks)
+      elif kind == 'restore':
+        _, product_id, bids, asks, journal = command
+        get_book(product_id)._restore(bids, asks, journal)
+      elif kind == 'invalidate':
+        _, product_id, buffer_changes = command
+        get_book(product_id)._invalidate(buffer_changes)
+      elif kind == 'query':
+        _, request_id, product_id, method, args = command
+        try:
+          value = getattr(get_book(product_id), method)
+          send(('result', request_id, value(*args) if callable(value) else value, None))
+        except Exception as e:
+          send(('result', request_id, None, e))
+      elif kind == 'add_callback':
+        _, product_id, identifier, min_interval_ms, top_k, deltas = command
+        callback_identifiers[identifier] = get_book(product_id).add_update_callback(
+          make_forwarder(product_id, identifier), min_interval_ms=min_interval_ms, top_k=top_k, deltas=deltas)
+      elif kind == 'track_top_of_book':
+        _, product_id = command
+        get_book(product_id).add_update_callback(send_top_of_book)
+      elif kind == 'remove_callback':
+        _, product_id, identifier = command
+        get_book(product_id).remove_update_callback(callback_identifiers.pop(identifier))
+      elif kind == 'stop':
+        return
+    except Exception:
+      logging.exception('Order book worker failed to run {}'.format(kind))
+
+
+class BookWorkerProcess:
+  """A process that owns the order books of some products, see CoinbaseOrderBook(mode='processes').
+
+  Changes are sent to the process without waiting. Queries wait for the process to answer. Callbacks run in this
+  process on a thread per worker, in the order the worker's books were updated, so they can query the books.
+  """
+
+  def __init__(self, order_book_factory: Callable, on_resync: Callable[[Text], None] = None,
+               on_top_of_book: Callable = None, name='BookWorker'):
+    """Args:
+      order_book_factory: Makes the order book for a product_id in the worker, it must be picklable unless the
+        processes are forked.
+      on_resync: (optional) Called with the product_id when a book went out of sync.
+      on_top_of_book: (optional) Called on the reader thread with the product_id and (best bid, best bid size, best ask,
+        best ask size) after every change to a book that was sent a 'track_top_of_book' command.
+    """
+    self.on_resync = on_resync
+    self.on_top_of_book = on_top_of_book
+    # Pipe returns (receiving end, sending end).
+    child_commands, self._commands = multiprocessing.Pipe(duplex=False)
+    self._events, child_events = multiprocessing.Pipe(duplex=False)
+    self._send_lock = threading.Lock()
+    self._results = {}
+    self._request_ids = itertools.count()
+    self._callbacks = {}
+    self._callback_queue = queue.Queue()
+    self.process = multiprocessing.Process(target=_run_book_worker, args=(order_book_factory, child_commands,
+                                                                          child_events),
+                                           name=name, daemon=True)
+    self.process.start()
+    child_commands.close()
+    child_events.close()
+    self._reader = threading.Thread(target=self._read_events, name='{}-reader'.format(name), daemon=True)
+    self._reader.start()
+    self._callback_thread = threading.Thread(target=self._run_callbacks, name='{}-callbacks'.format(name),
+                                             daemon=True)
+    self._callback_thread.start()
+
+  def send(self, command):
+    with self._send_lock:
+      self._commands.send(command)
+
+  def query(self, product_id, method, *args):
+    """Calls the method of the product's book in the worker and returns its result, or the attribute's value."""
+    result = Future()
+    request_id = next(self._request_ids)
+    self._results[request_id] = result
+    try:
+      self.send(('query', request_id, product_id, method, args))
+    except (OSError, ValueError) as e:
+      del self._results[request_id]
+      raise RuntimeError('The order book worker was closed') from e
+    return result.result()
+
+  def add_callback(self, product_id, callback, min_interval_ms=None, top_k=None, deltas=False, proxy=None):
+    identifier = str(uuid.uuid4())
+    self._callbacks[identifier] = (callback, deltas, proxy)
+    self.send(('add_callback', product_id, identifier, min_interval_ms, top_k, deltas))
+    return identifier
+
+  def remove_callback(self, product_id, identifier):
+    del self._callbacks[identifier]
+    self.send(('remove_callback', product_id, identifier))
+
+  def close(self):
+    try:
+      self.send(('stop',))
+    except (OSError, ValueError):
+      pass
+    self.process.join()
+    self._commands.close()
+    self._reader.join()
+    self._callback_queue.put(None)
+    self._callback_thread.join()
+
+  def _read_events(self):
+    while True:
+      try:
+        event = self._events.recv()
+      except (EOFError, OSError):
+        break
+      if event[0] == 'top_of_book':
+        if self.on_top_of_book is not None:
+          self.on_top_of_book(event[1], event[2])
+      elif event[0] == 'result':
+        _, request_id, result, exception = event
+        future = self._results.pop(request_id)
+        if exception is None:
+          future.set_result(result)
+        else:
+          future.set_exception(exception)
+      else:
+        self._callback_queue.put(event)
+    # The worker is gone, nothing will answer the queries that are waiting.
+    for request_id in list(self._results):
+      self._results.pop(request_id).set_exception(RuntimeError('The order book worker stopped'))
+
+  def _run_callbacks(self):
+    while True:
+      event = self._callback_queue.get()
+      if event is None:
+        return
+      try:
+        if event[0] == 'callback':
+          _, product_id, identifier, changes = event
+          if identifier in self._callbacks:
+            callback, deltas, proxy = self._callbacks[identifier]
+            if deltas:
+              callback(proxy, changes)
+            else:
+              callback(proxy)
+        elif event[0] == 'resync' and self.on_resync is not None:
+          self.on_resync(event[1])
+      except Exception:
+        logging.exception('Exception raised by an order book callback')
+
+
+class ProductOrderBookProxy:
+  """Stands in for a ProductOrderBook that is owned by a BookWorkerProcess, every read is answered by the worker.
+
+  Has the public API of ProductOrderBook, methods of subclasses (e.g. TickProductOrderBook.get_bids_ticks) can be
+  called with query.
+  """
+
+  def __init__(self, product_id, worker: BookWorkerProcess):
+    self.product_id = product_id
+    self.worker = worker
+    self.resyncs = 0
+
+  def query(self, method, *args):
+    """Calls the method of the book in the worker and returns its result, or the attribute's value."""
+    return self.worker.query(self.product_id, method, *args)
+
+  @property
+  def version(self):
+    return self.query('version')
+
+  @property
+  def restored(self):
+    return self.query('restored')
+
+  @property
+  def top_of_book(self):
+    return self.query('top_of_book')
+
+  def get_top_of_book(self):
+    return self.query('get_top_of_book')
+
+  def is_valid(self):
+    return self.query('is_valid')
+
+  def add_update_callback(self, callback: Callable, min_interval_ms: float = None, top_k: int = None,
+                          deltas: bool = False):
+    """See ProductOrderBook.add_update_callback, the callback is called with this proxy."""
+    return self.worker.add_callback(self.product_id, callback, min_interval_ms=min_interval_ms, top_k=top_k,
+                                    deltas=deltas, proxy=self)
+
+  def remove_update_callback(self, identifier: Text):
+    self.worker.remove_callback(self.product_id, identifier)
+
+  def get_snapshot(self, top_n=None):
+    return self.query('get_snapshot', top_n)
+
+  def top_n_string(self, n=None):
+    return self.query('top_n_string', n)
+
+  def get_book(self, top_n=None):
+    return self.query('get_book', top_n)
+
+  def get_asks(self, top_n=None):
+    return self.query('get_asks', top_n)
+
+  def get_bids(self, top_n=None):
+    return self.query('get_bids', top_n)
+
+  def get_bids_array(self, top_n, out=None):
+    return self._fill(self.query('get_bids_array', top_n), out)
+
+  def get_asks_array(self, top_n, out=None):
+    return self._fill(self.query('get_asks_array', top_n), out)
+
+  def __repr__(self):
+    return self.top_n_string()
+
+  # Private API Below this Line, used by CoinbaseOrderBook to update the book in the worker.
+  @staticmethod
+  def _fill(arrays, out):
+    if out is None:
+      return arrays
+    return out.fill(arrays.price[:arrays.levels], arrays.size[:arrays.levels])
+
+  def _consume_changes(self, changes):
+    # The worker reports books that went out of sync itself.
+    self.worker.send(('changes', self.product_id, changes))
+    return True
+
+  def _init_book(self, bids, asks):
+    self.worker.send(('snapshot', self.product_id, bids, asks))
+
+  def _restore(self, bids, asks, journal=()):
+    self.worker.send(('restore', self.product_id, bids, asks, list(journal)))
+
+  def _invalidate(self, buffer_changes=False):
+    self.worker.send(('invalidate', self.product_id, buffer_changes))
@@ -32,7 +32,7 @@ class PublicClient(RestClient):
     return self._send_get('products/{}'.format(product_id))
 
   def get_order_book(self, product_id, level=1):
-    if 1 <= level >= 3:
+    if not 1 <= level <= 3:
       raise ValueError('Level must be between 1 and three.')
     params = {'level': level}
     return self._send_get('products/{}/book'.format(product_id), params=params)
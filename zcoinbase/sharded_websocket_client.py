@@ -0,0 +1,402 @@
+import logging
+import threading
+import time
+
+from collections import Counter
+from collections.abc import Mapping
+from functools import partial
+from typing import Text, Callable
+
+from .util import LogLevel
+from .message_decoding import extract_message_type, extract_product_id, extract_sequence, LazyMessage
+from .websocket_client import CoinbaseWebsocket, _UNSUBSCRIBABLE_CHANNELS
+
+
+class _Handover:
+  """State of a product that is moving from one shard to another."""
+  __slots__ = ('old_shard', 'new_shard', 'sequenced', 'started', 'last_sequence', 'buffer')
+
+  def __init__(self, old_shard, new_shard, sequenced=False):
+    self.old_shard = old_shard
+    self.new_shard = new_shard
+    # Whether the product's messages carry gapless sequences ("full"), the shards have to line up by them.
+    self.sequenced = sequenced
+    self.started = time.monotonic()
+    # Last sequence delivered from the old shard.
+    self.last_sequence = None
+    # Messages received on the new shard while the old shard still owns the product, (sequence, message).
+    self.buffer = []
+
+
+class ShardedCoinbaseWebsocket:
+  """Spreads products over several CoinbaseWebsockets, and merges their messages into a single channels_to_function.
+
+  Each shard is its own connection and thread, so the feed for many products isn't limited by a single socket.
+  Products can be moved between shards (rebalance moves the busiest ones), the product is subscribed on its new shard
+  before it is unsubscribed from the old one, and the message streams are stitched together by sequence so that
+  nothing is lost or delivered twice. Products without sequence numbers (e.g. level2) switch over when the new shard
+  gets its first message, which is the snapshot for level2.
+
+  This has the same API as CoinbaseWebsocket for subscriptions, so it can be used with CoinbaseOrderBook,
+  CoinbaseLevel3OrderBook and FeedReplayer.
+  """
+
+  def __init__(self, websocket_addr=CoinbaseWebsocket.PROD_ADDRESS,
+               products_to_listen: list[Text] = None,
+               channels_to_function: dict[Text, list[Callable]] = None,
+               extra_channels: list[Text] = None,
+               shards: int = 2,
+               rebalance_interval: float = None,
+               rebalance_tolerance: float = 0.2,
+               handover_timeout: float = 10.0,
+               autostart: bool = True,
+               log_level: LogLevel = LogLevel.BASIC_MESSAGES,
+               **websocket_kwargs):
+    """Constructor for the ShardedCoinbaseWebsocket.
+
+    Args:
+      websocket_addr: The address to subscribe to.
+      products_to_listen: Products to subscribe to, spread round-robin over the shards to start with.
+      channels_to_function: Map of Channels to Functions, see CoinbaseWebsocket. Functions are called from the
+        thread of whichever shard got the message, so functions for different products can run at the same time.
+      extra_channels: Extra channels to subscribe to without a function.
+      shards: (Default: 2) The number of websocket connections to use.
+      rebalance_interval: (optional) Seconds between automatic calls to rebalance, by default only rebalance when
+        it's called.
+      rebalance_tolerance: (Default: 0.2) Only move products when the busiest shard gets this fraction more messages
+        than the average shard.
+      handover_timeout: (Default: 10.0) Seconds to wait for the shards to line up when a product is moved before
+        switching over anyway.
+      autostart: (Default: True) Start the websockets by default.
+      log_level: (Default: BASIC_MESSAGES) The LOG_LEVEL to use for this class and the shards.
+      **websocket_kwargs: Passed on to each shard's CoinbaseWebsocket (e.g. lazy_json, auto_reconnect, api_key).
+    """
+    if shards < 1:
+      raise ValueError('Must have at least one shard.')
+    if products_to_listen is None:
+      products_to_listen = []
+    if channels_to_function is None:
+      channels_to_function = {}
+    if extra_channels is None:
+      extra_channels = []
+    self.websocket_addr = websocket_addr
+    self.products_to_listen = list(products_to_listen)
+    self.channels_to_function = channels_to_function
+    self.extra_channels = extra_channels
+    self.rebalance_tolerance = rebalance_tolerance
+    self.handover_timeout = handover_timeout
+    self.log_level = log_level
+    self._dispatch_table = CoinbaseWebsocket.make_dispatch_table(self.channels_to_function)
+    # Product to index of the shard whose messages are delivered for it.
+    self._owners = {}
+    self._handovers = {}
+    # Taken for ownership changes, and for messages of products that are being moved. Functions are never called with
+    # it held, so they can add and move products.
+    self._lock = threading.Lock()
+    # Keeps the messages of products that are being moved in order, while they're passed to the functions.
+    self._handover_delivery_lock = threading.Lock()
+    # A Counter per shard, each only changed by its shard's thread.
+    self._message_counts = [Counter() for _ in range(shards)]
+    self._counts_since = time.monotonic()
+    self._moves = 0
+    # Set while at least one of the shards is connected.
+    self.ws_opened = threading.Event()
+    self.shards = []
+    for index in range(shards):
+      self.shards.append(CoinbaseWebsocket(
+        websocket_addr=websocket_addr,
+        products_to_listen=[],
+        channels_to_function={
+          'all_messages': [partial(self._on_shard_message, index)],
+          'open_websocket': [self._on_shard_open],
+          'close_websocket': [self._on_shard_close],
+          'error': [self._on_shard_error],
+        },
+        extra_channels=self._get_subscribed_channels(),
+        autostart=False,
+        log_level=log_level,
+        **websocket_kwargs))
+    self.frame_type = self.shards[0].frame_type
+    for index, product in enumerate(self.products_to_listen):
+      self._owners[product] = index % shards
+      self.shards[index % shards].products_to_listen.append(product)
+    self._rebalance_stop = threading.Event()
+    self._rebalance_thread = None
+    if rebalance_interval:
+      self._rebalance_thread = threading.Thread(target=self._rebalance_periodically, args=(rebalance_interval,),
+                                                daemon=True)
+      self._rebalance_thread.start()
+    if autostart:
+      self.start_websocket_in_thread()
+
+  def start_websocket_in_thread(self):
+    for shard in self.shards:
+      shard.start_websocket_in_thread()
+
+  def close_websocket(self):
+    self._rebalance_stop.set()
+    for shard in self.shards:
+      shard.close_websocket()
+
+  def wait_for_open(self):
+    for shard in self.shards:
+      shard.wait_for_open()
+
+  def on_message(self, ws, message):
+    """Handles a frame as if the shard that owns its product received it, e.g. frames replayed by FeedReplayer."""
+    _, product_id = ShardedCoinbaseWebsocket._get_routing_fields(message)
+    with self._lock:
+      shard_index = self._owners.get(product_id, 0)
+    self.shards[shard_index].on_message(ws, message)
+
+  def add_channel_function(self, channel, function, refresh_subscriptions=None):
+    if channel in self.channels_to_function:
+      functions = self.channels_to_function[channel]
+      if isinstance(functions, list):
+        functions.append(function)
+      else:
+        self.channels_to_function[channel] = [functions, function]
+    else:
+      self.channels_to_function[channel] = [function]
+      if channel not in _UNSUBSCRIBABLE_CHANNELS:
+        for shard in self.shards:
+          shard.add_channel(channel)
+      if refresh_subscriptions is None:
+        refresh_subscriptions = True
+    self._dispatch_table = CoinbaseWebsocket.make_dispatch_table(self.channels_to_function)
+    if refresh_subscriptions:
+      self.subscribe()
+
+  def add_channel(self, channel, refresh_subscriptions=True):
+    self.extra_channels.append(channel)
+    for shard in self.shards:
+      shard.add_channel(channel)
+
+  def add_product(self, product, refresh_subscriptions=True):
+    """Adds a product to the shard with the fewest products."""
+    with self._lock:
+      if product in self._owners:
+        return
+      shard_products = Counter(self._owners.values())
+      index = min(range(len(self.shards)), key=lambda i: shard_products[i])
+      self._owners[product] = index
+      self.products_to_listen.append(product)
+    self.shards[index].add_product(product, refresh_subscriptions=refresh_subscriptions)
+
+  def remove_product(self, product, refresh_subscriptions=True):
+    with self._lock:
+      if product not in self._owners:
+        return
+      index = self._owners.pop(product)
+      handover = self._handovers.pop(product, None)
+      self.products_to_listen.remove(product)
+    self.shards[index].remove_product(product, refresh_subscriptions=refresh_subscriptions)
+    if handover is not None:
+      self.shards[handover.new_shard].remove_product(product, refresh_subscriptions=refresh_subscriptions)
+
+  def add_authentication(self, api_key, api_secret, passphrase):
+    for shard in self.shards:
+      shard.add_authentication(api_key, api_secret, passphrase)
+
+  def subscribe(self):
+    for shard in self.shards:
+      if shard.ws_opened.is_set():
+        shard.subscribe()
+
+  def resubscribe(self, channel, product_ids):
+    """Resubscribes the products to the channel, on the shards that own them."""
+    with self._lock:
+      shard_products = {}
+      for product in product_ids:
+        if product in self._owners:
+          shard_products.setdefault(self._owners[product], []).append(product)
+    for shard_index, products in shard_products.items():
+      self.shards[shard_index].resubscribe(channel, products)
+
+  def get_connection_products(self, ws=None):
+    """Returns the products owned by the shard whose connection is ws (as passed to the 'open_websocket' functions).
+
+    Every product is returned if ws isn't the connection of one of the shards.
+    """
+    with self._lock:
+      for shard_index, shard in enumerate(self.shards):
+        if shard.ws is ws:
+          return {product for product, owner in self._owners.items() if owner == shard_index}
+      return set(self._owners)
+
+  def move_product(self, product, shard_index):
+    """Moves a product to another shard, without losing or repeating any of its messages."""
+    with self._lock:
+      old_shard = self._owners.get(product)
+      if old_shard is None or old_shard == shard_index or product in self._handovers:
+        return
+      self._handovers[product] = _Handover(old_shard, shard_index, sequenced=self._has_full_channel())
+      self._moves += 1
+    if self.log_level >= LogLevel.VERBOSE_LOG:
+      logging.info('Moving {} from shard {} to shard {}'.format(product, old_shard, shard_index))
+    self.shards[shard_index].add_product(product)
+
+  def rebalance(self):
+    """Spreads the products over the shards by the rate of messages seen since the last rebalance.
+
+    Returns:
+      The number of products that were moved.
+    """
+    with self._lock:
+      counts = sum(self._message_counts, Counter())
+      self._message_counts = [Counter() for _ in self.shards]
+      self._counts_since = time.monotonic()
+      owners = dict(self._owners)
+      moving = set(self._handovers.keys())
+    loads = [0] * len(self.shards)
+    for product, shard_index in owners.items():
+      loads[shard_index] += counts[product]
+    average_load = sum(loads) / len(loads)
+    if not average_load or max(loads) <= average_load * (1 + self.rebalance_tolerance):
+      return 0
+    # Greedy: the busiest products first, each to the least loaded shard, staying put when that's as good.
+    loads = [0] * len(self.shards)
+    moves = []
+    for product in sorted(owners.keys(), key=lambda p: counts[p], reverse=True):
+      current = owners[product]
+      target = min(range(len(loads)), key=lambda i: loads[i])
+      if loads[current] <= loads[target] or product in moving:
+        target = current
+      loads[target] += counts[product]
+      if target != current:
+        moves.append((product, target))
+    for product, target in moves:
+      self.move_product(product, target)
+    return len(moves)
+
+  def get_shard_stats(self):
+    """Returns the products and message rates of each shard."""
+    with self._lock:
+      elapsed = max(time.monotonic() - self._counts_since, 1e-9)
+      stats = [{'products': [], 'messages_per_second': 0.0} for _ in self.shards]
+      counts = sum(self._message_counts, Counter())
+      for product, shard_index in self._owners.items():
+        stats[shard_index]['products'].append(product)
+        stats[shard_index]['messages_per_second'] += counts[product] / elapsed
+      for shard_stats, shard in zip(stats, self.shards):
+        shard_stats['connection'] = shard.get_connection_stats()
+      return {'shards': stats, 'moving': list(self._handovers.keys()), 'moves': self._moves}
+
+  def _get_subscribed_channels(self):
+    return [channel for channel in self.channels_to_function.keys() if
+            channel not in _UNSUBSCRIBABLE_CHANNELS] + self.extra_channels
+
+  def _rebalance_periodically(self, interval):
+    while not self._rebalance_stop.wait(timeout=interval):
+      self.rebalance()
+
+  def _call_special_functions(self, channel, argument):
+    if channel in self.channels_to_function:
+      for function in CoinbaseWebsocket._functions_as_tuple(self.channels_to_function[channel]):
+        function(argument)
+
+  def _on_shard_open(self, ws):
+    with self._lock:
+      self.ws_opened.set()
+    self._call_special_functions('open_websocket', ws)
+
+  def _on_shard_close(self, ws):
+    with self._lock:
+      if not any(shard.ws_opened.is_set() for shard in self.shards):
+        self.ws_opened.clear()
+    self._call_special_functions('close_websocket', ws)
+
+  def _on_shard_error(self, err):
+    # Coinbase "error" messages come through _on_shard_message, only forward the shard's own errors.
+    if isinstance(err, Exception):
+      self._call_special_functions('error', err)
+
+  def _on_shard_message(self, shard_index, message):
+    message_type, product_id = ShardedCoinbaseWebsocket._get_routing_fields(message)
+    if product_id is not None:
+      self._message_counts[shard_index][product_id] += 1
+      if self._owners.get(product_id) != shard_index or product_id in self._handovers:
+        self._on_unowned_message(shard_index, message_type, product_id, message)
+        return
+    self._call_functions(message_type, message)
+
+  def _on_unowned_message(self, shard_index, message_type, product_id, message):
+    with self._handover_delivery_lock:
+      handover, deliveries = self._take_unowned_message(shard_index, message_type, product_id, message)
+      for delivery_type, delivery in deliveries:
+        self._call_functions(delivery_type, delivery)
+    if handover is not None:
+      self.shards[handover.old_shard].remove_product(product_id)
+
+  def _take_unowned_message(self, shard_index, message_type, product_id, message):
+    """Updates the product's handover with the message.
+
+    Returns:
+      A tuple of (the handover if it just finished, else None, the (message type, message) to pass to the functions).
+    """
+    with self._lock:
+      handover = self._handovers.get(product_id)
+      if handover is None:
+        # Late messages from a shard the product has already moved away from.
+        if self._owners.get(product_id, shard_index) == shard_index:
+          return None, [(message_type, message)]
+        return None, []
+      deliveries = []
+      sequence = ShardedCoinbaseWebsocket._get_sequence(message)
+      if shard_index == handover.old_shard:
+        deliveries.append((message_type, message))
+        if sequence is not None:
+          handover.last_sequence = sequence
+      elif shard_index == handover.new_shard:
+        handover.buffer.append((sequence, message))
+      if not self._handover_ready(handover):
+        return None, deliveries
+      # The new shard has caught up with the old one, deliver what it has that the old shard didn't.
+      del self._handovers[product_id]
+      self._owners[product_id] = handover.new_shard
+      for buffered_sequence, buffered_message in handover.buffer:
+        if (buffered_sequence is None or handover.last_sequence is None or
+            buffered_sequence > handover.last_sequence):
+          deliveries.append((ShardedCoinbaseWebsocket._get_routing_fields(buffered_message)[0], buffered_message))
+      return handover, deliveries
+
+  def _has_full_channel(self):
+    return 'full' in self.channels_to_function or 'full' in self.extra_channels
+
+  def _handover_ready(self, handover: _Handover):
+    if not handover.buffer:
+      return False
+    first_sequence = next((sequence for sequence, _ in handover.buffer if sequence is not None), None)
+    if first_sequence is None:
+      # A message without a sequence (e.g. a level2 snapshot) only shows that the new shard caught up when none of the
+      # product's messages have sequences, else the old shard may still have sequenced messages on the way.
+      if not handover.sequenced and handover.last_sequence is None:
+        return True
+    elif handover.last_sequence is not None and handover.last_sequence >= first_sequence - 1:
+      return True
+    if time.monotonic() - handover.started > self.handover_timeout:
+      if self.log_level >= LogLevel.ERROR_LOG:
+        logging.error('Timed out waiting for shards to line up, messages may have been lost.')
+      return True
+    return False
+
+  def _call_functions(self, message_type, message):
+    table, default_functions = self._dispatch_table
+    for function in table.get(message_type, default_functions):
+      function(message)
+
+  @staticmethod
+  def _get_routing_fields(message):
+    if isinstance(message, LazyMessage):
+      return message.type, message.product_id
+    if isinstance(message, Mapping):
+      return message.get('type'), message.get('product_id')
+    return extract_message_type(message), extract_product_id(message)
+
+  @staticmethod
+  def _get_sequence(message):
+    if isinstance(message, LazyMessage):
+      return message.sequence
+    if isinstance(message, Mapping):
+      return message.get('sequence')
+    return extract_sequence(message)
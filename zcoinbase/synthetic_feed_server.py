@@ -0,0 +1,444 @@
+# A local stand-in for the Coinbase websocket feed, for load testing the websocket client and order books.
+import asyncio
+import datetime
+import importlib.util
+import json
+import logging
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+
+from typing import Text
+
+from .util import LogLevel
+
+# The server needs the websockets package, it is optional for the rest of zcoinbase.
+websockets_spec = importlib.util.find_spec('websockets')
+if websockets_spec is not None:
+  import websockets
+
+# Channels the synthetic feed can generate.
+SYNTHETIC_CHANNELS = ['level2', 'full', 'matches', 'ticker', 'heartbeat']
+
+
+def _now():
+  return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class _SyntheticProduct:
+  """A random-walk market for a single product, keeps a level2 book and a set of open orders."""
+
+  def __init__(self, product_id, price, depth, rng: random.Random):
+    self.product_id = product_id
+    self.rng = rng
+    self.tick = 0.01
+    self.depth = depth
+    self.mid_ticks = int(price / self.tick)
+    self.sequence = rng.randint(1, 1 << 30)
+    self.trade_id = rng.randint(1, 1 << 20)
+    # Price (in ticks) to size.
+    self.bids = {self.mid_ticks - i: round(rng.uniform(0.01, 5), 8) for i in range(1, depth + 1)}
+    self.asks = {self.mid_ticks + i: round(rng.uniform(0.01, 5), 8) for i in range(1, depth + 1)}
+    # Open orders: (order_id, side, price ticks, size)
+    self.orders = []
+
+  def _price(self, ticks):
+    return '{:.2f}'.format(ticks * self.tick)
+
+  def _next_sequence(self):
+    self.sequence += 1
+    return self.sequence
+
+  def snapshot(self):
+    return {'type': 'snapshot', 'product_id': self.product_id,
+            'bids': [[self._price(p), str(self.bids[p])] for p in sorted(self.bids, reverse=True)],
+            'asks': [[self._price(p), str(self.asks[p])] for p in sorted(self.asks)]}
+
+  def heartbeat(self):
+    return {'type': 'heartbeat', 'product_id': self.product_id, 'sequence': self.sequence,
+            'last_trade_id': self.trade_id, 'time': _now()}
+
+  def next_messages(self):
+    """Generates the messages for one market event, as (channel, message) tuples."""
+    rng = self.rng
+    event = rng.random()
+    if event < 0.6:
+      return [('level2', self._l2update())]
+    elif event < 0.8 or not self.orders:
+      return self._new_order()
+    elif event < 0.9:
+      return self._cancel_order()
+    return self._match()
+
+  def _l2update(self):
+    changes = []
+    if self.rng.random() < 0.02:
+      # The mid moves, remove the levels it crossed.
+      self.mid_ticks += self.rng.choice((-1, 1))
+      for price in [p for p in self.bids if p >= self.mid_ticks]:
+        del self.bids[price]
+        changes.append(['buy', self._price(price), '0'])
+      for price in [p for p in self.asks if p <= self.mid_ticks]:
+        del self.asks[price]
+        changes.append(['sell', self._price(price), '0'])
+    side = self.rng.choice(('buy', 'sell'))
+    offset = self.rng.randint(1, self.depth)
+    book, price = (self.bids, self.mid_ticks - offset) if side == 'buy' else (self.asks, self.mid_ticks + offset)
+    if price in book and self.rng.random() < 0.2:
+      del book[price]
+      size = '0'
+    else:
+      book[price] = round(self.rng.uniform(0.01, 5), 8)
+      size = str(book[price])
+    changes.append([side, self._price(price), size])
+    return {'type': 'l2update', 'product_id': self.product_id, 'time': _now(), 'changes': changes}
+
+  def _new_order(self):
+    order_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+    side = self.rng.choice(('buy', 'sell'))
+    offset = self.rng.randint(1, self.depth)
+    price = self.mid_ticks - offset if side == 'buy' else self.mid_ticks + offset
+    size = round(self.rng.uniform(0.01, 2), 8)
+    self.orders.append((order_id, side, price, size))
+    now = _now()
+    return [('full', {'type': 'received', 'time': now, 'product_id': self.product_id,
+                      'sequence': self._next_sequence(), 'order_id': order_id, 'size': str(size),
+                      'price': self._price(price), 'side': side, 'order_type': 'limit'}),
+            ('full', {'type': 'open', 'time': now, 'product_id': self.product_id, 'sequence': self._next_sequence(),
+                      'order_id': order_id, 'price': self._price(price), 'remaining_size': str(size), 'side': side})]
+
+  def _cancel_order(self):
+    order_id, side, price, size = self.orders.pop(self.rng.randrange(len(self.orders)))
+    return [('full', {'type': 'done', 'time': _now(), 'product_id': self.product_id,
+                      'sequence': self._next_sequence(), 'order_id': order_id, 'price': self._price(price),
+                      'remaining_size': str(size), 'reason': 'canceled', 'side': side})]
+
+  def _match(self):
+    order_id, side, price, size = self.orders.pop(self.rng.randrange(len(self.orders)))
+    self.trade_id += 1
+    now = _now()
+    sequence = self._next_sequence()
+    messages = [('full', {'type': 'match', 'trade_id': self.trade_id, 'sequence': sequence,
+                          'maker_order_id': order_id, 'taker_order_id': str(uuid.UUID(int=self.rng.getrandbits(128))),
+                          'time': now, 'product_id': self.product_id, 'size': str(size),
+                          'price': self._price(price), 'side': side}),
+                ('full', {'type': 'done', 'time': now, 'product_id': self.product_id,
+                          'sequence': self._next_sequence(), 'order_id': order_id, 'price': self._price(price),
+                          'remaining_size': '0', 'reason': 'filled', 'side': side}),
+                ('ticker', {'type': 'ticker', 'trade_id': self.trade_id, 'sequence': sequence, 'time': now,
+                            'product_id': self.product_id, 'price': self._price(price), 'side': side,
+                            'last_size': str(size), 'best_bid': self._price(max(self.bids, default=price)),
+                            'best_ask': self._price(min(self.asks, default=price))})]
+    # "matches" gets the same match message as "full".
+    messages.insert(1, ('matches', messages[0][1]))
+    return messages
+
+
+class _Connection:
+  """A connected client, with its subscriptions and a bounded queue of frames to send."""
+
+  def __init__(self, websocket, max_queue_size):
+    self.websocket = websocket
+    # Set of (channel, product_id).
+    self.subscriptions = set()
+    self.queue = asyncio.Queue(maxsize=max_queue_size)
+
+
+class SyntheticFeedServer:
+  """Serves a synthetic Coinbase websocket feed.
+
+  Speaks the Coinbase subscribe protocol (including the channel object form and unsubscribe), acknowledges with a
+  'subscriptions' message, and sends a 'snapshot' before 'l2update's for level2. Traffic for 'level2', 'full',
+  'matches' and 'ticker' is generated at messages_per_second over product_count products, and 'heartbeat's are sent
+  once a second for each product. All clients see the same market, with the same sequence numbers.
+
+  Usage:
+    server = SyntheticFeedServer(messages_per_second=5000, product_count=20)
+    server.start()
+    cbws = CoinbaseWebsocket(websocket_addr=server.address, products_to_listen=server.product_ids, ...)
+    ...
+    server.stop()
+  """
+
+  def __init__(self, host: Text = 'localhost', port: int = 0,
+               messages_per_second: float = 1000,
+               product_count: int = 10,
+               book_depth: int = 50,
+               max_queue_size: int = 100000,
+               seed: int = None,
+               log_level: LogLevel = LogLevel.BASIC_MESSAGES):
+    """Constructor for the SyntheticFeedServer.
+
+    Args:
+      host: (Default: 'localhost') Host to listen on.
+      port: (Default: 0) Port to listen on, 0 picks a free port, see address.
+      messages_per_second: (Default: 1000) Rate of generated market messages, over all products.
+      product_count: (Default: 10) Number of products, named SYN0-USD, SYN1-USD, ...
+      book_depth: (Default: 50) Number of level2 price levels on each side of the book.
+      max_queue_size: (Default: 100000) Frames queued for a client before we start dropping its frames.
+      seed: (optional) Seed for the random market.
+      log_level: (Default: BASIC_MESSAGES) The LOG_LEVEL to use for this class.
+    """
+    if websockets_spec is None:
+      raise ImportError('SyntheticFeedServer requires the websockets package (pip install websockets).')
+    self.host = host
+    self.port = port
+    self.messages_per_second = messages_per_second
+    self.max_queue_size = max_queue_size
+    self.log_level = log_level
+    rng = random.Random(seed)
+    self.product_ids = ['SYN{}-USD'.format(i) for i in range(product_count)]
+    self._products = [_SyntheticProduct(product_id, rng.uniform(1, 50000), book_depth, rng)
+                      for product_id in self.product_ids]
+    self._connections = set()
+    self.messages_generated = 0
+    self.frames_sent = 0
+    self.frames_dropped = 0
+    self._loop = None
+    self._thread = None
+    self._started = threading.Event()
+    # Raised by serve on the server thread before it started listening, re-raised by start.
+    self._start_error = None
+    self._stop = None
+
+  @property
+  def address(self):
+    return 'ws://{}:{}'.format(self.host, self.port)
+
+  def start(self):
+    """Starts serving on a background thread, returns once the server is listening.
+
+    Raises:
+      The exception that stopped the server from listening, e.g. OSError if the port is taken.
+    """
+    self._started.clear()
+    self._start_error = None
+    self._thread = threading.Thread(target=self._run, name='SyntheticFeedServer', daemon=True)
+    self._thread.start()
+    self._started.wait()
+    if self._start_error is not None:
+      self._thread.join()
+      self._thread = self._loop = None
+      raise self._start_error
+
+  def stop(self):
+    if self._loop is not None:
+      self._loop.call_soon_threadsafe(self._stop.set)
+    if self._thread is not None:
+      self._thread.join()
+
+  def get_stats(self):
+    return {'messages_generated': self.messages_generated, 'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped, 'connections': len(self._connections)}
+
+  def _run(self):
+    try:
+      asyncio.run(self.serve())
+    except Exception as e:
+      if self._started.is_set():
+        logging.exception('Synthetic feed server failed')
+      else:
+        self._start_error = e
+    finally:
+      # Wakes start up if serve failed before it started listening.
+      self._started.set()
+
+  async def serve(self):
+    """Serves until stop is called."""
+    self._loop = asyncio.get_running_loop()
+    self._stop = asyncio.Event()
+    async with websockets.serve(self._handle_connection, self.host, self.port, max_size=None) as server:
+      self.port = next(iter(server.sockets)).getsockname()[1]
+      if self.log_level >= LogLevel.BASIC_MESSAGES:
+        logging.info('Synthetic feed serving on {}'.format(self.address))
+      producer = asyncio.create_task(self._produce())
+      self._started.set()
+      await self._stop.wait()
+      producer.cancel()
+
+  async def _handle_connection(self, websocket):
+    connection = _Connection(websocket, self.max_queue_size)
+    self._connections.add(connection)
+    sender = asyncio.create_task(self._send_frames(connection))
+    try:
+      async for request in websocket:
+        self._handle_request(connection, json.loads(request))
+    except websockets.exceptions.ConnectionClosed:
+      pass
+    finally:
+      self._connections.discard(connection)
+      sender.cancel()
+
+  def _handle_request(self, connection: _Connection, request):
+    if request.get('type') not in ('subscribe', 'unsubscribe'):
+      self._queue_frame(connection, json.dumps({'type': 'error', 'message': 'Failed to subscribe',
+                                                'reason': 'Type has to be either subscribe or unsubscribe'}))
+      return
+    requested = set()
+    for channel in request.get('channels', []):
+      if isinstance(channel, dict):
+        requested.update((channel['name'], product_id) for product_id in channel.get('product_ids', []))
+      else:
+        requested.update((channel, product_id) for product_id in request.get('product_ids', []))
+    new_subscriptions = set()
+    if request['type'] == 'unsubscribe':
+      connection.subscriptions.difference_update(requested)
+    else:
+      new_subscriptions = requested - connection.subscriptions
+      connection.subscriptions.update(requested)
+    # Like Coinbase, the 'subscriptions' ack comes first.
+    channels = {}
+    for channel, product_id in sorted(connection.subscriptions):
+      channels.setdefault(channel, []).append(product_id)
+    self._queue_frame(connection, json.dumps({
+      'type': 'subscriptions',
+      'channels': [{'name': name, 'product_ids': product_ids} for name, product_ids in channels.items()]}))
+    # Snapshots go out before any l2update for the product.
+    for product in self._products:
+      if ('level2', product.product_id) in new_subscriptions:
+        self._queue_frame(connection, json.dumps(product.snapshot()))
+
+  def _queue_frame(self, connection: _Connection, frame):
+    if connection.queue.full():
+      self.frames_dropped += 1
+    else:
+      connection.queue.put_nowait(frame)
+
+  async def _send_frames(self, connection: _Connection):
+    try:
+      while True:
+        frame = await connection.queue.get()
+        await connection.websocket.send(frame)
+        self.frames_sent += 1
+    except websockets.exceptions.ConnectionClosed:
+      pass
+
+  async def _produce(self):
+    loop = asyncio.get_running_loop()
+    start = last_heartbeat = loop.time()
+    rng = random.Random()
+    while True:
+      await asyncio.sleep(0.001)
+      now = loop.time()
+      due = int((now - start) * self.messages_per_second) - self.messages_generated
+      while due > 0:
+        product = rng.choice(self._products)
+        for channel, message in product.next_messages():
+          self._broadcast(channel, product.product_id, message)
+          self.messages_generated += 1
+          due -= 1
+      if now - last_heartbeat >= 1:
+        last_heartbeat = now
+        for product in self._products:
+          self._broadcast('heartbeat', product.product_id, product.heartbeat())
+
+  def _broadcast(self, channel, product_id, message):
+    frame = None
+    key = (channel, product_id)
+    for connection in self._connections:
+      if key in connection.subscriptions:
+        if frame is None:
+          frame = json.dumps(message)
+        self._queue_frame(connection, frame)
+
+
+def _serve_in_process(pipe, server_kwargs):
+  server = SyntheticFeedServer(**server_kwargs)
+  server.start()
+  pipe.send((server.address, server.product_ids))
+  pipe.recv()  # Wait to be told to stop.
+  stats = server.get_stats()
+  server.stop()
+  pipe.send(stats)
+
+
+def run_load_test(duration: float = 10.0,
+                  messages_per_second: float = 1000,
+                  product_count: int = 10,
+                  channels: list[Text] = None,
+                  order_book: bool = True,
+                  warmup: float = 1.0,
+                  **websocket_kwargs):
+  """Runs CoinbaseWebsocket (and optionally CoinbaseOrderBook) against a SyntheticFeedServer and reports how it did.
+
+  The server runs in its own process, so the CPU time reported is the client's alone.
+
+  Args:
+    duration: (Default: 10.0) Seconds to measure for.
+    messages_per_second: (Default: 1000) Rate of generated market messages, over all products.
+    product_count: (Default: 10) Number of products to subscribe to.
+    channels: (Default: ['level2', 'full', 'heartbeat']) Channels to subscribe to.
+    order_book: (Default: True) Maintain a CoinbaseOrderBook for every product (needs the level2 channel).
+    warmup: (Default: 1.0) Seconds to run before measuring, so the snapshots aren't measured.
+    **websocket_kwargs: Passed to the CoinbaseWebsocket under test (e.g. lazy_json, worker_threads).
+
+  Returns:
+    A dict with the sustained message rate, drop and sequence gap counts, lag percentiles (ns) and CPU per message.
+  """
+  # Imported here, the websocket client imports are heavier than the server needs.
+  from .websocket_client import CoinbaseWebsocket
+  from .coinbase_order_book import CoinbaseOrderBook
+  from .latency import EXCHANGE_TO_RECEIVE
+  if channels is None:
+    channels = ['level2', 'full', 'heartbeat']
+  parent_pipe, child_pipe = multiprocessing.Pipe()
+  server_process = multiprocessing.Process(
+    target=_serve_in_process, args=(child_pipe, {'messages_per_second': messages_per_second,
+                                                 'product_count': product_count,
+                                                 'log_level': LogLevel.NO_LOG}), daemon=True)
+  server_process.start()
+  address, product_ids = parent_pipe.recv()
+  received = [0]
+
+  def count_frame(frame):
+    received[0] += 1
+
+  websocket_kwargs.setdefault('log_level', LogLevel.NO_LOG)
+  websocket_kwargs.setdefault('detect_sequence_gaps', 'full' in channels)
+  websocket_kwargs.setdefault('track_latency', True)
+  websocket_kwargs.setdefault('latency_per_product', False)
+  cb_ws = CoinbaseWebsocket(websocket_addr=address,
+                            products_to_listen=list(product_ids),
+                            extra_channels=[channel for channel in channels if channel != 'level2' or not order_book],
+                            autostart=False,
+                            **websocket_kwargs)
+  cb_ws.add_raw_message_function(count_frame)
+  if order_book and 'level2' in channels:
+    CoinbaseOrderBook(cb_ws)
+  cb_ws.start_websocket_in_thread()
+  cb_ws.wait_for_open()
+  time.sleep(warmup)
+  if cb_ws.latency is not None:
+    cb_ws.latency.reset()
+  start_received = received[0]
+  start_cpu = time.process_time()
+  start_time = time.monotonic()
+  time.sleep(duration)
+  elapsed = time.monotonic() - start_time
+  cpu = time.process_time() - start_cpu
+  measured = received[0] - start_received
+  parent_pipe.send('stop')
+  server_stats = parent_pipe.recv()
+  server_process.join()
+  cb_ws.close_websocket()
+  connection_stats = cb_ws.get_connection_stats()
+  report = {
+    'messages_received': measured,
+    'messages_per_second': measured / elapsed,
+    'cpu_seconds': cpu,
+    'cpu_us_per_message': cpu / measured * 1e6 if measured else None,
+    'server_frames_sent': server_stats['frames_sent'],
+    'server_frames_dropped': server_stats['frames_dropped'],
+    'sequence_gaps': connection_stats['sequence_gaps'],
+    'out_of_order': connection_stats['out_of_order'],
+  }
+  if cb_ws.latency is not None:
+    lag = cb_ws.latency.get_histogram(EXCHANGE_TO_RECEIVE)
+    report.update({'lag_p50_ns': lag.percentile(50), 'lag_p99_ns': lag.percentile(99), 'lag_max_ns': lag.max})
+  dispatch_stats = cb_ws.get_dispatch_stats()
+  if dispatch_stats is not None:
+    report['client_dropped'] = dispatch_stats['dropped']
+    report['client_max_queue_depth'] = dispatch_stats['max_queue_depth']
+  return report
@@ -26,6 +26,20 @@ class LogLevel(Enum):
     return self.value <= other.value
 
 
+class BackpressurePolicy(Enum):
+  """What to do when a bounded message queue is full."""
+  BLOCK = 'block'  # Wait for the consumer to catch up.
+  DROP_OLDEST = 'drop_oldest'  # Drop the oldest queued message.
+  CONFLATE = 'conflate'  # Replace the queued message for the same channel and product with the new one.
+
+
+class FrameType(Enum):
+  """How websocket frames are handed to functions."""
+  TEXT = 'text'  # Decoded to str.
+  BYTES = 'bytes'  # The bytes as they were received, never decoded to str.
+  MEMORYVIEW = 'memoryview'  # A memoryview over the received bytes.
+
+
 class OrderSide(Enum):
   BUY = 'buy'
   SELL = 'sell'
@@ -2,11 +2,17 @@ import websocket
 import json
 import logging
 import threading
+import time
 
 from typing import Text, Callable
 
-from .util import LogLevel
+from .util import LogLevel, BackpressurePolicy, FrameType
 from .coinbase_auth import CoinbaseAuth
+from .internal import ShardedDispatchQueue, LatestValueStore
+from .latency import LatencyTracker, parse_exchange_time, EXCHANGE_TO_RECEIVE, RECEIVE_TO_DISPATCH, HANDLER
+from .messages import decode_typed_message
+from .message_decoding import get_json_decoder, extract_message_type, extract_product_id, extract_sequence, \
+  extract_time, LazyMessage
 
 # Special channels are sometimes sent by Coinbase, but cannot be subscribed to directly.
 SPECIAL_CHANNELS = ['error',
@@ -22,9 +28,15 @@ SPECIAL_CHANNELS = ['error',
                     # Documentation: https://docs.pro.coinbase.com/#the-level2-channel
                     'snapshot',
                     'l2update',
+                    # Sent by this client when a sequence gap or an out-of-order message is detected.
+                    'sequence_gap',
                     ]
 # Channels received with "full" subscription: https://docs.pro.coinbase.com/#the-full-channel
-FULL_CHANNELS = ['open', 'received', 'match', 'change', 'activate']
+FULL_CHANNELS = ['open', 'received', 'match', 'change', 'done', 'activate']
+# Channels that only exist locally, these are never sent to Coinbase in a subscribe message.
+_UNSUBSCRIBABLE_CHANNELS = frozenset(SPECIAL_CHANNELS + FULL_CHANNELS)
+# Message types that carry a gapless, per-product sequence number (sent on the "full" channel).
+_SEQUENCED_MESSAGE_TYPES = frozenset(FULL_CHANNELS)
 
 
 # noinspection PyUnusedLocal
@@ -36,7 +48,23 @@ class CoinbaseWebsocket:
                products_to_listen: list[Text] = None,
                channels_to_function: dict[Text, list[Callable]] = None,
                extra_channels: list[Text] = None,
+               channel_products: dict[Text, list[Text]] = None,
+               subscription_batch_window: float = 0.0,
+               conflated_channels: list[Text] = None,
                preparse_json: bool = True,
+               frame_type: FrameType = FrameType.TEXT,
+               json_decoder='auto',
+               lazy_json: bool = False,
+               typed_messages: bool = False,
+               worker_threads: int = 0,
+               max_queue_size: int = 10000,
+               backpressure: BackpressurePolicy = BackpressurePolicy.BLOCK,
+               auto_reconnect: bool = False,
+               reconnect_backoff: float = 1.0,
+               max_reconnect_backoff: float = 60.0,
+               detect_sequence_gaps: bool = False,
+               track_latency: bool = False,
+               latency_per_product: bool = True,
                autostart: bool = True,
                log_level: LogLevel = LogLevel.BASIC_MESSAGES,
                api_key=None, api_secret=None, passphrase=None):
@@ -66,11 +94,56 @@ class CoinbaseWebsocket:
         "Special" Channels:
           "error": Error Handler (gets json or string message)
           "close_websocket": Handle on-close (parameter is websocket)
-          "open_websocket": Handle on-open (parameter is websocket)
+          "open_websocket": Handle on-open (parameter is websocket), also called after every reconnect.
+          "sequence_gap": Called when detect_sequence_gaps is set and a message is missing or out of order. The
+                          parameter is a dict with 'type', 'channel' (the channel with the gap, 'full'), 'product_id',
+                          'last_sequence', 'sequence' and 'out_of_order'.
           "full": Subscribing to this channel will create FULL_CHANNELS messages.
                   These messages might be useful for authenticated clients for confirming filling of orders.
       extra_channels: Extra channels to subscribe to without a function.
+      channel_products: (optional) Map of channels to the only products to subscribe to on that channel, instead of
+        products_to_listen, e.g. {'level2': ['BTC-USD'], 'ticker': [...300 products...]}. The channels are subscribed to
+        even if they have no function.
+      subscription_batch_window: (Default: 0.0) Seconds to collect subscription changes (add_product, add_channel, ...)
+        for before sending them, so many changes go out in one frame. Only the difference from what is already
+        subscribed is ever sent.
+      conflated_channels: (optional) Channels (e.g. 'ticker', 'heartbeat') whose messages are only kept as the latest
+        message per product, instead of being passed to functions. The receive thread just overwrites a slot, read the
+        slots with get_latest and get_all_latest, or have them delivered on a fixed cadence with
+        add_conflated_function. The messages are LazyMessages (raw frames when preparse_json is False), so they are
+        only decoded when they are read.
       preparse_json: (Default: True) Should we pass json to channels to function or simply the string?
+        When this is False, the frame is never decoded, only the 'type' is scanned out of it for routing.
+      frame_type: (Default: TEXT) The type of the frames handed to raw message functions, to functions when
+        preparse_json is False, and to the JSON decoder. BYTES and MEMORYVIEW skip decoding the frames to str (and
+        websocket-client's UTF-8 validation), so frames can be recorded or forwarded as they arrived. orjson parses
+        memoryviews directly, the other decoders get a copy of the bytes.
+      json_decoder: (Default: 'auto') The JSON decoder to use, one of 'auto', 'json', 'orjson' or 'simdjson', or a
+        callable. 'auto' uses the fastest one that is installed, see message_decoding.get_json_decoder.
+      lazy_json: (Default: False) Only scan 'type', 'product_id' and 'sequence' out of each frame for routing, and pass
+        functions a LazyMessage that decodes the rest of the frame the first time a function reads it.
+      typed_messages: (Default: False) Decode the busy message types ('l2update', 'snapshot', 'match', 'ticker',
+        'received', 'open', 'done', 'change') to the typed records in zcoinbase.messages, with prices and sizes already
+        converted to floats. The records can still be read like dicts. Takes precedence over lazy_json.
+      worker_threads: (Default: 0) When set, channel functions are run on this many worker threads instead of the
+        websocket thread, so a slow function can't stall reading the socket. Messages are sharded over the workers by
+        product_id, so messages for a product are always handled in order.
+      max_queue_size: (Default: 10000) The most messages that can be queued for each worker.
+      backpressure: (Default: BLOCK) What to do when a worker's queue is full, see BackpressurePolicy. CONFLATE keeps
+        only the newest queued message per (type, product_id), don't use it with order books.
+      auto_reconnect: (Default: False) Reconnect when the websocket is dropped and subscribe to everything that was
+        subscribed to before, until close_websocket is called.
+      reconnect_backoff: (Default: 1.0) Seconds to wait before the first reconnect attempt, doubled after each failed
+        attempt.
+      max_reconnect_backoff: (Default: 60.0) The longest we'll wait between reconnect attempts.
+      detect_sequence_gaps: (Default: False) Track the sequence of "full" channel messages per product, messages that
+        are older than one we've already seen are dropped, and gaps are reported on the "sequence_gap" channel. Only
+        products subscribed to "full" are tracked, other channels (e.g. matches, user or ticker) don't have gapless
+        sequences, even though some of their message types are the same.
+      track_latency: (Default: False) Record latency histograms per channel and product: from the exchange's 'time' to
+        receiving the message, from receiving to running its functions, and how long each function takes. See
+        get_latency_stats and the latency attribute (a LatencyTracker).
+      latency_per_product: (Default: True) Keep latency histograms for every product, otherwise only per channel.
       autostart: (Default: True) Start the websocket by default.
       log_level: (Default: ERROR_LOG) The LOG_LEVEL to use for this class, by default, will only report errors (using
         python logging api)
@@ -84,20 +157,60 @@ class CoinbaseWebsocket:
       channels_to_function = {}
     if extra_channels is None:
       extra_channels = []
+    if channel_products is None:
+      channel_products = {}
     self.websocket_addr = websocket_addr
     self.products_to_listen = products_to_listen
     self.channels_to_function = channels_to_function
     self.extra_channels = extra_channels
+    self.channel_products = channel_products
+    self.subscription_batch_window = subscription_batch_window
+    # The (channel, product_id) pairs Coinbase has been asked to send on this connection.
+    self._active_subscriptions = set()
+    # Products subscribed to "full", the only ones whose sequences are tracked.
+    self._sequenced_products = frozenset()
+    self._subscription_timer = None
+    self._subscription_lock = threading.Lock()
+    self.conflated_channels = frozenset(conflated_channels or ())
+    self.latest_values = LatestValueStore()
     self.preparse_json = preparse_json
+    self.frame_type = frame_type
+    self.json_decoder = get_json_decoder(json_decoder, frame_type)
+    self.lazy_json = lazy_json
+    self.typed_messages = typed_messages
+    self._dispatch_queue = None
+    if worker_threads:
+      self._dispatch_queue = ShardedDispatchQueue(num_workers=worker_threads,
+                                                  max_queue_size=max_queue_size,
+                                                  backpressure=backpressure,
+                                                  name='CoinbaseWebsocketWorker')
     self.log_level = log_level
     self.api_key = api_key
     self.api_secret = api_secret
     self.passphrase = passphrase
+    self.auto_reconnect = auto_reconnect
+    self.reconnect_backoff = reconnect_backoff
+    self.max_reconnect_backoff = max_reconnect_backoff
+    self.detect_sequence_gaps = detect_sequence_gaps
+    self.latency = LatencyTracker(per_product=latency_per_product) if track_latency else None
+    self._last_sequences = {}
+    self._reconnects = 0
+    self._sequence_gaps = 0
+    self._out_of_order = 0
+    self._closing = threading.Event()
+    self._connected_since_start = False
+    self.ws_thread = None
     self.ws_opened = threading.Event()
+    # Serializes rebuilds of the dispatch table, the receive thread never takes this lock.
+    self._dispatch_table_lock = threading.Lock()
+    self._dispatch_table = CoinbaseWebsocket.make_dispatch_table(self.channels_to_function)
+    # Functions that get every frame as it was received, before it is decoded.
+    self._raw_message_functions = ()
     self.ws = websocket.WebSocketApp(self.websocket_addr,
                                      on_message=lambda ws, msg: self.on_message(ws, msg),
                                      on_error=lambda ws, err: self.on_error(ws, err),
-                                     on_close=lambda ws: self.on_close(ws),
+                                     # Newer websocket-client versions also pass the close status and message.
+                                     on_close=lambda ws, *args: self.on_close(ws),
                                      on_open=lambda ws: self.on_open(ws))
     if autostart:
       self.ws_thread = threading.Thread(target=self.start_websocket, daemon=True)
@@ -107,15 +220,46 @@ class CoinbaseWebsocket:
     self.close_websocket()
 
   def start_websocket(self):
-    self.ws.run_forever()
+    """Runs the websocket on this thread, until it is closed (or close_websocket is called, with auto_reconnect)."""
+    self._closing.clear()
+    if self._dispatch_queue is not None and self._dispatch_queue.closed:
+      # close_websocket stopped the workers, start new ones.
+      self._dispatch_queue = ShardedDispatchQueue(num_workers=self._dispatch_queue.num_workers,
+                                                  max_queue_size=self._dispatch_queue.max_queue_size,
+                                                  backpressure=self._dispatch_queue.backpressure,
+                                                  name='CoinbaseWebsocketWorker')
+    backoff = self.reconnect_backoff
+    while True:
+      self._connected_since_start = False
+      self.ws.run_forever(skip_utf8_validation=self.frame_type != FrameType.TEXT)
+      if not self.auto_reconnect or self._closing.is_set():
+        return
+      if self._connected_since_start:
+        # The last connection worked, so start backing off from the beginning.
+        backoff = self.reconnect_backoff
+      if self.log_level >= LogLevel.BASIC_MESSAGES:
+        logging.info('Reconnecting to Coinbase Websocket ({}) in {} seconds'.format(self.websocket_addr, backoff))
+      if self._closing.wait(timeout=backoff):
+        return
+      backoff = min(backoff * 2, self.max_reconnect_backoff)
+      self._reconnects += 1
 
   def start_websocket_in_thread(self):
-    if not self.ws_opened.is_set():
+    if self.ws_thread is None or not self.ws_thread.is_alive():
       self.ws_thread = threading.Thread(target=self.start_websocket, daemon=True)
       self.ws_thread.start()
 
   def close_websocket(self):
+    """Closes the websocket, and stops the worker threads and the conflated functions.
+
+    With the BLOCK backpressure policy the workers first run the functions of the messages that are already queued,
+    with the other policies those messages are dropped. Conflated functions have to be added again after a restart.
+    """
+    self._closing.set()
     self.ws.close()
+    if self._dispatch_queue is not None:
+      self._dispatch_queue.close_and_join(drain=self._dispatch_queue.backpressure == BackpressurePolicy.BLOCK)
+    self.latest_values.close()
 
   def wait_for_open(self):
     self.ws_opened.wait()
@@ -130,6 +274,60 @@ class CoinbaseWebsocket:
       subscribe_msg.update(CoinbaseAuth.get_websocket_verification(api_key, api_secret, passphrase))
     return json.dumps(subscribe_msg)
 
+  @staticmethod
+  def make_unsubscribe(product_ids=None, channels=None):
+    if product_ids is None or channels is None:
+      raise SyntaxError('Must specify channels and product_ids')
+    return json.dumps({'type': 'unsubscribe', 'product_ids': product_ids, 'channels': channels})
+
+  @staticmethod
+  def make_channel_subscriptions(subscriptions, message_type='subscribe',
+                                 api_key=None, api_secret=None, passphrase=None):
+    """Makes a subscribe (or unsubscribe) message in the channel object form, every channel has its own products.
+
+    Args:
+      subscriptions: Iterable of (channel, product_id) pairs.
+      message_type: (Default: 'subscribe') 'subscribe' or 'unsubscribe'.
+    """
+    channels = {}
+    for channel, product_id in sorted(subscriptions):
+      channels.setdefault(channel, []).append(product_id)
+    subscribe_msg = {'type': message_type,
+                     'channels': [{'name': channel, 'product_ids': product_ids}
+                                  for channel, product_ids in channels.items()]}
+    if message_type == 'subscribe' and api_key and api_secret and passphrase:
+      subscribe_msg.update(CoinbaseAuth.get_websocket_verification(api_key, api_secret, passphrase))
+    return json.dumps(subscribe_msg)
+
+  @staticmethod
+  def make_dispatch_table(channels_to_function):
+    """Precompiles channels_to_function into a routing table for incoming messages.
+
+    Every message type maps to a ready tuple of the functions to call, including the functions registered on the
+    'full', 'matches' and 'all_messages' aliases, so routing a message is a single dict lookup.
+
+    Returns:
+      A tuple of (table, default_functions), default_functions are called for messages whose type is not in the table.
+    """
+    all_functions = CoinbaseWebsocket._functions_as_tuple(channels_to_function.get('all_messages', ()))
+    full_functions = CoinbaseWebsocket._functions_as_tuple(channels_to_function.get('full', ()))
+    matches_functions = CoinbaseWebsocket._functions_as_tuple(channels_to_function.get('matches', ()))
+    table = {}
+    for message_type in set(channels_to_function.keys()).union(FULL_CHANNELS, ['match']):
+      functions = CoinbaseWebsocket._functions_as_tuple(channels_to_function.get(message_type, ()))
+      if message_type in FULL_CHANNELS:
+        functions += full_functions
+      if message_type == 'match':
+        functions += matches_functions
+      table[message_type] = functions + all_functions
+    return table, all_functions
+
+  def rebuild_dispatch_table(self):
+    """Rebuilds the routing table, call this if channels_to_function is modified directly."""
+    with self._dispatch_table_lock:
+      # Build the new table on the side and swap it in, the receive thread always sees a complete table.
+      self._dispatch_table = CoinbaseWebsocket.make_dispatch_table(self.channels_to_function)
+
   def add_channel_function(self, channel, function, refresh_subscriptions=None):
     if channel in self.channels_to_function:
       functions = self.channels_to_function[channel]
@@ -138,50 +336,199 @@ class CoinbaseWebsocket:
         functions.append(function)
       else:
         # Not a list, make it a list.
-        current_function = functions
-        functions = [current_function, function]
+        self.channels_to_function[channel] = [functions, function]
     else:
       self.channels_to_function[channel] = [function]
       # This is a new channel, so force subscription update, if not set.
       if refresh_subscriptions is None:
         refresh_subscriptions = True
+    self.rebuild_dispatch_table()
     # Force refresh subscriptions if not explicitly set.
     if refresh_subscriptions or refresh_subscriptions is None:
       self.subscribe()
 
+  def remove_channel_function(self, channel, function):
+    """Removes a function previously added to a channel, the channel stays subscribed."""
+    functions = self.channels_to_function.get(channel)
+    if isinstance(functions, list):
+      if function in functions:
+        functions.remove(function)
+    elif functions == function:
+      self.channels_to_function[channel] = []
+    self.rebuild_dispatch_table()
+
+  def add_raw_message_function(self, function):
+    """Adds a function that is called with every frame as it was received, before it's decoded or dispatched."""
+    with self._dispatch_table_lock:
+      self._raw_message_functions = self._raw_message_functions + (function,)
+
+  def remove_raw_message_function(self, function):
+    with self._dispatch_table_lock:
+      self._raw_message_functions = tuple(f for f in self._raw_message_functions if f != function)
+
   def add_product(self, product, refresh_subscriptions=True):
     if product not in self.products_to_listen:
       self.products_to_listen.append(product)
       if refresh_subscriptions:
         self.subscribe()
 
+  def remove_product(self, product, refresh_subscriptions=True):
+    """Stops listening to a product, unsubscribing it from every channel."""
+    if product in self.products_to_listen:
+      self.products_to_listen.remove(product)
+    for product_ids in self.channel_products.values():
+      if product in product_ids:
+        product_ids.remove(product)
+    if refresh_subscriptions:
+      self.subscribe()
+
   def add_channel(self, channel, refresh_subscriptions=True):
-    self.extra_channels.append(channel)
+    if channel not in self.extra_channels:
+      self.extra_channels.append(channel)
+      if refresh_subscriptions:
+        self.subscribe()
+
+  def add_channel_products(self, channel, product_ids, refresh_subscriptions=True):
+    """Subscribes to the products on this channel only, the channel stops following products_to_listen."""
+    channel_product_ids = self.channel_products.setdefault(channel, [])
+    for product_id in product_ids:
+      if product_id not in channel_product_ids:
+        channel_product_ids.append(product_id)
+    if refresh_subscriptions:
+      self.subscribe()
+
+  def remove_channel_products(self, channel, product_ids, refresh_subscriptions=True):
+    """Unsubscribes the products from this channel only."""
+    if channel not in self.channel_products:
+      # The channel followed products_to_listen until now, scope it to the rest of them.
+      self.channel_products[channel] = list(self.products_to_listen)
+    self.channel_products[channel] = [product_id for product_id in self.channel_products[channel]
+                                      if product_id not in product_ids]
+    if refresh_subscriptions:
+      self.subscribe()
+
+  def remove_channel(self, channel, refresh_subscriptions=True):
+    """Unsubscribes from a channel, for every product, and removes any functions on it."""
+    if channel in self.extra_channels:
+      self.extra_channels.remove(channel)
+    self.channel_products.pop(channel, None)
+    if channel in self.channels_to_function:
+      del self.channels_to_function[channel]
+      self.rebuild_dispatch_table()
+    if refresh_subscriptions:
+      self.subscribe()
+
+  def add_conflated_channel(self, channel, refresh_subscriptions=True):
+    """Subscribes to a channel, keeping only the latest message per product (see conflated_channels)."""
+    if channel not in self.conflated_channels:
+      self.conflated_channels = self.conflated_channels.union([channel])
+      if refresh_subscriptions:
+        self.subscribe()
+
+  def get_latest(self, channel, product_id):
+    """Returns the latest message of a conflated channel for the product, or None if there hasn't been one."""
+    return self.latest_values.get(channel, product_id)
+
+  def get_all_latest(self, channel):
+    """Returns a dict of product_id to the latest message of a conflated channel."""
+    return self.latest_values.get_all(channel)
+
+  def add_conflated_function(self, channel, function, interval: float = 1.0):
+    """Calls function, every interval seconds and on its own thread, with the latest message of each product whose
+    message on the conflated channel changed since the last call."""
+    self.latest_values.add_listener(channel, function, interval)
+
+  def remove_conflated_function(self, function):
+    self.latest_values.remove_listener(function)
 
   def add_authentication(self, api_key, api_secret, passphrase):
     self.api_key = api_key
     self.api_secret = api_secret
     self.passphrase = passphrase
+    # Subscribe to everything again, this time authenticated.
+    with self._subscription_lock:
+      self._set_active_subscriptions(set())
     self.subscribe()
 
   def subscribe(self):
-    channels = [channel for channel in self.channels_to_function.keys() if
-                channel not in SPECIAL_CHANNELS + FULL_CHANNELS] + self.extra_channels
-    if self.log_level >= LogLevel.VERBOSE_LOG:
-      logging.info("Subscribing to channels: {}".format(", ".join(channels)))
-    # Make sure there are channels and products to listen to.
-    if channels and self.products_to_listen:
-      self.ws.send(CoinbaseWebsocket.make_subscribe(self.products_to_listen,
-                                                    channels,
-                                                    self.api_key, self.api_secret, self.passphrase))
+    """Sends the subscribe/unsubscribe messages that take the connection from what it is subscribed to now to the
+    channels and products that are wanted, nothing is sent if nothing changed.
+
+    With a subscription_batch_window, the changes are sent once the window has passed, together with any other changes
+    made in the meantime.
+    """
+    if self.subscription_batch_window <= 0:
+      self._send_subscription_changes()
+      return
+    with self._subscription_lock:
+      if self._subscription_timer is None:
+        self._subscription_timer = threading.Timer(self.subscription_batch_window, self._send_subscription_changes)
+        self._subscription_timer.daemon = True
+        self._subscription_timer.start()
+
+  def resubscribe(self, channel, product_ids):
+    """Unsubscribes the products from the channel and subscribes them again, e.g. to get a new level2 snapshot.
+
+    Only products that are currently subscribed to on the channel are resubscribed.
+    """
+    with self._subscription_lock:
+      subscriptions = {(channel, product_id) for product_id in product_ids}.intersection(self._active_subscriptions)
+      if not subscriptions or not self.ws_opened.is_set():
+        return
+      try:
+        self.ws.send(CoinbaseWebsocket.make_channel_subscriptions(subscriptions, 'unsubscribe'))
+        self.ws.send(CoinbaseWebsocket.make_channel_subscriptions(subscriptions, 'subscribe',
+                                                                  self.api_key, self.api_secret, self.passphrase))
+      except websocket.WebSocketException as err:
+        if self.log_level >= LogLevel.ERROR_LOG:
+          logging.error('Failed to resubscribe: {}'.format(err))
+
+  def unsubscribe(self, product_ids):
+    """Stops listening to the products, unsubscribing them from every channel."""
+    for product_id in product_ids:
+      self.remove_product(product_id, refresh_subscriptions=False)
+    self.subscribe()
+
+  def get_connection_products(self, ws=None):
+    """Returns the products whose messages come over the connection ws (as passed to the 'open_websocket' functions).
+
+    This websocket has a single connection, so that's every product it listens to.
+    """
+    products = set(self.products_to_listen)
+    for product_ids in self.channel_products.values():
+      products.update(product_ids)
+    return products
+
+  def get_connection_stats(self):
+    """Returns reconnect and sequence counters for this websocket."""
+    return {
+      'connected': self.ws_opened.is_set(),
+      'reconnects': self._reconnects,
+      'sequence_gaps': self._sequence_gaps,
+      'out_of_order': self._out_of_order,
+    }
+
+  def get_latency_stats(self):
+    """Returns a summary of every latency histogram (see LatencyTracker.get_stats), or None if latency isn't tracked."""
+    if self.latency is None:
+      return None
+    return self.latency.get_stats()
+
+  def get_dispatch_stats(self):
+    """Returns queue depth, drop and conflation counters for the worker threads, or None if there aren't any."""
+    if self._dispatch_queue is None:
+      return None
+    return self._dispatch_queue.get_stats()
 
   def on_open(self, ws):
     if self.log_level >= LogLevel.BASIC_MESSAGES:
       logging.info('Coinbase Websocket Connection ({})'.format(self.websocket_addr))
+    self._connected_since_start = True
     self.ws_opened.set()
-    # Subscribe to defaults.
-    if self.products_to_listen and self.channels_to_function:
-      self.subscribe()
+    # Subscribe to defaults, after a reconnect this replays the current subscriptions.
+    with self._subscription_lock:
+      self._set_active_subscriptions(set())
+    self._send_subscription_changes()
     if 'open_websocket' in self.channels_to_function:
       self._execute_functions_on_message(ws, self._get_functions_as_list('open_websocket'))
 
@@ -189,42 +536,189 @@ class CoinbaseWebsocket:
     del ws  # We don't use this, but it's required by WebSocketApp.
     if self.log_level >= LogLevel.ERROR_LOG:
       logging.error('Error Received: {}'.format(err))
-    self._call_message_functions(err)
+    # Errors from the websocket itself (not "error" messages from Coinbase) aren't frames, don't try to decode them.
+    if 'error' in self.channels_to_function:
+      self._execute_functions_on_message(err, self._get_functions_as_list('error'))
 
   def on_message(self, ws, message):
     del ws  # We don't use this, but it's required by WebSocketApp.
     if self.log_level >= LogLevel.VERBOSE_LOG:
       logging.info('Message Received: {}'.format(message))
-    self._call_message_functions(message)
+    receive_ns = time.time_ns() if self.latency is not None else None
+    if self.frame_type == FrameType.MEMORYVIEW and not isinstance(message, memoryview):
+      message = memoryview(message)
+    for function in self._raw_message_functions:
+      function(message)
+    self._call_message_functions(message, receive_ns)
 
   def on_close(self, ws):
+    self.ws_opened.clear()
     if self.log_level >= LogLevel.BASIC_MESSAGES:
       logging.info('Coinbase Websocket Disconnection ({})'.format(self.websocket_addr))
     if 'close_websocket' in self.channels_to_function:
       self._execute_functions_on_message(ws, self._get_functions_as_list('close_websocket'))
 
-  def _call_message_functions(self, message):
-    json_msg = json.loads(message)
-    functions_to_execute = list()
-    if 'type' in json_msg:
-      if json_msg['type'] in self.channels_to_function:
-        functions_to_execute.extend(self._get_functions_as_list(json_msg['type']))
-      # Subscribe to "full" messages with "full" keyword.
-      if 'full' in self.channels_to_function and json_msg['type'] in FULL_CHANNELS:
-        functions_to_execute.extend(self._get_functions_as_list('full'))
-      # Matches messages come on "match" messages.
-      if 'matches' in self.channels_to_function and json_msg['type'] == 'match':
-        functions_to_execute.extend(self._get_functions_as_list('matches'))
-    if 'all_messages' in self.channels_to_function:
-      functions_to_execute.extend(self._get_functions_as_list('all_messages'))
-    self._execute_functions_on_message(message, functions_to_execute, json_msg)
-
-  def _execute_functions_on_message(self, message, functions, json_msg=None):
-    message_is_string = isinstance(message, str)
-    if json_msg is None and message_is_string:
-      json_msg = json.loads(message)
+  def _get_subscribed_channels(self):
+    return [channel for channel in self.channels_to_function.keys() if
+            channel not in _UNSUBSCRIBABLE_CHANNELS] + self.extra_channels
+
+  def _get_wanted_subscriptions(self):
+    """The (channel, product_id) pairs that should be subscribed to."""
+    wanted = set()
+    for channel in set(self._get_subscribed_channels()).union(self.channel_products.keys(), self.conflated_channels):
+      product_ids = self.channel_products.get(channel, self.products_to_listen)
+      wanted.update((channel, product_id) for product_id in product_ids)
+    return wanted
+
+  def _send_subscription_changes(self):
+    with self._subscription_lock:
+      self._subscription_timer = None
+      if not self.ws_opened.is_set():
+        # Everything is subscribed to in on_open.
+        return
+      wanted = self._get_wanted_subscriptions()
+      removed = self._active_subscriptions - wanted
+      added = wanted - self._active_subscriptions
+      try:
+        if removed:
+          if self.log_level >= LogLevel.VERBOSE_LOG:
+            logging.info('Unsubscribing from: {}'.format(sorted(removed)))
+          self.ws.send(CoinbaseWebsocket.make_channel_subscriptions(removed, 'unsubscribe'))
+        if added:
+          if self.log_level >= LogLevel.VERBOSE_LOG:
+            logging.info('Subscribing to: {}'.format(sorted(added)))
+          self.ws.send(CoinbaseWebsocket.make_channel_subscriptions(added, 'subscribe',
+                                                                    self.api_key, self.api_secret, self.passphrase))
+      except websocket.WebSocketException as err:
+        # The connection dropped, on_open subscribes to everything when it's back.
+        if self.log_level >= LogLevel.ERROR_LOG:
+          logging.error('Failed to update subscriptions: {}'.format(err))
+        return
+      self._set_active_subscriptions(wanted)
+
+  def _set_active_subscriptions(self, subscriptions):
+    """Must be called with the _subscription_lock held."""
+    self._active_subscriptions = subscriptions
+    self._sequenced_products = frozenset(product_id for channel, product_id in subscriptions if channel == 'full')
+    # A product that is subscribed again starts a new sequence, it isn't a gap.
+    for product_id in list(self._last_sequences):
+      if product_id not in self._sequenced_products:
+        self._last_sequences.pop(product_id, None)
+
+  def _call_message_functions(self, message, receive_ns=None):
+    if self.conflated_channels:
+      message_type = extract_message_type(message)
+      if message_type in self.conflated_channels:
+        # Only overwrite the slot, the reader decodes the message if and when it needs it.
+        if self.preparse_json:
+          message = LazyMessage(message, self.json_decoder)
+          self.latest_values.put(message_type, message.product_id, message)
+        else:
+          self.latest_values.put(message_type, extract_product_id(message), message)
+        return
+    # Decode the frame at most once, and only as far as the functions need it.
+    if not self.preparse_json:
+      message_type = extract_message_type(message)
+    elif self.typed_messages:
+      message = decode_typed_message(self.json_decoder(message))
+      message_type = message.get('type')
+    elif self.lazy_json:
+      message = LazyMessage(message, self.json_decoder)
+      message_type = message.type
+    else:
+      message = self.json_decoder(message)
+      message_type = message.get('type')
+    if self.detect_sequence_gaps and message_type in _SEQUENCED_MESSAGE_TYPES:
+      if not self._check_sequence(message):
+        return
+    # Read the table once, it may be swapped out by another thread while we are dispatching.
+    table, default_functions = self._dispatch_table
+    functions = table.get(message_type, default_functions)
+    if self.latency is not None and receive_ns is not None:
+      product_id = self._get_product_id(message)
+      self._record_exchange_latency(message, message_type, product_id, receive_ns)
+      if functions:
+        self._dispatch(message, functions, message_type, product_id, receive_ns)
+    elif functions:
+      self._dispatch(message, functions, message_type,
+                     self._get_product_id(message) if self._dispatch_queue is not None else None)
+
+  def _dispatch(self, message, functions, message_type, product_id, receive_ns=None):
+    if receive_ns is None:
+      execute, args = CoinbaseWebsocket._execute_functions_on_message, (message, functions)
+    else:
+      execute, args = self._execute_functions_timed, (message, functions, message_type, product_id, receive_ns)
+    if self._dispatch_queue is None:
+      execute(*args)
+    else:
+      self._dispatch_queue.submit(product_id, execute, args, conflation_key=(message_type, product_id))
+
+  def _execute_functions_timed(self, message, functions, message_type, product_id, receive_ns):
+    self.latency.record(RECEIVE_TO_DISPATCH, message_type, product_id, time.time_ns() - receive_ns)
     for function in functions:
-      function(json_msg if self.preparse_json and message_is_string else message)
+      start_ns = time.perf_counter_ns()
+      function(message)
+      self.latency.record(HANDLER, message_type, product_id, time.perf_counter_ns() - start_ns,
+                          handler=getattr(function, '__qualname__', None) or repr(function))
+
+  def _record_exchange_latency(self, message, message_type, product_id, receive_ns):
+    if not self.preparse_json:
+      exchange_time = extract_time(message)
+    elif self.lazy_json and not self.typed_messages:
+      exchange_time = extract_time(message.raw)
+    else:
+      exchange_time = message.get('time')
+    if exchange_time:
+      try:
+        self.latency.record(EXCHANGE_TO_RECEIVE, message_type, product_id,
+                            receive_ns - parse_exchange_time(exchange_time))
+      except ValueError:
+        pass  # Not a timestamp we understand, don't record it.
+
+  def _check_sequence(self, message):
+    """Tracks the sequence of the message's product, returns False if the message is older than the last one."""
+    product_id = self._get_product_id(message)
+    if product_id not in self._sequenced_products:
+      return True
+    if not self.preparse_json:
+      sequence = extract_sequence(message)
+    elif self.lazy_json and not self.typed_messages:
+      sequence = message.sequence
+    else:
+      sequence = message.get('sequence')
+    if sequence is None:
+      return True
+    last_sequence = self._last_sequences.get(product_id)
+    if last_sequence is None or sequence == last_sequence + 1:
+      self._last_sequences[product_id] = sequence
+      return True
+    out_of_order = sequence <= last_sequence
+    if out_of_order:
+      self._out_of_order += 1
+    else:
+      self._sequence_gaps += 1
+      self._last_sequences[product_id] = sequence
+    if self.log_level >= LogLevel.ERROR_LOG:
+      logging.error('Sequence {} for {} after {}'.format(sequence, product_id, last_sequence))
+    if 'sequence_gap' in self.channels_to_function:
+      # Dispatched like any other message for the product, so it is seen in order with the product's messages.
+      self._dispatch({'type': 'sequence_gap', 'channel': 'full', 'product_id': product_id,
+                      'last_sequence': last_sequence, 'sequence': sequence, 'out_of_order': out_of_order},
+                     CoinbaseWebsocket._functions_as_tuple(self.channels_to_function['sequence_gap']),
+                     'sequence_gap', product_id)
+    return not out_of_order
+
+  def _get_product_id(self, message):
+    if not self.preparse_json:
+      return extract_product_id(message)
+    elif self.lazy_json and not self.typed_messages:
+      return message.product_id
+    return message.get('product_id')
+
+  @staticmethod
+  def _execute_functions_on_message(message, functions):
+    for function in functions:
+      function(message)
 
   def _get_functions_as_list(self, message_type):
     functions_list = []
@@ -234,3 +728,9 @@ class CoinbaseWebsocket:
     else:
       functions_list.append(functions)
     return functions_list
+
+  @staticmethod
+  def _functions_as_tuple(functions):
+    if isinstance(functions, (list, tuple)):
+      return tuple(functions)
+    return (functions,)